@@ -16,20 +16,18 @@
 
 
 import os
-import redis
 import logging
 from logging import handlers
 from trader.settings import *
 from trader.strategy.brother2 import TradeStrategy
 from trader.utils.read_config import config_file, app_dir, config
+from trader.utils.redis_pool import redis_manager
 
 
 class RedislHandler(logging.StreamHandler):
     def __init__(self, channel: str):
         super().__init__()
-        self.redis_client = redis.StrictRedis(
-            host=config.get('REDIS', 'host', fallback='localhost'), port=config.getint('REDIS', 'port', fallback=6379),
-            db=config.getint('REDIS', 'db', fallback=0), decode_responses=True)
+        self.redis_client = redis_manager.client
         self.channel = channel
 
     def emit(self, message: logging.LogRecord):
@@ -13,9 +13,13 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import datetime
+from dataclasses import dataclass
+from decimal import Decimal
 import pandas as pd
 from pandas.io.sql import read_sql_query
 from django.db import models
+from django.db.models import Max, Count
 from django.db import connection
 from django.core.exceptions import EmptyResultSet
 
@@ -101,6 +105,30 @@ class Performance(models.Model):
         return '{}-{}'.format(self.broker, self.NAV)
 
 
+@dataclass(frozen=True)
+class StrategyParam:
+    """
+    策略参数快照, 由 Strategy.get_param 生成, 只读
+    """
+    break_n: int
+    atr_n: int
+    long_n: int
+    short_n: int
+    stop_n: int
+    risk: Decimal
+    update_time: datetime.datetime = None
+
+    # 字段名 -> (Param.code, 取值字段)
+    FIELDS = {
+        'break_n': ('BreakPeriod', 'int_value'),
+        'atr_n': ('AtrPeriod', 'int_value'),
+        'long_n': ('LongPeriod', 'int_value'),
+        'short_n': ('ShortPeriod', 'int_value'),
+        'stop_n': ('StopLoss', 'int_value'),
+        'risk': ('Risk', 'float_value'),
+    }
+
+
 class Strategy(models.Model):
     broker = models.ForeignKey(Broker, verbose_name='账户', on_delete=models.CASCADE)
     name = models.CharField(verbose_name='名称', max_length=64)
@@ -124,6 +152,27 @@ class Strategy(models.Model):
     get_force_opens.short_description = '手动开仓'
     get_force_opens.allow_tags = True
 
+    _param_cache = dict()  # { strategy_id: (版本, StrategyParam) }
+
+    def get_param(self) -> StrategyParam:
+        """
+        读取策略参数快照, 只有参数的更新时间或数量变化时才重新查询全部参数
+        """
+        version = self.param_set.aggregate(update_time=Max('update_time'), count=Count('id'))
+        version = (version['update_time'], version['count'])
+        cached = Strategy._param_cache.get(self.id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        values = {code: (int_value, float_value) for code, int_value, float_value in self.param_set.values_list(
+            'code', 'int_value', 'float_value')}
+        kwargs = dict()
+        for field, (code, value_field) in StrategyParam.FIELDS.items():
+            int_value, float_value = values[code]
+            kwargs[field] = int_value if value_field == 'int_value' else float_value
+        param = StrategyParam(update_time=version[0], **kwargs)
+        Strategy._param_cache[self.id] = (version, param)
+        return param
+
 
 class Param(models.Model):
     strategy = models.ForeignKey(Strategy, verbose_name='策略', on_delete=models.CASCADE)
@@ -208,6 +257,36 @@ class MainBar(models.Model):
     class Meta:
         verbose_name = '主力连续日K线'
         verbose_name_plural = '主力连续日K线列表'
+        constraints = [
+            models.UniqueConstraint(fields=['exchange', 'product_code', 'time'], name='unique_main_bar'),
+        ]
+
+    def __str__(self):
+        return '{}.{}'.format(self.exchange, self.product_code)
+
+
+class AdjustedMainBar(models.Model):
+    """
+    换月调整后的主力连续K线, 对应 trader.utils.create_adjusted_main_view 建立的数据库视图
+    """
+    exchange = models.CharField('交易所', max_length=8, choices=ExchangeType.choices)
+    product_code = models.CharField('品种代码', max_length=8, null=True)
+    code = models.CharField('合约代码', max_length=16, null=True, blank=True)
+    time = models.DateField('时间')
+    open = models.DecimalField(max_digits=12, decimal_places=3, verbose_name='开盘价')
+    high = models.DecimalField(max_digits=12, decimal_places=3, verbose_name='最高价')
+    low = models.DecimalField(max_digits=12, decimal_places=3, verbose_name='最低价')
+    close = models.DecimalField(max_digits=12, decimal_places=3, verbose_name='收盘价')
+    settlement = models.DecimalField(max_digits=12, decimal_places=3, verbose_name='结算价', null=True)
+    volume = models.IntegerField('成交量')
+    open_interest = models.DecimalField(max_digits=12, decimal_places=3, verbose_name='持仓量')
+    basis = models.DecimalField(max_digits=12, decimal_places=3, verbose_name='基差', null=True)
+
+    class Meta:
+        managed = False
+        db_table = 'panel_adjustedmainbar'
+        verbose_name = '调整后主力连续日K线'
+        verbose_name_plural = '调整后主力连续日K线列表'
 
     def __str__(self):
         return '{}.{}'.format(self.exchange, self.product_code)
@@ -229,11 +308,40 @@ class DailyBar(models.Model):
     class Meta:
         verbose_name = '日K线'
         verbose_name_plural = '日K线列表'
+        constraints = [
+            models.UniqueConstraint(fields=['exchange', 'code', 'time'], name='unique_daily_bar'),
+        ]
 
     def __str__(self):
         return '{}.{}'.format(self.exchange, self.code)
 
 
+class IntradayBar(models.Model):
+    """
+    由实时行情合成的K线, 见 trader.utils.bar_aggregator
+    """
+    code = models.CharField('合约代码', max_length=16)
+    period = models.IntegerField('周期(分钟)', help_text='0为交易日K线, -1为交易时段K线')
+    trading_day = models.DateField('交易日', db_index=True)
+    time = models.DateTimeField('开始时间')
+    open = models.DecimalField(max_digits=12, decimal_places=3, verbose_name='开盘价')
+    high = models.DecimalField(max_digits=12, decimal_places=3, verbose_name='最高价')
+    low = models.DecimalField(max_digits=12, decimal_places=3, verbose_name='最低价')
+    close = models.DecimalField(max_digits=12, decimal_places=3, verbose_name='收盘价')
+    volume = models.IntegerField('成交量')
+    open_interest = models.DecimalField(max_digits=12, decimal_places=3, verbose_name='持仓量')
+
+    class Meta:
+        verbose_name = '日内K线'
+        verbose_name_plural = '日内K线列表'
+        constraints = [
+            models.UniqueConstraint(fields=['code', 'period', 'time'], name='unique_intraday_bar'),
+        ]
+
+    def __str__(self):
+        return '{}.{}'.format(self.code, self.period)
+
+
 class Order(models.Model):
     broker = models.ForeignKey(Broker, verbose_name='账户', on_delete=models.CASCADE)
     strategy = models.ForeignKey(Strategy, verbose_name='策略', on_delete=models.SET_NULL, null=True, blank=True)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import sys
+import os
+import django
+if sys.platform == 'darwin':
+    sys.path.append('/Users/jeffchen/Documents/gitdir/dashboard')
+elif sys.platform == 'win32':
+    sys.path.append(r'E:\GitHub\dashboard')
+else:
+    sys.path.append('/root/dashboard')
+os.environ["DJANGO_SETTINGS_MODULE"] = "dashboard.settings"
+os.environ["DJANGO_ALLOW_ASYNC_UNSAFE"] = "true"
+django.setup()
+import datetime
+import unittest
+from trader.utils.bar_aggregator import BarAggregator, DAY, SESSION, trading_day_of, trading_sessions, session_minute
+from trader.utils.tick import TickBar
+
+
+def make_tick(instrument: str, time: str, price: float, volume: int) -> TickBar:
+    tick = TickBar.__new__(TickBar)
+    tick.instrument = instrument
+    tick.dateTime = datetime.datetime.strptime(time, '%Y-%m-%d %H:%M:%S')
+    tick.price = price
+    tick.volume = volume
+    tick.holding = 100.0
+    return tick
+
+
+class BarAggregatorTest(unittest.TestCase):
+    def locate(self, product_code: str, time: str):
+        time = datetime.datetime.strptime(time, '%H:%M:%S')
+        return BarAggregator._locate(trading_sessions(product_code), session_minute(time), time.second)
+
+    def test_trading_day_of(self):
+        cases = [('2023-01-06 21:30:00', '2023-01-09'),  # 周五夜盘属于下周一
+                 ('2023-01-07 00:30:00', '2023-01-09'),  # 周六凌晨
+                 ('2023-01-09 10:00:00', '2023-01-09'),
+                 ('2023-01-10 21:00:00', '2023-01-11')]
+        for time, day in cases:
+            self.assertEqual(trading_day_of(datetime.datetime.strptime(time, '%Y-%m-%d %H:%M:%S')),
+                             datetime.datetime.strptime(day, '%Y-%m-%d').date())
+
+    def test_locate(self):
+        self.assertEqual(self.locate('rb', '20:59:00'), 21 * 60)         # 集合竞价并入开盘第一分钟
+        self.assertEqual(self.locate('rb', '21:00:30'), 21 * 60)
+        self.assertEqual(self.locate('rb', '10:15:00'), 10 * 60 + 14)    # 休市时刻并入前一分钟
+        self.assertIsNone(self.locate('rb', '10:20:00'))
+        self.assertEqual(self.locate('rb', '15:00:00'), 14 * 60 + 59)    # 收盘时刻并入最后一分钟
+        self.assertIsNone(self.locate('rb', '15:00:01'))
+        self.assertIsNone(self.locate('rb', '00:30:00'))
+        self.assertEqual(self.locate('cu', '00:30:00'), 1440 + 30)
+        self.assertEqual(self.locate('IF', '09:25:00'), 9 * 60 + 30)
+        self.assertIsNone(self.locate('IF', '21:00:00'))
+
+    def test_late_tick_after_close(self):
+        aggregator = BarAggregator((1, DAY))
+        aggregator.update(make_tick('rb2305', '2023-01-09 14:59:10', 100, 10))
+        aggregator.update(make_tick('rb2305', '2023-01-09 14:59:50', 101, 20))
+        aggregator.close_due(datetime.datetime(2023, 1, 9, 15, 0, 10))
+        bars = aggregator.drain()
+        self.assertEqual([bar.volume for bar in bars], [20, 20])
+        # 本地时钟偏快, 收盘时刻的行情在K线结束后才到达
+        self.assertTrue(aggregator.update(make_tick('rb2305', '2023-01-09 15:00:00', 102, 25)))
+        aggregator.close_due(datetime.datetime(2023, 1, 9, 16))
+        self.assertEqual(aggregator.drain(), [])
+
+    def test_late_tick_in_previous_minute(self):
+        aggregator = BarAggregator((1, ))
+        aggregator.update(make_tick('rb2305', '2023-01-09 09:00:10', 100, 10))
+        aggregator.update(make_tick('rb2305', '2023-01-09 09:01:00', 101, 20))
+        aggregator.update(make_tick('rb2305', '2023-01-09 09:00:59', 99, 25))
+        aggregator.close_due(datetime.datetime(2023, 1, 9, 10))
+        bars = aggregator.drain()
+        self.assertEqual([bar.time.minute for bar in bars], [0, 1])
+        self.assertEqual(bars[1].open, 101)
+
+    def test_session_bars(self):
+        aggregator = BarAggregator((SESSION, ))
+        aggregator.update(make_tick('cu2305', '2023-01-06 21:00:05', 100, 10))
+        aggregator.update(make_tick('cu2305', '2023-01-07 00:59:59', 105, 30))
+        aggregator.update(make_tick('cu2305', '2023-01-09 09:05:00', 103, 35))   # 周五夜盘属于周一
+        aggregator.update(make_tick('cu2305', '2023-01-09 10:14:00', 102, 40))
+        aggregator.update(make_tick('cu2305', '2023-01-09 10:30:00', 101, 50))
+        aggregator.close_due(datetime.datetime(2023, 1, 9, 11, 31))
+        bars = aggregator.drain()
+        self.assertEqual([(bar.time, bar.end) for bar in bars], [
+            (datetime.datetime(2023, 1, 6, 21), datetime.datetime(2023, 1, 7, 1)),
+            (datetime.datetime(2023, 1, 9, 9), datetime.datetime(2023, 1, 9, 10, 15)),
+            (datetime.datetime(2023, 1, 9, 10, 30), datetime.datetime(2023, 1, 9, 11, 30))])
+        self.assertEqual([bar.trading_day for bar in bars], [datetime.date(2023, 1, 9)] * 3)
+        self.assertEqual([(bar.open, bar.close, bar.volume) for bar in bars], [(100, 105, 30), (103, 102, 10),
+                                                                              (101, 101, 10)])
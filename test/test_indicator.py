@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import sys
+import os
+import django
+if sys.platform == 'darwin':
+    sys.path.append('/Users/jeffchen/Documents/gitdir/dashboard')
+elif sys.platform == 'win32':
+    sys.path.append(r'E:\GitHub\dashboard')
+else:
+    sys.path.append('/root/dashboard')
+os.environ["DJANGO_SETTINGS_MODULE"] = "dashboard.settings"
+os.environ["DJANGO_ALLOW_ASYNC_UNSAFE"] = "true"
+django.setup()
+import unittest
+import numpy as np
+import pandas as pd
+from talib import ATR
+from trader.utils.indicator import calc_trend, calc_channel, calc_atr, calc_indicators
+
+
+class IndicatorTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(2016)
+        self.close = np.round(3000 + np.cumsum(rng.normal(0, 20, 400)), 1)
+        self.high = self.close + np.round(rng.random(400) * 30, 1)
+        self.low = self.close - np.round(rng.random(400) * 30, 1)
+
+    def loop_trend(self, close, period):
+        trend = close.copy()
+        for idx in range(1, close.shape[0]):
+            trend[idx] = (trend[idx - 1] * (period - 1) + close[idx]) / period
+        return trend
+
+    def test_trend_bit_identical(self):
+        self.assertTrue(np.array_equal(calc_trend(self.close, 10), self.loop_trend(self.close, 10)))
+        self.assertTrue(np.array_equal(calc_trend(self.close, 60), self.loop_trend(self.close, 60)))
+
+    def test_indicators(self):
+        df = pd.DataFrame({'high': self.high, 'low': self.low, 'close': self.close})
+        calc_indicators(df, 20, 26, 60, 10)
+        np.testing.assert_array_equal(df.atr.values, ATR(self.high, self.low, self.close, timeperiod=26))
+        np.testing.assert_array_equal(df.high_line.values, pd.Series(self.close).rolling(window=20).max().values)
+        np.testing.assert_array_equal(df.low_line.values, pd.Series(self.close).rolling(window=20).min().values)
+
+    def test_panel_with_missing_head(self):
+        pad = np.full(50, np.nan)
+        close = np.column_stack([self.close, np.concatenate([pad, self.close[:350]])])
+        high = np.column_stack([self.high, np.concatenate([pad, self.high[:350]])])
+        low = np.column_stack([self.low, np.concatenate([pad, self.low[:350]])])
+        trend = calc_trend(close, 10)
+        self.assertTrue(np.isnan(trend[:50, 1]).all())
+        np.testing.assert_array_equal(trend[50:, 1], self.loop_trend(self.close[:350], 10))
+        np.testing.assert_array_equal(calc_atr(high, low, close, 26)[50:, 1],
+                                      ATR(self.high[:350], self.low[:350], self.close[:350], timeperiod=26))
+        high_line, _ = calc_channel(close, 20)
+        np.testing.assert_array_equal(high_line[:, 0], pd.Series(self.close).rolling(window=20).max().values)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import sys
+import os
+import django
+if sys.platform == 'darwin':
+    sys.path.append('/Users/jeffchen/Documents/gitdir/dashboard')
+elif sys.platform == 'win32':
+    sys.path.append(r'E:\GitHub\dashboard')
+else:
+    sys.path.append('/root/dashboard')
+os.environ["DJANGO_SETTINGS_MODULE"] = "dashboard.settings"
+os.environ["DJANGO_ALLOW_ASYNC_UNSAFE"] = "true"
+django.setup()
+import asyncio
+import datetime
+import unittest
+import ujson as json
+from trader.strategy import BaseModule
+from trader.utils.func_container import RegisterCallback
+from trader.utils.tick import decode_tick
+
+TICK_PATTERN = 'MSG:CTP:RSP:MARKET:OnRtnDepthMarketData:*'
+ORDER_PATTERN = 'MSG:CTP:RSP:TRADE:OnRtnOrder:*'
+TICK = {'InstrumentID': 'rb2305', 'BidPrice1': 4000.0, 'BidVolume1': 1, 'AskPrice1': 4001.0, 'AskVolume1': 2,
+        'OpenInterest': 100.0, 'UpperLimitPrice': 4200.0, 'LowerLimitPrice': 3800.0, 'Volume': 10,
+        'LastPrice': 4000.0, 'HighestPrice': 4010.0, 'LowestPrice': 3990.0, 'OpenPrice': 4000.0,
+        'PreClosePrice': 3990.0, 'UpdateTime': '20230104 21:00:01:500'}
+
+
+class FakePubSub(object):
+    def __init__(self, messages: list):
+        self.messages = messages
+
+    async def listen(self):
+        for pattern, channel, data in self.messages:
+            yield {'type': 'pmessage', 'pattern': pattern, 'channel': channel, 'data': data}
+        yield {'type': 'punsubscribe'}
+
+
+class RecordModule(BaseModule):
+    def __init__(self):
+        super().__init__()
+        self.received = list()
+
+    @RegisterCallback(channel=TICK_PATTERN, decoder=decode_tick)
+    async def on_tick(self, channel, tick):
+        self.received.append(tick)
+
+    @RegisterCallback(channel=ORDER_PATTERN)
+    async def on_order(self, channel, order: dict):
+        self.received.append(order)
+
+
+class MsgReaderTest(unittest.TestCase):
+    def test_bad_message_does_not_stop_reader(self):
+        module = RecordModule()
+        module._register_callback()
+        bad_time = dict(TICK, UpdateTime='20230104 2x:00:01')
+        module.sub_client = FakePubSub([
+            (TICK_PATTERN, 'MSG:CTP:RSP:MARKET:OnRtnDepthMarketData:rb2305', '{bad json'),
+            (TICK_PATTERN, 'MSG:CTP:RSP:MARKET:OnRtnDepthMarketData:rb2305', json.dumps(bad_time)),
+            (TICK_PATTERN, 'MSG:CTP:RSP:MARKET:OnRtnDepthMarketData:rb2305', json.dumps({'InstrumentID': 'rb2305'})),
+            (TICK_PATTERN, 'MSG:CTP:RSP:MARKET:OnRtnDepthMarketData:rb2305', json.dumps(TICK)),
+            (ORDER_PATTERN, 'MSG:CTP:RSP:TRADE:OnRtnOrder:1', json.dumps({'OrderRef': '1'})),
+        ])
+        try:
+            module.io_loop.run_until_complete(asyncio.wait_for(module._msg_reader(), 5))
+            module.io_loop.run_until_complete(module.dispatcher.join())
+        finally:
+            module.io_loop.close()
+        self.assertEqual(len(module.received), 2)
+        self.assertEqual(module.received[0].dateTime, datetime.datetime(2023, 1, 4, 21, 0, 1, 500000))
+        self.assertEqual(module.received[1], {'OrderRef': '1'})
+        self.assertEqual(module.dispatcher.stats[TICK_PATTERN].dropped, 3)
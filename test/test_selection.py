@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import sys
+import os
+import django
+if sys.platform == 'darwin':
+    sys.path.append('/Users/jeffchen/Documents/gitdir/dashboard')
+elif sys.platform == 'win32':
+    sys.path.append(r'E:\GitHub\dashboard')
+else:
+    sys.path.append('/root/dashboard')
+os.environ["DJANGO_SETTINGS_MODULE"] = "dashboard.settings"
+os.environ["DJANGO_ALLOW_ASYNC_UNSAFE"] = "true"
+django.setup()
+import unittest
+from itertools import combinations
+import numpy as np
+import pandas as pd
+from trader.utils.selection import pair_cost, basket_cost, basket_score, enumerate_baskets, select_basket
+
+
+class SelectionTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(2016)
+        self.corr = pd.DataFrame(rng.normal(size=(300, 10))).corr()
+        self.cost = pair_cost(self.corr)
+
+    def brute_force(self, n: int, top: int) -> list:
+        return sorted((basket_cost(self.cost, basket), basket) for basket in combinations(range(10), n))[:top]
+
+    def test_enumerate_matches_brute_force(self):
+        for n in (2, 4, 7):
+            expected = self.brute_force(n, 3)
+            result = enumerate_baskets(self.cost, n, top=3)
+            self.assertEqual([basket for _, basket in result], [basket for _, basket in expected])
+            np.testing.assert_allclose([total for total, _ in result], [total for total, _ in expected])
+
+    def test_score_matches_find_best_score(self):
+        # 原来 find_best_score 的算法: 逐个组合取两两相关系数求平方均值
+        for basket in [(0, 1, 2), (1, 3, 5, 7), tuple(range(10))]:
+            score_df = pd.DataFrame([self.corr.iloc[i, j] for i, j in combinations(basket, 2)])
+            expected = (round((1 - (score_df.abs() ** 2).mean().iloc[0]) * 100, 3) - 50) * 2
+            self.assertAlmostEqual(basket_score(basket_cost(self.cost, basket), len(basket)), expected, places=9)
+
+    def test_select_basket(self):
+        expected = self.brute_force(4, 1)[0]
+        best = select_basket(self.corr, 4, top=1)[0]
+        self.assertEqual(best[1], expected[1])
+        self.assertAlmostEqual(best[0], basket_score(expected[0], 4), places=9)
+        # 超过穷举上限时用启发式搜索, 小规模下也应找到最优组合
+        heuristic = select_basket(self.corr, 4, time_budget=0.2, top=1, exhaustive_limit=0)[0]
+        self.assertEqual(heuristic[1], expected[1])
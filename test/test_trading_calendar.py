@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import sys
+import os
+import django
+if sys.platform == 'darwin':
+    sys.path.append('/Users/jeffchen/Documents/gitdir/dashboard')
+elif sys.platform == 'win32':
+    sys.path.append(r'E:\GitHub\dashboard')
+else:
+    sys.path.append('/root/dashboard')
+os.environ["DJANGO_SETTINGS_MODULE"] = "dashboard.settings"
+os.environ["DJANGO_ALLOW_ASYNC_UNSAFE"] = "true"
+django.setup()
+import asyncio
+import datetime
+import os
+import tempfile
+import unittest
+from unittest import mock
+from trader.utils import check_trading_day, cffex_pool
+from trader.utils.http_pool import HttpResult
+from trader.utils.trading_calendar import TradingCalendar
+
+HOLIDAYS = {datetime.date(2020, 1, 1), datetime.date(2020, 10, 1)}
+
+
+class TradingCalendarTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.failing = set()
+        self.flaky = dict()
+        self.in_flight = self.max_in_flight = 0
+        self.calendar = TradingCalendar(self.probe, os.path.join(self.tmp_dir.name, 'calendar.json'),
+                                        concurrency=4, backoff=0)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    async def probe(self, day: datetime.datetime):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0)
+            if day.date() in self.failing:
+                raise ValueError('HTTP 503')
+            if self.flaky.get(day.date(), 0) > 0:
+                self.flaky[day.date()] -= 1
+                raise ValueError('HTTP 429')
+            return day, day.date() not in HOLIDAYS
+        finally:
+            self.in_flight -= 1
+
+    async def test_bounded_and_retried(self):
+        self.flaky = {datetime.date(2020, 3, 2): 1, datetime.date(2020, 9, 1): 2}
+        await self.calendar.ensure(datetime.date(2020, 1, 1), datetime.date(2020, 12, 31))
+        self.assertEqual(self.max_in_flight, 4)
+        # 暂时失败的日子重试后成功, 整年都确认了
+        self.assertTrue(self.calendar.covers_range(datetime.date(2020, 1, 1), datetime.date(2020, 12, 31)))
+        self.assertTrue(self.calendar.is_trading_day(datetime.date(2020, 9, 1)))
+
+    async def test_probe_failure_stops_confirmation(self):
+        self.failing = {datetime.date(2020, 6, 1)}
+        await self.calendar.ensure(datetime.date(2020, 1, 1), datetime.date(2020, 12, 31))
+        self.assertEqual(self.calendar.covered[2020], datetime.date(2020, 5, 31))
+        self.assertFalse(self.calendar.covers(datetime.date(2020, 6, 1)))
+        # 失败之后的日子没有被当成非交易日
+        self.assertEqual(self.calendar.trading_days(datetime.date(2020, 6, 1), datetime.date(2020, 12, 31)), [])
+        self.failing = set()
+        await self.calendar.ensure(datetime.date(2020, 1, 1), datetime.date(2020, 12, 31))
+        self.assertTrue(self.calendar.covers_range(datetime.date(2020, 1, 1), datetime.date(2020, 12, 31)))
+        self.assertTrue(self.calendar.is_trading_day(datetime.date(2020, 6, 1)))
+        self.assertFalse(self.calendar.is_trading_day(datetime.date(2020, 10, 1)))
+
+    async def test_partial_year_not_covered(self):
+        self.failing = {datetime.date(2019, 6, 3)}
+        await self.calendar.ensure(datetime.date(2019, 1, 1), datetime.date(2020, 12, 31))
+        # 后面的年份完整, 前面的年份只确认了一部分
+        self.assertTrue(self.calendar.covers(datetime.date(2020, 12, 31)))
+        self.assertFalse(self.calendar.covers_range(datetime.date(2019, 1, 1), datetime.date(2020, 12, 31)))
+        self.assertTrue(self.calendar.covers_range(datetime.date(2019, 1, 1), datetime.date(2019, 5, 31)))
+        self.assertTrue(self.calendar.covers_range(datetime.date(2020, 1, 1), datetime.date(2020, 12, 31)))
+
+    async def test_check_trading_day_status(self):
+        day = datetime.datetime(2020, 6, 1)
+        for status, expected in ((200, True), (404, False), (302, False)):
+            with mock.patch.object(cffex_pool, 'get', mock.AsyncMock(return_value=HttpResult(status, b'', None))):
+                self.assertEqual(await check_trading_day(day), (day, expected))
+        for status in (429, 503):
+            with mock.patch.object(cffex_pool, 'get', mock.AsyncMock(return_value=HttpResult(status, b'', None))):
+                with self.assertRaises(ValueError):
+                    await check_trading_day(day)
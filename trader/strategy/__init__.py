@@ -13,7 +13,6 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
-import redis
 import ujson as json
 
 import pytz
@@ -25,10 +24,11 @@ from django.utils import timezone
 from croniter import croniter
 import asyncio
 from abc import abstractmethod, ABCMeta
-from redis import asyncio as aioredis
 
+from trader.utils.dispatcher import ChannelDispatcher, QUEUE, SERIAL_CHANNEL
 from trader.utils.func_container import CallbackFunctionContainer
 from trader.utils.read_config import config
+from trader.utils.redis_pool import redis_manager
 
 logger = logging.getLogger('BaseModule')
 
@@ -38,19 +38,17 @@ class BaseModule(CallbackFunctionContainer, metaclass=ABCMeta):
         super().__init__()
         self.io_loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.io_loop)
-        self.redis_client = aioredis.from_url(
-            f"redis://{config.get('REDIS', 'host', fallback='localhost')}:"
-            f"{config.getint('REDIS', 'port', fallback=6379)}/{config.getint('REDIS', 'db', fallback=0)}",
-            decode_responses=True)
-        self.raw_redis = redis.StrictRedis(host=config.get('REDIS', 'host', fallback='localhost'),
-                                           port=config.getint(
-                                               'REDIS', 'port', fallback=6379),
-                                           db=config.getint('REDIS', 'db', fallback=0), decode_responses=True)
+        # 与进程内其他模块共用连接池
+        self.redis_client = redis_manager.async_client
+        self.raw_redis = redis_manager.client
         self.sub_client = self.redis_client.pubsub()
         self.initialized = False
         self.sub_tasks = list()
         self.sub_channels = list()
         self.channel_router = dict()
+        self.channel_decoder = dict()
+        self.dispatcher = ChannelDispatcher(config.getint('TRADE', 'callback_concurrency', fallback=64),
+                                            config.getint('TRADE', 'callback_max_pending', fallback=10000))
         self.crontab_router = defaultdict(dict)
         self.datetime = None
         self.time = None
@@ -62,13 +60,20 @@ class BaseModule(CallbackFunctionContainer, metaclass=ABCMeta):
         self.loop_time = self.io_loop.time()
         for fun_name, args in self.callback_fun_args.items():
             if 'crontab' in args:
-                key = args['crontab']
+                # 以函数名为键, 多个回调可以使用相同的 crontab
+                key = fun_name
                 self.crontab_router[key]['func'] = getattr(self, fun_name)
                 self.crontab_router[key]['iter'] = croniter(
                     args['crontab'], self.datetime)
                 self.crontab_router[key]['handle'] = None
             elif 'channel' in args:
                 self.channel_router[args['channel']] = getattr(self, fun_name)
+                # 消息解码器, 默认解析成字典, 行情等高频频道可以指定更快的解码器
+                self.channel_decoder[args['channel']] = args.get('decoder', json.loads)
+                capture = args.get('capture')
+                self.dispatcher.add_route(
+                    args['channel'], getattr(self, fun_name), args.get('policy', QUEUE),
+                    args.get('serial', SERIAL_CHANNEL), None if capture is None else getattr(self, capture))
 
     def _get_next(self, key):
         return self.loop_time + (self.crontab_router[key]['iter'].get_next() - self.time)
@@ -103,6 +108,7 @@ class BaseModule(CallbackFunctionContainer, metaclass=ABCMeta):
             # await asyncio.wait(self.sub_tasks, loop=self.io_loop)
             self.sub_tasks.clear()
             await self.sub_client.close()
+            self.dispatcher.cancel()
             for key, cron_dict in self.crontab_router.items():
                 if self.crontab_router[key]['handle'] is not None:
                     self.crontab_router[key]['handle'].cancel()
@@ -119,10 +125,14 @@ class BaseModule(CallbackFunctionContainer, metaclass=ABCMeta):
             if msg['type'] == 'pmessage':
                 channel = msg['channel']
                 pattern = msg['pattern']
-                data = json.loads(msg['data'])
-                # logger.debug("%s channel[%s] Got Message:%s", type(self).__name__, channel, msg)
-                self.io_loop.create_task(
-                    self.channel_router[pattern](channel, data))
+                # 一条消息出错只丢弃这一条, 不能让读取结束, 否则所有订阅都收不到消息
+                try:
+                    data = self.channel_decoder[pattern](msg['data'])
+                    # logger.debug("%s channel[%s] Got Message:%s", type(self).__name__, channel, msg)
+                    await self.dispatcher.dispatch(pattern, channel, data)
+                except Exception as e:
+                    self.dispatcher.stats[pattern].dropped += 1
+                    logger.warning(f'{channel} 消息解码或分发发生错误: {repr(e)}', exc_info=True)
             elif msg['type'] == 'punsubscribe':
                 break
         logger.debug('%s quit _msg_reader!', type(self).__name__)
@@ -132,6 +142,7 @@ class BaseModule(CallbackFunctionContainer, metaclass=ABCMeta):
 
     async def stop(self):
         await self.uninstall()
+        await redis_manager.aclose()
 
     def run(self):
         try:
@@ -21,15 +21,24 @@ from decimal import Decimal
 import logging
 from django.db.models import Q, F, Sum
 from django.utils import timezone
-from talib import ATR
 import ujson as json
 from typing import Tuple
-from redis import asyncio as aioredis
 from trader.strategy import BaseModule
 from trader.utils.func_container import RegisterCallback
 from trader.utils.read_config import config, ctp_errors
 from trader.utils import ApiStruct, price_round, is_trading_day, update_from_shfe, update_from_dce, update_from_czce, update_from_cffex, \
-    get_contracts_argument, calc_main_inst, str_to_number, get_next_id, ORDER_REF_SIGNAL_ID_START, update_from_gfex
+    get_contracts_argument, calc_main_inst, str_to_number, get_next_id, ORDER_REF_SIGNAL_ID_START, update_from_gfex, \
+    load_main_bars, panel_to_frames, close_http_pools, load_main_frame, store_intraday_bars
+from trader.utils.correlation import correlation_service
+from trader.utils.indicator import calc_indicators, calc_panel_indicators
+from trader.utils.rpc import RpcMultiplexer, TokenBucket
+from trader.utils.tick import TickBar, decode_tick
+from trader.utils.tick_buffer import TickBufferPool
+from trader.utils.bar_aggregator import BarAggregator
+from trader.utils.tick_journal import TickJournal
+from trader.utils.dispatcher import LATEST
+from trader.utils.db_executor import DBExecutor
+from trader.utils.redis_pool import redis_manager
 from panel.models import *
 
 logger = logging.getLogger('CTPApi')
@@ -44,6 +53,20 @@ class TradeStrategy(BaseModule):
         self.__trade_response_format = config.get(
             'MSG_CHANNEL', 'trade_response_format')
         self.__request_format = config.get('MSG_CHANNEL', 'request_format')
+        trade_response_prefix = config.get('MSG_CHANNEL', 'trade_response_prefix')
+        market_response_prefix = config.get('MSG_CHANNEL', 'market_response_prefix')
+        # 行情推送(OnRtnDepthMarketData)量很大且不属于请求应答, 不订阅
+        self.__rpc = RpcMultiplexer(self.redis_client, [
+            trade_response_prefix + 'OnRsp*', trade_response_prefix + 'OnRtnOrder:*',
+            market_response_prefix + 'OnRsp*'])
+        self.__query_semaphore = asyncio.Semaphore(config.getint('TRADE', 'query_concurrency', fallback=8))
+        self.__query_bucket = TokenBucket(config.getfloat('TRADE', 'query_rate', fallback=1))
+        self.__tick_buffers = TickBufferPool(config.getint('TRADE', 'tick_buffer_size', fallback=4096))
+        self.__bar_aggregator = BarAggregator()
+        self.__tick_journal = TickJournal() if config.getboolean('TRADE', 'tick_journal', fallback=True) else None
+        # 数据库操作在专用线程中执行, 盘后指标计算交给进程池
+        self.__db = DBExecutor(config.getint('TRADE', 'db_workers', fallback=4),
+                               config.getint('TRADE', 'cpu_workers', fallback=None))
         self.__ignore_inst_list = config.get(
             'TRADE', 'ignore_inst', fallback="WH,bb,JR,RI,RS,LR,PM,im").split(',')
         self.__strategy = Strategy.objects.get(name=name)
@@ -71,7 +94,11 @@ class TradeStrategy(BaseModule):
 
     async def start(self):
         await self.install()
+        if self.__tick_journal is not None:
+            self.__tick_journal.start()
+        await self.__rpc.start()
         self.raw_redis.set('HEARTBEAT:TRADER', 1, ex=61)
+        logger.debug(f'redis 连接: {redis_manager.stats()}')
         today = timezone.localtime()
         now = int(today.strftime('%H%M'))
         if today.isoweekday() < 6 and (820 <= now <= 1550 or 2010 <= now <= 2359):  # 非交易时间查不到数据
@@ -86,12 +113,21 @@ class TradeStrategy(BaseModule):
                     await self.cancel_order(order)
                 # 已成交订单
                 elif order['OrderSubmitStatus'] == ApiStruct.OSS_Accepted:
-                    self.save_order(order)
+                    await self.__db.run(self.save_order, order)
             await self.refresh_position()
         # today = timezone.make_aware(datetime.datetime.strptime(self.raw_redis.get('LastTradingDay'), '%Y%m%d'))
-        # self.calculate(today, create_main_bar=False)
+        # await self.calculate(today, create_main_bar=False)
         # await self.processing_signal3()
 
+    async def stop(self):
+        await self.__rpc.stop()
+        await self.__db.run(store_intraday_bars, self.__bar_aggregator.drain())
+        if self.__tick_journal is not None:
+            self.__tick_journal.stop()
+        self.__db.shutdown()
+        await close_http_pools()
+        await super().stop()
+
     async def refresh_account(self):
         try:
             logger.debug('更新账户')
@@ -116,8 +152,7 @@ class TradeStrategy(BaseModule):
             self.__broker.current = self.__current
             self.__broker.pre_balance = self.__pre_balance
             self.__broker.margin = self.__margin
-            self.__broker.save(
-                update_fields=['cash', 'current', 'pre_balance', 'margin'])
+            await self.__db.save(self.__broker, update_fields=['cash', 'current', 'pre_balance', 'margin'])
             logger.debug(f"更新账户,可用资金: {self.__cash:,.0f} 静态权益: {self.__pre_balance:,.0f} 动态权益: {self.__current:,.0f} "
                          f"出入金: {self.__withdraw - self.__deposit:,.0f} 虚拟: {fake:,.0f}")
         except Exception as e:
@@ -141,38 +176,44 @@ class TradeStrategy(BaseModule):
                         old_pos['Volume'] += pos['Volume']
                         old_pos['PositionProfitByTrade'] += pos['PositionProfitByTrade']
                         old_pos['Margin'] += pos['Margin']
-            Trade.objects.filter(~Q(code__in=self.__cur_pos.keys(
-            )), close_time__isnull=True).delete()  # 删除不存在的头寸
-            for _, pos in self.__cur_pos.items():
-                p_code = self.__re_extract_code.match(
-                    pos['InstrumentID']).group(1)
-                inst = Instrument.objects.get(product_code=p_code)
-                trade = Trade.objects.filter(broker=self.__broker, strategy=self.__strategy, instrument=inst, code=pos['InstrumentID'], close_time__isnull=True,
-                                             direction=DirectionType.values[pos['Direction']]).first()
-                bar = DailyBar.objects.filter(
-                    code=pos['InstrumentID']).order_by('-time').first()
-                profit = (
-                    bar.close - Decimal(pos['OpenPrice'])) * pos['Volume'] * inst.volume_multiple
-                if pos['Direction'] == DirectionType.values[DirectionType.SHORT]:
-                    profit *= -1
-                if trade:
-                    trade.shares = (
-                        trade.closed_shares if trade.closed_shares else 0) + pos['Volume']
-                    trade.filled_shares = trade.shares
-                    trade.profit = profit
-                    trade.save(update_fields=[
-                               'shares', 'filled_shares', 'profit'])
-                else:
-                    Trade.objects.create(
-                        broker=self.__broker, strategy=self.__strategy, instrument=inst, code=pos[
-                            'InstrumentID'], profit=profit, filled_shares=pos['Volume'],
-                        direction=DirectionType.values[pos['Direction']], avg_entry_price=Decimal(pos['OpenPrice']), shares=pos['Volume'],
-                        open_time=timezone.make_aware(datetime.datetime.strptime(pos['OpenDate'] + '08', '%Y%m%d%H')), frozen_margin=Decimal(pos['Margin']),
-                        cost=pos['Volume'] * Decimal(pos['OpenPrice']) * inst.fee_money * inst.volume_multiple + pos['Volume'] * inst.fee_volume)
+            await self.__db.run(self.save_positions, dict(self.__cur_pos))
             logger.debug('更新持仓完成!')
         except Exception as e:
             logger.warning(f'refresh_position 发生错误: {repr(e)}', exc_info=True)
 
+    def save_positions(self, positions: dict):
+        """
+        按柜台的持仓明细更新数据库中的持仓, 在数据库线程中执行
+        :param positions: {合约代码: 合并后的持仓}
+        """
+        Trade.objects.filter(~Q(code__in=positions.keys()), close_time__isnull=True).delete()  # 删除不存在的头寸
+        for _, pos in positions.items():
+            p_code = self.__re_extract_code.match(
+                pos['InstrumentID']).group(1)
+            inst = Instrument.objects.get(product_code=p_code)
+            trade = Trade.objects.filter(broker=self.__broker, strategy=self.__strategy, instrument=inst, code=pos['InstrumentID'], close_time__isnull=True,
+                                         direction=DirectionType.values[pos['Direction']]).first()
+            bar = DailyBar.objects.filter(
+                code=pos['InstrumentID']).order_by('-time').first()
+            profit = (
+                bar.close - Decimal(pos['OpenPrice'])) * pos['Volume'] * inst.volume_multiple
+            if pos['Direction'] == DirectionType.values[DirectionType.SHORT]:
+                profit *= -1
+            if trade:
+                trade.shares = (
+                    trade.closed_shares if trade.closed_shares else 0) + pos['Volume']
+                trade.filled_shares = trade.shares
+                trade.profit = profit
+                trade.save(update_fields=[
+                           'shares', 'filled_shares', 'profit'])
+            else:
+                Trade.objects.create(
+                    broker=self.__broker, strategy=self.__strategy, instrument=inst, code=pos[
+                        'InstrumentID'], profit=profit, filled_shares=pos['Volume'],
+                    direction=DirectionType.values[pos['Direction']], avg_entry_price=Decimal(pos['OpenPrice']), shares=pos['Volume'],
+                    open_time=timezone.make_aware(datetime.datetime.strptime(pos['OpenDate'] + '08', '%Y%m%d%H')), frozen_margin=Decimal(pos['Margin']),
+                    cost=pos['Volume'] * Decimal(pos['OpenPrice']) * inst.fee_money * inst.volume_multiple + pos['Volume'] * inst.fee_volume)
+
     async def refresh_instrument(self):
         try:
             logger.debug("更新合约...")
@@ -193,6 +234,8 @@ class TradeStrategy(BaseModule):
                                                  ]['multiple'] = inst['VolumeMultiple']
                     inst_dict[inst['ProductID']][inst['InstrumentID']
                                                  ]['price_tick'] = inst['PriceTick']
+            inst_list = list()
+            exist_dict = await self.__db.run(Instrument.objects.in_bulk, list(inst_dict.keys()), field_name='product_code')
             for code in inst_dict.keys():
                 all_inst = ','.join(sorted(inst_dict[code].keys()))
                 inst_data = list(inst_dict[code].values())[0]
@@ -204,35 +247,52 @@ class TradeStrategy(BaseModule):
                 if valid_name == code:
                     valid_name = ''
                 inst_data['name'] = valid_name
-                inst, created = Instrument.objects.update_or_create(
-                    product_code=code, exchange=inst_data['exchange'])
+                inst = exist_dict.get(code)
+                created = inst is None
+                if created:
+                    inst = await self.__db.create(Instrument, product_code=code, exchange=inst_data['exchange'])
                 print(
                     f"inst:{inst} created:{created} main_code:{inst.main_code}")
-                update_field_list = list()
-                # 更新主力合约的保证金和手续费
-                if inst.main_code:
-                    margin_rate = await self.query('InstrumentMarginRate', InstrumentID=inst.main_code)
-                    inst.margin_rate = margin_rate[0]['LongMarginRatioByMoney']
-                    fee = await self.query('InstrumentCommissionRate', InstrumentID=inst.main_code)
-                    inst.fee_money = Decimal(fee[0]['CloseRatioByMoney'])
-                    inst.fee_volume = Decimal(fee[0]['CloseRatioByVolume'])
-                    update_field_list += ['margin_rate',
-                                          'fee_money', 'fee_volume']
                 if created:
                     inst.name = inst_data['name']
                     inst.volume_multiple = inst_data['multiple']
                     inst.price_tick = inst_data['price_tick']
-                    update_field_list += ['name',
-                                          'volume_multiple', 'price_tick']
                 elif inst.main_code:
                     inst.all_inst = all_inst
-                    update_field_list.append('all_inst')
-                inst.save(update_fields=update_field_list)
+                inst_list.append(inst)
+            # 并发查询主力合约的保证金和手续费
+            rate_dict = await self.query_instrument_rate([inst.main_code for inst in inst_list if inst.main_code])
+            for inst in inst_list:
+                margin_rate, fee = rate_dict.get(inst.main_code, (None, None))
+                if margin_rate:
+                    inst.margin_rate = margin_rate[0]['LongMarginRatioByMoney']
+                if fee:
+                    inst.fee_money = Decimal(fee[0]['CloseRatioByMoney'])
+                    inst.fee_volume = Decimal(fee[0]['CloseRatioByVolume'])
+            await self.__db.bulk_update(Instrument, inst_list, [
+                'name', 'volume_multiple', 'price_tick', 'all_inst', 'margin_rate', 'fee_money', 'fee_volume'])
             logger.debug("更新合约完成!")
         except Exception as e:
             logger.warning(
                 f'refresh_instrument 发生错误: {repr(e)}', exc_info=True)
 
+    async def query_instrument_rate(self, inst_codes: list) -> dict:
+        """
+        并发查询合约的保证金率和手续费率, 同时进行的查询数受 query_concurrency 限制,
+        发送速度受令牌桶限制, 以免触发CTP查询流控
+        :return: { 合约代码: (保证金率应答, 手续费率应答) }, 查询失败的应答为None
+        """
+        async def limited_query(query_type: str, inst_code: str):
+            async with self.__query_semaphore:
+                await self.__query_bucket.acquire()
+                rst = await self.query(query_type, InstrumentID=inst_code)
+                if not rst:
+                    logger.warning(f'{inst_code} {query_type} 查询失败')
+                return rst
+        results = await asyncio.gather(*[limited_query(query_type, code) for code in inst_codes
+                                         for query_type in ('InstrumentMarginRate', 'InstrumentCommissionRate')])
+        return {code: (results[i * 2], results[i * 2 + 1]) for i, code in enumerate(inst_codes)}
+
     def getShares(self, instrument: str):
         # 这个函数只能处理持有单一方向仓位的情况，若同时持有多空的头寸，返回结果不正确
         shares = 0
@@ -253,189 +313,134 @@ class TradeStrategy(BaseModule):
         self.raw_redis.publish(self.__request_format.format(
             'ReqQry' + query_type), json.dumps(kwargs))
 
-    @staticmethod
-    async def query_reader(pb: aioredis.client.PubSub):
-        msg_list = []
-        async for msg in pb.listen():
-            # print(f"query_reader msg: {msg}")
-            msg_dict = json.loads(msg['data'])
-            if 'empty' not in msg_dict or not msg_dict['empty']:
-                msg_list.append(msg_dict)
-            if 'bIsLast' not in msg_dict or msg_dict['bIsLast']:
-                return msg_list
-
     async def query(self, query_type: str, **kwargs):
-        sub_client = None
-        channel_rsp_qry, channel_rsp_err = None, None
         try:
-            sub_client = self.redis_client.pubsub(
-                ignore_subscribe_messages=True)
             request_id = get_next_id()
             kwargs['RequestID'] = request_id
-            channel_rsp_qry = self.__trade_response_format.format(
-                'OnRspQry' + query_type, request_id)
-            channel_rsp_err = self.__trade_response_format.format(
-                'OnRspError', request_id)
-            await sub_client.psubscribe(channel_rsp_qry, channel_rsp_err)
-            task = asyncio.create_task(self.query_reader(sub_client))
-            self.raw_redis.publish(self.__request_format.format(
-                'ReqQry' + query_type), json.dumps(kwargs))
-            await asyncio.wait_for(task, HANDLER_TIME_OUT)
-            await sub_client.punsubscribe()
-            await sub_client.close()
-            return task.result()
+            return await self.__rpc.call(
+                [self.__trade_response_format.format('OnRspQry' + query_type, request_id),
+                 self.__trade_response_format.format('OnRspError', request_id)],
+                self.__request_format.format('ReqQry' + query_type), json.dumps(kwargs), HANDLER_TIME_OUT)
         except Exception as e:
             logger.warning(f'{query_type} 发生错误: {repr(e)}', exc_info=True)
-            if sub_client and channel_rsp_qry:
-                await sub_client.unsubscribe()
-                await sub_client.close()
             return None
 
     async def SubscribeMarketData(self, inst_ids: list):
-        sub_client = None
-        channel_rsp_dat, channel_rsp_err = None, None
         try:
-            sub_client = self.redis_client.pubsub(
-                ignore_subscribe_messages=True)
-            channel_rsp_dat = self.__market_response_format.format(
-                'OnRspSubMarketData', 0)
-            channel_rsp_err = self.__market_response_format.format(
-                'OnRspError', 0)
-            await sub_client.psubscribe(channel_rsp_dat, channel_rsp_err)
-            task = asyncio.create_task(self.query_reader(sub_client))
-            self.raw_redis.publish(self.__request_format.format(
-                'SubscribeMarketData'), json.dumps(inst_ids))
-            await asyncio.wait_for(task, HANDLER_TIME_OUT)
-            await sub_client.punsubscribe()
-            await sub_client.close()
-            return task.result()
+            self.__tick_buffers.ensure(inst_ids)
+            return await self.__rpc.call(
+                [self.__market_response_format.format('OnRspSubMarketData', 0),
+                 self.__market_response_format.format('OnRspError', 0)],
+                self.__request_format.format('SubscribeMarketData'), json.dumps(inst_ids), HANDLER_TIME_OUT)
         except Exception as e:
             logger.warning(
                 f'SubscribeMarketData 发生错误: {repr(e)}', exc_info=True)
-            if sub_client and sub_client.in_pubsub and channel_rsp_dat:
-                await sub_client.unsubscribe()
-                await sub_client.close()
             return None
 
     async def UnSubscribeMarketData(self, inst_ids: list):
-        sub_client = None
-        channel_rsp_dat, channel_rsp_err = None, None
         try:
-            sub_client = self.redis_client.pubsub(
-                ignore_subscribe_messages=True)
-            channel_rsp_dat = self.__market_response_format.format(
-                'OnRspUnSubMarketData', 0)
-            channel_rsp_err = self.__market_response_format.format(
-                'OnRspError', 0)
-            await sub_client.psubscribe(channel_rsp_dat, channel_rsp_err)
-            task = asyncio.create_task(self.query_reader(sub_client))
-            self.raw_redis.publish(self.__request_format.format(
-                'UnSubscribeMarketData'), json.dumps(inst_ids))
-            await asyncio.wait_for(task, HANDLER_TIME_OUT)
-            await sub_client.punsubscribe()
-            await sub_client.close()
-            return task.result()
+            self.__tick_buffers.discard(inst_ids)
+            return await self.__rpc.call(
+                [self.__market_response_format.format('OnRspUnSubMarketData', 0),
+                 self.__market_response_format.format('OnRspError', 0)],
+                self.__request_format.format('UnSubscribeMarketData'), json.dumps(inst_ids), HANDLER_TIME_OUT)
         except Exception as e:
             logger.warning(
                 f'UnSubscribeMarketData 发生错误: {repr(e)}', exc_info=True)
-            if sub_client and sub_client.in_pubsub and channel_rsp_dat:
-                await sub_client.unsubscribe()
-                await sub_client.close()
             return None
 
-    def ReqOrderInsert(self, sig: Signal):
+    async def ReqOrderInsert(self, sig: Signal):
         try:
-            request_id = get_next_id()
-            autoid = Autonumber.objects.create()
-            order_ref = f"{autoid.id:07}{sig.id:05}"
-            param_dict = dict()
-            param_dict['RequestID'] = request_id
-            param_dict['OrderRef'] = order_ref
-            param_dict['InstrumentID'] = sig.code
-            param_dict['VolumeTotalOriginal'] = sig.volume
-            param_dict['LimitPrice'] = float(sig.price)
-            match sig.type:
-                case SignalType.BUY | SignalType.SELL_SHORT:
-                    param_dict['Direction'] = ApiStruct.D_Buy if sig.type == SignalType.BUY else ApiStruct.D_Sell
-                    param_dict['CombOffsetFlag'] = ApiStruct.OF_Open
-                    logger.info(
-                        f'{sig.instrument} {sig.type}{sig.volume}手 价格: {sig.price}')
-                case SignalType.BUY_COVER | SignalType.SELL:
-                    param_dict['Direction'] = ApiStruct.D_Buy if sig.type == SignalType.BUY_COVER else ApiStruct.D_Sell
-                    param_dict['CombOffsetFlag'] = ApiStruct.OF_Close
-                    pos = Trade.objects.filter(
-                        broker=self.__broker, strategy=self.__strategy, code=sig.code, shares=sig.volume, close_time__isnull=True,
-                        direction=DirectionType.values[DirectionType.SHORT] if sig.type == SignalType.BUY_COVER else DirectionType.values[
-                            DirectionType.LONG]).first()
-                    if pos.open_time.astimezone().date() == timezone.localtime().date() and pos.instrument.exchange == ExchangeType.SHFE:
-                        # 上期所区分平今和平昨
-                        param_dict['CombOffsetFlag'] = ApiStruct.OF_CloseToday
-                    logger.info(
-                        f'{sig.instrument} {sig.type}{sig.volume}手 价格: {sig.price}')
-                case SignalType.ROLL_CLOSE:
-                    param_dict['CombOffsetFlag'] = ApiStruct.OF_Close
-                    pos = Trade.objects.filter(broker=self.__broker, strategy=self.__strategy,
-                                               code=sig.code, shares=sig.volume, close_time__isnull=True).first()
-                    param_dict['Direction'] = ApiStruct.D_Sell if pos.direction == DirectionType.values[DirectionType.LONG] else ApiStruct.D_Buy
-                    if pos.open_time.astimezone().date() == timezone.localtime().date() and pos.instrument.exchange == ExchangeType.SHFE:
-                        # 上期所区分平今和平昨
-                        param_dict['CombOffsetFlag'] = ApiStruct.OF_CloseToday
-                    logger.info(
-                        f'{sig.code}->{sig.instrument.main_code} {pos.direction}头换月平旧{sig.volume}手 价格: {sig.price}')
-                case SignalType.ROLL_OPEN:
-                    param_dict['CombOffsetFlag'] = ApiStruct.OF_Open
-                    pos = Trade.objects.filter(
-                        Q(close_time__isnull=True) | Q(
-                            close_time__date__gte=timezone.localtime().now().date()),
-                        broker=self.__broker, strategy=self.__strategy, code=sig.instrument.last_main, shares=sig.volume).first()
-                    param_dict['Direction'] = ApiStruct.D_Buy if pos.direction == DirectionType.values[DirectionType.LONG] else ApiStruct.D_Sell
-                    logger.info(
-                        f'{pos.code}->{sig.code} {pos.direction}头换月开新{sig.volume}手 价格: {sig.price}')
+            # 查询数据库在数据库线程中执行, 分配请求号和发布请求留在事件循环中
+            param_dict = await self.__db.run(self.order_param, sig)
+            param_dict['RequestID'] = get_next_id()
             self.raw_redis.publish(self.__request_format.format(
                 'ReqOrderInsert'), json.dumps(param_dict))
         except Exception as e:
             logger.warning(f'ReqOrderInsert 发生错误: {repr(e)}', exc_info=True)
 
+    def order_param(self, sig: Signal) -> dict:
+        """
+        报单参数(不含 RequestID), 需要读写数据库, 在数据库线程中执行
+        """
+        autoid = Autonumber.objects.create()
+        order_ref = f"{autoid.id:07}{sig.id:05}"
+        param_dict = dict()
+        param_dict['OrderRef'] = order_ref
+        param_dict['InstrumentID'] = sig.code
+        param_dict['VolumeTotalOriginal'] = sig.volume
+        param_dict['LimitPrice'] = float(sig.price)
+        match sig.type:
+            case SignalType.BUY | SignalType.SELL_SHORT:
+                param_dict['Direction'] = ApiStruct.D_Buy if sig.type == SignalType.BUY else ApiStruct.D_Sell
+                param_dict['CombOffsetFlag'] = ApiStruct.OF_Open
+                logger.info(
+                    f'{sig.instrument} {sig.type}{sig.volume}手 价格: {sig.price}')
+            case SignalType.BUY_COVER | SignalType.SELL:
+                param_dict['Direction'] = ApiStruct.D_Buy if sig.type == SignalType.BUY_COVER else ApiStruct.D_Sell
+                param_dict['CombOffsetFlag'] = ApiStruct.OF_Close
+                pos = Trade.objects.filter(
+                    broker=self.__broker, strategy=self.__strategy, code=sig.code, shares=sig.volume, close_time__isnull=True,
+                    direction=DirectionType.values[DirectionType.SHORT] if sig.type == SignalType.BUY_COVER else DirectionType.values[
+                        DirectionType.LONG]).first()
+                if pos.open_time.astimezone().date() == timezone.localtime().date() and pos.instrument.exchange == ExchangeType.SHFE:
+                    # 上期所区分平今和平昨
+                    param_dict['CombOffsetFlag'] = ApiStruct.OF_CloseToday
+                logger.info(
+                    f'{sig.instrument} {sig.type}{sig.volume}手 价格: {sig.price}')
+            case SignalType.ROLL_CLOSE:
+                param_dict['CombOffsetFlag'] = ApiStruct.OF_Close
+                pos = Trade.objects.filter(broker=self.__broker, strategy=self.__strategy,
+                                           code=sig.code, shares=sig.volume, close_time__isnull=True).first()
+                param_dict['Direction'] = ApiStruct.D_Sell if pos.direction == DirectionType.values[DirectionType.LONG] else ApiStruct.D_Buy
+                if pos.open_time.astimezone().date() == timezone.localtime().date() and pos.instrument.exchange == ExchangeType.SHFE:
+                    # 上期所区分平今和平昨
+                    param_dict['CombOffsetFlag'] = ApiStruct.OF_CloseToday
+                logger.info(
+                    f'{sig.code}->{sig.instrument.main_code} {pos.direction}头换月平旧{sig.volume}手 价格: {sig.price}')
+            case SignalType.ROLL_OPEN:
+                param_dict['CombOffsetFlag'] = ApiStruct.OF_Open
+                pos = Trade.objects.filter(
+                    Q(close_time__isnull=True) | Q(
+                        close_time__date__gte=timezone.localtime().now().date()),
+                    broker=self.__broker, strategy=self.__strategy, code=sig.instrument.last_main, shares=sig.volume).first()
+                param_dict['Direction'] = ApiStruct.D_Buy if pos.direction == DirectionType.values[DirectionType.LONG] else ApiStruct.D_Sell
+                logger.info(
+                    f'{pos.code}->{sig.code} {pos.direction}头换月开新{sig.volume}手 价格: {sig.price}')
+        return param_dict
+
     async def cancel_order(self, order: dict):
-        sub_client = None
-        channel_rsp_odr_act, channel_rsp_err = None, None
         try:
-            sub_client = self.redis_client.pubsub(
-                ignore_subscribe_messages=True)
             request_id = get_next_id()
             order['RequestID'] = request_id
-            channel_rtn_odr = self.__trade_response_format.format(
-                'OnRtnOrder', order['OrderRef'])
-            channel_rsp_odr_act = self.__trade_response_format.format(
-                'OnRspOrderAction', 0)
-            channel_rsp_err = self.__trade_response_format.format(
-                'OnRspError', request_id)
-            await sub_client.psubscribe(channel_rtn_odr, channel_rsp_odr_act, channel_rsp_err)
-            task = asyncio.create_task(self.query_reader(sub_client))
-            self.raw_redis.publish(self.__request_format.format(
-                'ReqOrderAction'), json.dumps(order))
-            await asyncio.wait_for(task, HANDLER_TIME_OUT)
-            await sub_client.punsubscribe()
-            await sub_client.close()
-            result = task.result()[0]
+            result = await self.__rpc.call(
+                [self.__trade_response_format.format('OnRtnOrder', order['OrderRef']),
+                 self.__trade_response_format.format('OnRspOrderAction', 0),
+                 self.__trade_response_format.format('OnRspError', request_id)],
+                self.__request_format.format('ReqOrderAction'), json.dumps(order), HANDLER_TIME_OUT)
+            result = result[0]
             if 'ErrorID' in result:
                 logger.warning(f"撤销订单出错: {ctp_errors[result['ErrorID']]}")
                 return False
             return True
         except Exception as e:
             logger.warning('cancel_order 发生错误: %s', repr(e), exc_info=True)
-            if sub_client and sub_client.in_pubsub and channel_rsp_odr_act:
-                await sub_client.unsubscribe()
-                await sub_client.close()
             return False
 
-    @RegisterCallback(channel='MSG:CTP:RSP:MARKET:OnRtnDepthMarketData:*')
-    async def OnRtnDepthMarketData(self, channel, tick: dict):
+    def capture_tick(self, channel, tick: TickBar):
+        """
+        每笔行情到达时同步调用, 即使 OnRtnDepthMarketData 处理不过来被合并, 也不会漏掉行情
+        """
+        self.__tick_buffers.append(tick)
+        self.__bar_aggregator.update(tick)
+        if self.__tick_journal is not None:
+            self.__tick_journal.record(tick)
+
+    @RegisterCallback(channel='MSG:CTP:RSP:MARKET:OnRtnDepthMarketData:*', decoder=decode_tick, policy=LATEST,
+                      capture='capture_tick')
+    async def OnRtnDepthMarketData(self, channel, tick: TickBar):
         try:
-            inst = channel.split(':')[-1]
-            tick['UpdateTime'] = datetime.datetime.strptime(
-                tick['UpdateTime'], "%Y%m%d %H:%M:%S:%f")
-            logger.debug('inst=%s, tick: %s', inst, tick)
+            logger.debug('inst=%s, tick: %s', tick.instrument, tick)
         except Exception as ee:
             logger.warning('OnRtnDepthMarketData 发生错误: %s',
                            repr(ee), exc_info=True)
@@ -450,8 +455,15 @@ class TradeStrategy(BaseModule):
         return f"{trade['ExchangeID']}.{trade['InstrumentID']} {OffsetFlag.values[trade['OffsetFlag']]}{open_direct}已成交{trade['Volume']}手 " \
                f"价格:{trade['Price']} 时间:{trade['TradeTime']} 订单号: {trade['OrderRef']}"
 
-    @RegisterCallback(channel='MSG:CTP:RSP:TRADE:OnRtnTrade:*')
+    # 成交回报和委托回报共用一个队列, 按到达顺序逐条处理
+    @RegisterCallback(channel='MSG:CTP:RSP:TRADE:OnRtnTrade:*', serial='order')
     async def OnRtnTrade(self, channel, trade: dict):
+        await self.__db.run(self.save_trade, channel, trade)
+
+    def save_trade(self, channel, trade: dict):
+        """
+        根据成交回报更新持仓, 在数据库线程中执行
+        """
         try:
             signal = None
             new_trade = False
@@ -583,21 +595,21 @@ class TradeStrategy(BaseModule):
                 order_str += f"成交数量:{order['VolumeTraded']} 剩余数量:{order['VolumeTotal']}"
         return order_str
 
-    @RegisterCallback(channel='MSG:CTP:RSP:TRADE:OnRtnOrder:*')
+    @RegisterCallback(channel='MSG:CTP:RSP:TRADE:OnRtnOrder:*', serial='order')
     async def OnRtnOrder(self, _: str, order: dict):
         try:
             if order["OrderSysID"]:
                 logger.debug(f"订单回报: {self.get_order_string(order)}")
-            order_obj, _ = self.save_order(order)
+            order_obj, _ = await self.__db.run(self.save_order, order)
             if not order_obj:
                 return
             signal = order_obj.signal
-            inst = Instrument.objects.get(
-                product_code=self.__re_extract_code.match(order['InstrumentID']).group(1))
+            inst = await self.__db.get(
+                Instrument, product_code=self.__re_extract_code.match(order['InstrumentID']).group(1))
             # 处理由于委托价格超出交易所涨跌停板而被撤单的报单，将委托价格下调50%，重新报单
             if order['OrderStatus'] == OrderStatus.Canceled and order['OrderSubmitStatus'] == OrderSubmitStatus.InsertRejected:
-                last_bar = DailyBar.objects.filter(
-                    exchange=inst.exchange, code=order['InstrumentID']).order_by('-time').first()
+                last_bar = await self.__db.first(DailyBar.objects.filter(
+                    exchange=inst.exchange, code=order['InstrumentID']).order_by('-time'))
                 volume = int(order['VolumeTotalOriginal'])
                 price = Decimal(order['LimitPrice'])
                 if order['CombOffsetFlag'] == CombOffsetFlag.Open:
@@ -610,7 +622,7 @@ class TradeStrategy(BaseModule):
                             return
                         logger.info(f"{inst} 以价格 {price} 开多{volume}手 重新报单...")
                         signal.price = price
-                        self.io_loop.call_soon(self.ReqOrderInsert, signal)
+                        await self.ReqOrderInsert(signal)
                     else:
                         delta = (last_bar.settlement - price) * Decimal(0.5)
                         price = price_round(
@@ -620,7 +632,7 @@ class TradeStrategy(BaseModule):
                             return
                         logger.info(f"{inst} 以价格 {price} 开空{volume}手 重新报单...")
                         signal.price = price
-                        self.io_loop.call_soon(self.ReqOrderInsert, signal)
+                        await self.ReqOrderInsert(signal)
                 else:
                     if order['Direction'] == DirectionType.LONG:
                         delta = (price - last_bar.settlement) * Decimal(0.5)
@@ -631,7 +643,7 @@ class TradeStrategy(BaseModule):
                             return
                         logger.info(f"{inst} 以价格 {price} 买平{volume}手 重新报单...")
                         signal.price = price
-                        self.io_loop.call_soon(self.ReqOrderInsert, signal)
+                        await self.ReqOrderInsert(signal)
                     else:
                         delta = (last_bar.settlement - price) * Decimal(0.5)
                         price = price_round(
@@ -641,7 +653,7 @@ class TradeStrategy(BaseModule):
                             return
                         logger.info(f"{inst} 以价格 {price} 卖平{volume}手 重新报单...")
                         signal.price = price
-                        self.io_loop.call_soon(self.ReqOrderInsert, signal)
+                        await self.ReqOrderInsert(signal)
         except Exception as ee:
             logger.warning(f'OnRtnOrder 发生错误: {repr(ee)}', exc_info=True)
 
@@ -649,6 +661,16 @@ class TradeStrategy(BaseModule):
     async def heartbeat(self):
         self.raw_redis.set('HEARTBEAT:TRADER', 1, ex=301)
 
+    @RegisterCallback(crontab='*/1 * * * *')
+    async def flush_bars(self):
+        try:
+            self.__bar_aggregator.close_due(datetime.datetime.now())
+            count = await self.__db.run(store_intraday_bars, self.__bar_aggregator.drain())
+            if count:
+                logger.debug(f'保存日内K线{count}根')
+        except Exception as e:
+            logger.warning(f'flush_bars 发生错误: {repr(e)}', exc_info=True)
+
     @RegisterCallback(crontab='55 8 * * *')
     async def processing_signal1(self):
         await asyncio.sleep(5)
@@ -656,10 +678,11 @@ class TradeStrategy(BaseModule):
         _, trading = await is_trading_day(day)
         if trading:
             logger.debug('查询日盘信号..')
-            for sig in Signal.objects.filter(~Q(instrument__exchange=ExchangeType.CFFEX), trigger_time__gte=self.__last_trading_day, strategy=self.__strategy,
-                                             instrument__night_trade=False, processed=False).order_by('-priority'):
+            sig_list = await self.__db.all(Signal.objects.filter(~Q(instrument__exchange=ExchangeType.CFFEX), trigger_time__gte=self.__last_trading_day, strategy=self.__strategy,
+                                                                 instrument__night_trade=False, processed=False).select_related('instrument').order_by('-priority'))
+            for sig in sig_list:
                 logger.info(f'发现日盘信号: {sig}')
-                self.io_loop.call_soon(self.ReqOrderInsert, sig)
+                await self.ReqOrderInsert(sig)
             if (self.__trading_day - self.__last_trading_day).days > 3:
                 logger.info(f'假期后第一天，处理节前未成交夜盘信号.')
                 self.io_loop.call_soon(
@@ -671,10 +694,11 @@ class TradeStrategy(BaseModule):
         _, trading = await is_trading_day(day)
         if trading:
             logger.debug('查询遗漏的日盘信号..')
-            for sig in Signal.objects.filter(~Q(instrument__exchange=ExchangeType.CFFEX), trigger_time__gte=self.__last_trading_day, strategy=self.__strategy,
-                                             instrument__night_trade=False, processed=False).order_by('-priority'):
+            sig_list = await self.__db.all(Signal.objects.filter(~Q(instrument__exchange=ExchangeType.CFFEX), trigger_time__gte=self.__last_trading_day, strategy=self.__strategy,
+                                                                 instrument__night_trade=False, processed=False).select_related('instrument').order_by('-priority'))
+            for sig in sig_list:
                 logger.info(f'发现遗漏信号: {sig}')
-                self.io_loop.call_soon(self.ReqOrderInsert, sig)
+                await self.ReqOrderInsert(sig)
 
     @RegisterCallback(crontab='25 9 * * *')
     async def processing_signal2(self):
@@ -683,10 +707,11 @@ class TradeStrategy(BaseModule):
         _, trading = await is_trading_day(day)
         if trading:
             logger.debug('查询股指和国债信号..')
-            for sig in Signal.objects.filter(instrument__exchange=ExchangeType.CFFEX, trigger_time__gte=self.__last_trading_day, strategy=self.__strategy,
-                                             instrument__night_trade=False, processed=False).order_by('-priority'):
+            sig_list = await self.__db.all(Signal.objects.filter(instrument__exchange=ExchangeType.CFFEX, trigger_time__gte=self.__last_trading_day, strategy=self.__strategy,
+                                                                 instrument__night_trade=False, processed=False).select_related('instrument').order_by('-priority'))
+            for sig in sig_list:
                 logger.info(f'发现股指和国债信号: {sig}')
-                self.io_loop.call_soon(self.ReqOrderInsert, sig)
+                await self.ReqOrderInsert(sig)
 
     @RegisterCallback(crontab='31 9 * * *')
     async def check_signal2_processed(self):
@@ -694,10 +719,11 @@ class TradeStrategy(BaseModule):
         _, trading = await is_trading_day(day)
         if trading:
             logger.debug('查询遗漏的股指和国债信号..')
-            for sig in Signal.objects.filter(instrument__exchange=ExchangeType.CFFEX, trigger_time__gte=self.__last_trading_day, strategy=self.__strategy,
-                                             instrument__night_trade=False, processed=False).order_by('-priority'):
+            sig_list = await self.__db.all(Signal.objects.filter(instrument__exchange=ExchangeType.CFFEX, trigger_time__gte=self.__last_trading_day, strategy=self.__strategy,
+                                                                 instrument__night_trade=False, processed=False).select_related('instrument').order_by('-priority'))
+            for sig in sig_list:
                 logger.info(f'发现遗漏的股指和国债信号: {sig}')
-                self.io_loop.call_soon(self.ReqOrderInsert, sig)
+                await self.ReqOrderInsert(sig)
 
     @RegisterCallback(crontab='55 20 * * *')
     async def processing_signal3(self):
@@ -706,10 +732,11 @@ class TradeStrategy(BaseModule):
         _, trading = await is_trading_day(day)
         if trading:
             logger.debug('查询夜盘信号..')
-            for sig in Signal.objects.filter(
-                    trigger_time__gte=self.__last_trading_day, strategy=self.__strategy, instrument__night_trade=True, processed=False).order_by('-priority'):
+            sig_list = await self.__db.all(Signal.objects.filter(
+                    trigger_time__gte=self.__last_trading_day, strategy=self.__strategy, instrument__night_trade=True, processed=False).select_related('instrument').order_by('-priority'))
+            for sig in sig_list:
                 logger.info(f'发现夜盘信号: {sig}')
-                self.io_loop.call_soon(self.ReqOrderInsert, sig)
+                await self.ReqOrderInsert(sig)
 
     @RegisterCallback(crontab='1 21 * * *')
     async def check_signal3_processed(self):
@@ -717,10 +744,11 @@ class TradeStrategy(BaseModule):
         _, trading = await is_trading_day(day)
         if trading:
             logger.debug('查询遗漏的夜盘信号..')
-            for sig in Signal.objects.filter(
-                    trigger_time__gte=self.__last_trading_day, strategy=self.__strategy, instrument__night_trade=True, processed=False).order_by('-priority'):
+            sig_list = await self.__db.all(Signal.objects.filter(
+                    trigger_time__gte=self.__last_trading_day, strategy=self.__strategy, instrument__night_trade=True, processed=False).select_related('instrument').order_by('-priority'))
+            for sig in sig_list:
                 logger.info(f'发现遗漏的夜盘信号: {sig}')
-                self.io_loop.call_soon(self.ReqOrderInsert, sig)
+                await self.ReqOrderInsert(sig)
 
     @RegisterCallback(crontab='20 15 * * *')
     async def refresh_all(self):
@@ -738,8 +766,8 @@ class TradeStrategy(BaseModule):
     async def update_equity(self):
         today, trading = await is_trading_day(timezone.localtime())
         if trading:
-            dividend = Performance.objects.filter(
-                broker=self.__broker, day__lt=today.date()).aggregate(Sum('dividend'))['dividend__sum']
+            dividend = (await self.__db.run(Performance.objects.filter(
+                broker=self.__broker, day__lt=today.date()).aggregate, Sum('dividend')))['dividend__sum']
             if dividend is None:
                 dividend = Decimal(0)
             dividend = dividend + self.__deposit - self.__withdraw
@@ -748,11 +776,11 @@ class TradeStrategy(BaseModule):
             if self.__fake < 1:
                 self.__fake = 0
             self.__broker.fake = self.__fake
-            self.__broker.save(update_fields=['fake'])
+            await self.__db.save(self.__broker, update_fields=['fake'])
             unit = dividend + self.__fake
             nav = (self.__current + self.__fake) / unit  # 单位净值
             accumulated = self.__current / (unit - self.__fake)  # 累计净值
-            Performance.objects.update_or_create(broker=self.__broker, day=today.date(), defaults={
+            await self.__db.update_or_create(Performance, broker=self.__broker, day=today.date(), defaults={
                 'used_margin': self.__margin, 'dividend': self.__deposit - self.__withdraw, 'fake': self.__fake, 'capital': self.__current, 'unit_count': unit,
                 'NAV': nav, 'accumulated': accumulated})
             logger.info(f"动态权益: {self.__current:,.0f}({self.__current/10000:.1f}万) "
@@ -776,7 +804,7 @@ class TradeStrategy(BaseModule):
                          update_from_cffex, update_from_gfex, get_contracts_argument]
             result = await asyncio.gather(*[func(day) for func in tasks], return_exceptions=True)
             if all(result):
-                self.io_loop.call_soon(self.calculate, day)
+                await self.calculate(day)
             else:
                 failed_tasks = [tasks[i]
                                 for i, rst in enumerate(result) if not rst]
@@ -786,50 +814,59 @@ class TradeStrategy(BaseModule):
             logger.warning(f'collect_quote 发生错误: {repr(e)}', exc_info=True)
         logger.debug('盘后计算完毕!')
 
-    def calculate(self, day, create_main_bar=True):
+    async def calculate(self, day, create_main_bar=True):
         try:
+            # 持仓和账户随时在事件循环中刷新, 先取快照再交给数据库线程
             p_code_set = set(self.__inst_ids)
             for code in self.__cur_pos.keys():
                 p_code_set.add(self.__re_extract_code.match(code).group(1))
-            all_margin = 0
-            for inst in Instrument.objects.all().order_by('section', 'exchange', 'name'):
-                if create_main_bar:
-                    logger.debug(f'生成连续合约: {inst.name}')
-                    calc_main_inst(inst, day)
-                if inst.product_code in p_code_set:
-                    logger.debug(f'计算交易信号: {inst.name}')
-                    sig, margin = self.calc_signal(inst, day)
-                    all_margin += margin
-            if (all_margin + self.__margin) / self.__current > 0.8:
-                logger.info(f"！！！风险提示！！！开仓保证金共计: {all_margin:.0f}({all_margin/10000:.1f}万) "
-                            f"账户风险度将达到: {100 * (all_margin + self.__margin) / self.__current:.0f}% 建议追加保证金或减少开仓手数！")
+            await self.__db.run(self.calc_all_signals, day, p_code_set, self.__margin, self.__current, create_main_bar)
         except Exception as e:
             logger.warning(f'calculate 发生错误: {repr(e)}', exc_info=True)
 
-    def calc_signal(self, inst: Instrument, day: datetime.datetime) -> Tuple[Signal, Decimal]:
+    def calc_all_signals(self, day, p_code_set: set, cur_margin, current, create_main_bar=True):
+        """
+        生成连续合约并计算全部品种的交易信号, 在数据库线程中执行, 不访问策略的持仓和账户状态
+        """
+        all_margin = 0
+        inst_list = list(Instrument.objects.all().order_by('section', 'exchange', 'name'))
+        if create_main_bar:
+            for inst in inst_list:
+                logger.debug(f'生成连续合约: {inst.name}')
+                calc_main_inst(inst, day, save=False)
+            Instrument.objects.bulk_update(inst_list, ['last_main', 'main_code', 'change_time'])
+        inst_list = [inst for inst in inst_list if inst.product_code in p_code_set]
+        # 一次读取全部品种的K线, 所有品种的指标一起计算
+        param = self.__strategy.get_param()
+        panel = load_main_bars([inst.product_code for inst in inst_list], day)
+        # 几十个品种的矩阵运算很快, 直接在数据库线程中计算, 交给进程池反而要付出序列化的开销
+        panel = calc_panel_indicators(panel, param.break_n, param.atr_n, param.long_n, param.short_n)
+        frames = panel_to_frames(panel)
+        for inst in inst_list:
+            logger.debug(f'计算交易信号: {inst.name}')
+            sig, margin = self.calc_signal(inst, day, frames.get(inst.product_code), param)
+            all_margin += margin
+        if (all_margin + cur_margin) / current > 0.8:
+            logger.info(f"！！！风险提示！！！开仓保证金共计: {all_margin:.0f}({all_margin/10000:.1f}万) "
+                        f"账户风险度将达到: {100 * (all_margin + cur_margin) / current:.0f}% 建议追加保证金或减少开仓手数！")
+        correlation_service.update(
+            day, self.__strategy.instruments.order_by('id').values_list('product_code', flat=True))
+
+    def calc_signal(self, inst: Instrument, day: datetime.datetime, df: pd.DataFrame = None,
+                    param: StrategyParam = None) -> Tuple[Signal, Decimal]:
+        """
+        :param df: 已经算好指标的K线, 为None时单独读取该品种的K线计算
+        :param param: 策略参数快照, 为None时读取最新参数
+        """
         try:
-            break_n = self.__strategy.param_set.get(
-                code='BreakPeriod').int_value
-            atr_n = self.__strategy.param_set.get(code='AtrPeriod').int_value
-            long_n = self.__strategy.param_set.get(code='LongPeriod').int_value
-            short_n = self.__strategy.param_set.get(
-                code='ShortPeriod').int_value
-            stop_n = self.__strategy.param_set.get(code='StopLoss').int_value
-            risk = self.__strategy.param_set.get(code='Risk').float_value
-            # 只读取最近400条记录，减少运算量
-            df = to_df(MainBar.objects.filter(time__lte=day.date(), exchange=inst.exchange, product_code=inst.product_code).order_by('-time').values_list(
-                'time', 'open', 'high', 'low', 'close')[:400], index_col='time', parse_dates=['time'])
-            df = df.iloc[::-1]  # 日期升序排列
-            df["atr"] = ATR(df.high, df.low, df.close, timeperiod=atr_n)
-            df["short_trend"] = df.close
-            df["long_trend"] = df.close
-            for idx in range(1, df.shape[0]):  # 手动计算SMA
-                df.short_trend[idx] = (
-                    df.short_trend[idx-1] * (short_n - 1) + df.close[idx]) / short_n
-                df.long_trend[idx] = (
-                    df.long_trend[idx-1] * (long_n - 1) + df.close[idx]) / long_n
-            df["high_line"] = df.close.rolling(window=break_n).max()
-            df["low_line"] = df.close.rolling(window=break_n).min()
+            if param is None:
+                param = self.__strategy.get_param()
+            stop_n = param.stop_n
+            risk = param.risk
+            if df is None:
+                # 只读取最近400条记录，减少运算量
+                df = load_main_frame(inst.product_code, day, 400)[['open', 'high', 'low', 'close']]
+                calc_indicators(df, param.break_n, param.atr_n, param.long_n, param.short_n)
             idx = -1
             buy_sig = df.short_trend[idx] > df.long_trend[idx] and price_round(
                 df.close[idx], inst.price_tick) >= price_round(df.high_line[idx - 1], inst.price_tick)
@@ -15,42 +15,57 @@
 # under the License.
 import logging
 import ujson as json
+from dataclasses import asdict
 from decimal import Decimal
 import datetime
 import math
+import itertools
 import re
 import xml.etree.ElementTree as ET
 import asyncio
 import os
-from functools import reduce
-from itertools import combinations
-from typing import Tuple
+from functools import reduce, partial
+from itertools import groupby
+from operator import attrgetter
+from typing import Tuple, NamedTuple, Iterable, Iterator, List
 
+import numpy as np
 import pytz
-import aiohttp
 from django.db.models import Q, F, Max, Min
+from django.db import connection
 from django.utils import timezone
-import redis
-from talib import ATR
 from tqdm import tqdm
 
 from panel.models import *
 from trader.utils import ApiStruct
+from trader.utils.backtest import run_backtest, ENTRY, STOP, MARK
+from trader.utils.bars import bar_store, Bars
+from trader.utils.correlation import correlation_service
+from trader.utils.http_pool import HttpPool, HttpResult
+from trader.utils.indicator import calc_indicators
+from trader.utils.selection import select_basket
+from trader.utils.stream_parse import LineRowParser, XmlRowParser, parse_all, iter_rows
+from trader.utils.sweep import BAR_FIELDS, param_grid, run_sweep
+from trader.utils.trading_calendar import TradingCalendar
 from trader.utils.read_config import config
+from trader.utils.redis_pool import redis_manager
+from trader.utils.response_cache import ResponseCache
 
 logger = logging.getLogger('utils')
 
-max_conn_shfe = asyncio.Semaphore(15)
-max_conn_dce = asyncio.Semaphore(5)
-max_conn_gfex = asyncio.Semaphore(5)
-max_conn_czce = asyncio.Semaphore(15)
-max_conn_cffex = asyncio.Semaphore(15)
-max_conn_sina = asyncio.Semaphore(15)
 cffex_ip = 'www.cffex.com.cn'    # www.cffex.com.cn
 shfe_ip = 'www.shfe.com.cn'      # www.shfe.com.cn
 czce_ip = 'www.czce.com.cn'     # www.czce.com.cn
 dce_ip = 'www.dce.com.cn'        # www.dce.com.cn
 gfex_ip = 'www.gfex.com.cn'
+# 各交易所网站共用的长连接池, limit 为同时连接数上限
+shfe_pool = HttpPool(shfe_ip, limit=15)
+dce_pool = HttpPool(dce_ip, limit=5)
+gfex_pool = HttpPool(gfex_ip, limit=5)
+czce_pool = HttpPool(czce_ip, limit=15)
+cffex_pool = HttpPool(cffex_ip, limit=15)
+# 交易所日线原始数据的本地缓存, 修正解析错误后可以用 reingest_from_cache 重新入库而不必重新下载
+response_cache = ResponseCache()
 IGNORE_INST_LIST = config.get('TRADE', 'ignore_inst').split(',')
 INE_INST_LIST = ['sc', 'bc', 'nr', 'lu']
 ORDER_REF_SIGNAL_ID_START = -5
@@ -85,29 +100,42 @@ def price_round(x: Decimal, base: Decimal):
     return round(base * round(x / base), precision)
 
 
+_request_ids = itertools.count()
+
+
 def get_next_id():
-    if not hasattr(get_next_id, "request_id"):
-        get_next_id.request_id = 0
-    get_next_id.request_id = 1 if get_next_id.request_id == 65535 else get_next_id.request_id + 1
-    return get_next_id.request_id
+    # next() 在 CPython 中是原子操作, 多个线程同时调用也不会得到相同的请求号, 1~65535 循环
+    return next(_request_ids) % 65535 + 1
+
+
+async def close_http_pools():
+    """
+    关闭各交易所的长连接池, 在脚本或进程退出前调用
+    """
+    for pool in (shfe_pool, dce_pool, gfex_pool, czce_pool, cffex_pool):
+        await pool.close()
 
 
 async def is_trading_day(day: datetime.datetime):
-    s = redis.StrictRedis(
-        host=config.get('REDIS', 'host', fallback='localhost'),
-        db=config.getint('REDIS', 'db', fallback=0), decode_responses=True)
-    return day, day.strftime('%Y%m%d') in (s.get('TradingDay'), s.get('LastTradingDay'))
+    s = redis_manager.client
+    return day, day.strftime('%Y%m%d') in s.mget('TradingDay', 'LastTradingDay')
 
 
 async def check_trading_day(day: datetime.datetime) -> Tuple[datetime.datetime, bool]:
-    async with aiohttp.ClientSession() as session:
-        await max_conn_cffex.acquire()
-        async with session.get(
-                'http://{}/fzjy/mrhq/{}/index.xml'.format(
-                    cffex_ip, day.strftime('%Y%m/%d')),
-                allow_redirects=False) as response:
-            max_conn_cffex.release()
-            return day, response.status == 200
+    """
+    中金所当天有行情文件即为交易日。只有 200 和 404(或跳转到错误页)是确定的结果,
+    限流、服务器错误等抛出异常, 以免被交易日历当成非交易日永久保存
+    """
+    response = await cffex_pool.get(f"/fzjy/mrhq/{day.strftime('%Y%m/%d')}/index.xml", allow_redirects=False)
+    if response.status == 200:
+        return day, True
+    if response.status in (301, 302, 404):
+        return day, False
+    raise ValueError(f'check_trading_day {day:%Y%m%d}: HTTP {response.status}')
+
+
+# 本地交易日历, 按年向中金所确认交易日, 见 TradingCalendar
+trading_calendar = TradingCalendar(probe=check_trading_day, concurrency=cffex_pool.limit)
 
 
 def get_expire_date(inst_code: str, day: datetime.datetime):
@@ -120,343 +148,654 @@ def get_expire_date(inst_code: str, day: datetime.datetime):
     return expire_date
 
 
+class BarRow(NamedTuple):
+    """
+    交易所日线数据解析后的一行, 字段与 DailyBar 一致
+    """
+    exchange: str
+    code: str
+    time: datetime.date
+    expire_date: int
+    open: Decimal
+    high: Decimal
+    low: Decimal
+    close: Decimal
+    settlement: Decimal
+    volume: int
+    open_interest: Decimal
+
+
+def to_decimal(value) -> Decimal:
+    if isinstance(value, str):
+        value = value.replace(',', '').strip()
+    return Decimal(str(value))
+
+
+def to_int(value) -> int:
+    return int(to_decimal(value))
+
+
+def bulk_upsert(model, objs: list, unique_fields: list, update_fields: list, batch_size: int = 1000):
+    """
+    批量插入, 唯一键冲突时更新 (MySQL: INSERT ... ON DUPLICATE KEY UPDATE)
+    """
+    kwargs = {'update_conflicts': True, 'update_fields': update_fields, 'batch_size': batch_size}
+    if connection.features.supports_update_conflicts_with_target:
+        kwargs['unique_fields'] = unique_fields
+    return model.objects.bulk_create(objs, **kwargs)
+
+
+def store_daily_bars(rows: Iterable[BarRow]) -> int:
+    """
+    日线入库: 按 (exchange, code, time) 去重后一次批量写入, 已存在的记录直接覆盖
+    :return: 写入的记录数
+    """
+    bar_dict = {(row.exchange, row.code, row.time): row for row in rows}
+    if bar_dict:
+        bulk_upsert(DailyBar, [DailyBar(**row._asdict()) for row in bar_dict.values()],
+                    ['exchange', 'code', 'time'], list(BarRow._fields[3:]))
+    return len(bar_dict)
+
+
+def store_intraday_bars(bars: list) -> int:
+    """
+    合成的日内K线批量入库, 同一根K线重复写入时覆盖
+    :param bars: BarAggregator.drain() 取出的K线
+    :return: 写入的记录数
+    """
+    if bars:
+        bulk_upsert(IntradayBar, [IntradayBar(
+            code=bar.instrument, period=bar.period, trading_day=bar.trading_day,
+            time=timezone.make_aware(bar.time), open=to_decimal(bar.open), high=to_decimal(bar.high),
+            low=to_decimal(bar.low), close=to_decimal(bar.close), volume=bar.volume,
+            open_interest=to_decimal(bar.open_interest)) for bar in bars], ['code', 'period', 'time'],
+            ['trading_day', 'open', 'high', 'low', 'close', 'volume', 'open_interest'])
+    return len(bars)
+
+
+def parse_shfe(rst_json: dict, day: datetime.datetime) -> Iterator[BarRow]:
+    for inst_data in rst_json['o_curinstrument']:
+        """
+{"PRODUCTID":"cu_f    ","PRODUCTGROUPID":"cu      ","PRODUCTSORTNO":10,"PRODUCTNAME":"铜                  ",
+"DELIVERYMONTH":"2112","PRESETTLEMENTPRICE":69850,"OPENPRICE":69770,"HIGHESTPRICE":70280,"LOWESTPRICE":69600,
+"CLOSEPRICE":69900,"SETTLEMENTPRICE":69950,"ZD1_CHG":50,"ZD2_CHG":100,"VOLUME":19450,"TURNOVER":680294.525,
+"TASVOLUME":"","OPENINTEREST":19065,"OPENINTERESTCHG":-5585,"ORDERNO":0,"ORDERNO2":0}
+        """
+        if inst_data['DELIVERYMONTH'] == '小计' or inst_data['PRODUCTID'] == '总计':
+            continue
+        if '_f' not in inst_data['PRODUCTID']:
+            continue
+        code = inst_data['PRODUCTGROUPID'].strip()
+        if code in IGNORE_INST_LIST:
+            continue
+        # 上期能源的四个品种
+        exchange_str = ExchangeType.INE if code in INE_INST_LIST else ExchangeType.SHFE
+        close = inst_data['CLOSEPRICE']
+        yield BarRow(
+            exchange_str, code + inst_data['DELIVERYMONTH'], day.date(), to_int(inst_data['DELIVERYMONTH']),
+            to_decimal(inst_data['OPENPRICE'] if inst_data['OPENPRICE'] else close),
+            to_decimal(inst_data['HIGHESTPRICE'] if inst_data['HIGHESTPRICE'] else close),
+            to_decimal(inst_data['LOWESTPRICE'] if inst_data['LOWESTPRICE'] else close),
+            to_decimal(close),
+            to_decimal(inst_data['SETTLEMENTPRICE'] if inst_data['SETTLEMENTPRICE'] else
+                       inst_data['PRESETTLEMENTPRICE']),
+            to_int(inst_data['VOLUME'] if inst_data['VOLUME'] else 0),
+            to_decimal(inst_data['OPENINTEREST'] if inst_data['OPENINTEREST'] else 0))
+
+
+async def fetch_shfe(day: datetime.datetime, revalidate: bool = None) -> HttpResult:
+    return await response_cache.fetch(shfe_pool, 'shfe', day, 'daily', 'GET',
+                                      f"/data/tradedata/future/dailydata/kx{day.strftime('%Y%m%d')}.dat", revalidate)
+
+
+def ingest_shfe(response: HttpResult, day: datetime.datetime) -> int:
+    rst_json = response.json()
+    count = store_daily_bars(parse_shfe(rst_json, day))
+    # 更新上期所合约中文名称
+    inst_name_dict = {}
+    for inst_data in rst_json['o_curinstrument']:
+        code = inst_data['PRODUCTGROUPID'].strip()
+        if inst_data['DELIVERYMONTH'] == '小计' or '_f' not in inst_data['PRODUCTID'] or \
+                code in IGNORE_INST_LIST:
+            continue
+        if code not in inst_name_dict:
+            inst_name_dict[code] = inst_data['PRODUCTNAME'].strip()
+    for code, name in inst_name_dict.items():
+        Instrument.objects.filter(
+            product_code=code).update(name=name)
+    return count
+
+
 async def update_from_shfe(day: datetime.datetime) -> bool:
     try:
-        async with aiohttp.ClientSession() as session:
-            day_str = day.strftime('%Y%m%d')
-            await max_conn_shfe.acquire()
-            async with session.get(f'http://{shfe_ip}/data/tradedata/future/dailydata/kx{day_str}.dat') as response:
-                rst = await response.read()
-                rst_json = json.loads(rst)
-                max_conn_shfe.release()
-                inst_name_dict = {}
-                for inst_data in rst_json['o_curinstrument']:
-                    """
-        {"PRODUCTID":"cu_f    ","PRODUCTGROUPID":"cu      ","PRODUCTSORTNO":10,"PRODUCTNAME":"铜                  ",
-        "DELIVERYMONTH":"2112","PRESETTLEMENTPRICE":69850,"OPENPRICE":69770,"HIGHESTPRICE":70280,"LOWESTPRICE":69600,
-        "CLOSEPRICE":69900,"SETTLEMENTPRICE":69950,"ZD1_CHG":50,"ZD2_CHG":100,"VOLUME":19450,"TURNOVER":680294.525,
-        "TASVOLUME":"","OPENINTEREST":19065,"OPENINTERESTCHG":-5585,"ORDERNO":0,"ORDERNO2":0}
-                    """
-                    # error_data = inst_data
-                    if inst_data['DELIVERYMONTH'] == '小计' or inst_data['PRODUCTID'] == '总计':
-                        continue
-                    if '_f' not in inst_data['PRODUCTID']:
-                        continue
-                    # logger.info(f'inst_data: {inst_data}')
-                    code = inst_data['PRODUCTGROUPID'].strip()
-                    if code in IGNORE_INST_LIST:
-                        continue
-                    name = inst_data['PRODUCTNAME'].strip()
-                    if code not in inst_name_dict:
-                        inst_name_dict[code] = name
-                    exchange_str = ExchangeType.SHFE
-                    # 上期能源的四个品种
-                    if code in INE_INST_LIST:
-                        exchange_str = ExchangeType.INE
-                    DailyBar.objects.update_or_create(
-                        code=code + inst_data['DELIVERYMONTH'],
-                        exchange=exchange_str, time=day, defaults={
-                            'expire_date': inst_data['DELIVERYMONTH'],
-                            'open': inst_data['OPENPRICE'] if inst_data['OPENPRICE'] else inst_data['CLOSEPRICE'],
-                            'high': inst_data['HIGHESTPRICE'] if inst_data['HIGHESTPRICE'] else
-                            inst_data['CLOSEPRICE'],
-                            'low': inst_data['LOWESTPRICE'] if inst_data['LOWESTPRICE']
-                            else inst_data['CLOSEPRICE'],
-                            'close': inst_data['CLOSEPRICE'],
-                            'settlement': inst_data['SETTLEMENTPRICE'] if inst_data['SETTLEMENTPRICE'] else
-                            inst_data['PRESETTLEMENTPRICE'],
-                            'volume': inst_data['VOLUME'] if inst_data['VOLUME'] else 0,
-                            'open_interest': inst_data['OPENINTEREST'] if inst_data['OPENINTEREST'] else 0})
-                # 更新上期所合约中文名称
-                for code, name in inst_name_dict.items():
-                    Instrument.objects.filter(
-                        product_code=code).update(name=name)
-        return True
+        response = await fetch_shfe(day)
     except Exception as e:
         logger.warning(f'update_from_shfe failed: {repr(e)}', exc_info=True)
         return False
+    return ingest_cached('shfe', 'daily', ingest_shfe, response, day)
+
+
+def parse_czce_line(lines: str, day: datetime.datetime) -> BarRow:
+    if '小计' in lines or '合约' in lines or '品种' in lines:
+        return None
+    inst_data = [x.strip() for x in lines.split('|' if '|' in lines else ',')]
+    """
+[0'合约代码', 1'昨结算', 2'今开盘', 3'最高价', 4'最低价', 5'今收盘', 6'今结算', 7'涨跌1', 8'涨跌2', 9'成交量(手)', 
+ 10'持仓量', 11'增减量', 12'成交额(万元)', 13'交割结算价']
+['CF601', '11,970.00', '11,970.00', '11,970.00', '11,800.00', '11,870.00', '11,905.00', '-100.00',
+ '-65.00', '13,826', '59,140', '-10,760', '82,305.24', '']
+    """
+    if re.findall('[A-Za-z]+', inst_data[0])[0] in IGNORE_INST_LIST:
+        return None
+    pre_settlement, open_price, high, low, close, settlement = [to_decimal(x) for x in inst_data[1:7]]
+    close = close if close > 0.1 else settlement
+    return BarRow(
+        ExchangeType.CZCE, inst_data[0], day.date(), get_expire_date(inst_data[0], day),
+        open_price if open_price > 0.1 else close,
+        high if high > 0.1 else close,
+        low if low > 0.1 else close,
+        close,
+        settlement if settlement > 0.1 else pre_settlement,
+        to_int(inst_data[9]), to_decimal(inst_data[10]))
+
+
+def czce_parser(day: datetime.datetime, encoding: str = None) -> LineRowParser:
+    # 第一行是标题, 最后三行是合计和空行
+    return LineRowParser(partial(parse_czce_line, day=day), '\n', head=1, tail=3, encoding=encoding)
+
+
+def parse_czce(rst, day: datetime.datetime, encoding: str = None) -> List[BarRow]:
+    """
+    :param rst: 完整的文件内容, 文本或字节
+    """
+    return parse_all(czce_parser(day, encoding), rst)
+
+
+def czce_daily_path(day: datetime.datetime) -> str:
+    return f"/cn/DFSStaticFiles/Future/{day.year}/{day.strftime('%Y%m%d')}/FutureDataDaily.txt"
+
+
+async def fetch_czce(day: datetime.datetime, revalidate: bool = None) -> HttpResult:
+    return await response_cache.fetch(czce_pool, 'czce', day, 'daily', 'GET', czce_daily_path(day), revalidate)
+
+
+def ingest_czce(response: HttpResult, day: datetime.datetime) -> int:
+    return store_daily_bars(parse_czce(response.body, day, response.encoding))
 
 
 async def update_from_czce(day: datetime.datetime) -> bool:
-    try:
-        async with aiohttp.ClientSession() as session:
-            day_str = day.strftime('%Y%m%d')
-            async with session.get(
-                    f'http://{czce_ip}/cn/DFSStaticFiles/Future/{day.year}/{day_str}/FutureDataDaily.txt') as response:
-                rst = await response.text()
-                for lines in rst.split('\n')[1:-3]:
-                    if '小计' in lines or '合约' in lines or '品种' in lines:
-                        continue
-                    inst_data = [x.strip() for x in lines.split(
-                        '|' if '|' in lines else ',')]
-                    """
-        [0'合约代码', 1'昨结算', 2'今开盘', 3'最高价', 4'最低价', 5'今收盘', 6'今结算', 7'涨跌1', 8'涨跌2', 9'成交量(手)', 
-         10'持仓量', 11'增减量', 12'成交额(万元)', 13'交割结算价']
-        ['CF601', '11,970.00', '11,970.00', '11,970.00', '11,800.00', '11,870.00', '11,905.00', '-100.00',
-         '-65.00', '13,826', '59,140', '-10,760', '82,305.24', '']
-                    """
-                    # print(f'inst_data: {inst_data}')
-                    if re.findall('[A-Za-z]+', inst_data[0])[0] in IGNORE_INST_LIST:
-                        continue
-                    close = inst_data[5].replace(',', '') if Decimal(inst_data[5].replace(',', '')) > 0.1 \
-                        else inst_data[6].replace(',', '')
-                    DailyBar.objects.update_or_create(
-                        code=inst_data[0],
-                        exchange=ExchangeType.CZCE, time=day, defaults={
-                            'expire_date': get_expire_date(inst_data[0], day),
-                            'open': inst_data[2].replace(',', '') if Decimal(inst_data[2].replace(',', '')) > 0.1
-                            else close,
-                            'high': inst_data[3].replace(',', '') if Decimal(inst_data[3].replace(',', '')) > 0.1
-                            else close,
-                            'low': inst_data[4].replace(',', '') if Decimal(inst_data[4].replace(',', '')) > 0.1
-                            else close,
-                            'close': close,
-                            'settlement': inst_data[6].replace(',', '') if
-                            Decimal(inst_data[6].replace(',', '')) > 0.1 else inst_data[1].replace(',', ''),
-                            'volume': inst_data[9].replace(',', ''),
-                            'open_interest': inst_data[10].replace(',', '')})
-                return True
-    except Exception as e:
-        logger.warning(f'update_from_czce failed: {repr(e)}', exc_info=True)
-        return False
+    return await stream_ingest('czce', czce_pool, day, czce_parser, 'GET', czce_daily_path(day))
+
+
+def parse_dce_line(lines: str, day: datetime.datetime) -> BarRow:
+    if '小计' in lines or '品种' in lines:
+        return None
+    inst_data = [x.strip() for x in lines.split('\t') if len(x.strip()) > 0]
+    """
+[0'商品名称', 1'交割月份', 2'开盘价', 3'最高价', 4'最低价', 5'收盘价', 6'前结算价', 7'结算价', 8'涨跌', 9'涨跌1', 10'成交量', 
+ 11'持仓量', 12'持仓量变化', 13'成交额']
+['豆一', '1611', '3,760', '3,760', '3,760', '3,760', '3,860', '3,760', '-100', '-100', '2', '0', '0', '7.52']
+    """
+    if '小计' in inst_data[0]:
+        return None
+    if DCE_NAME_CODE[inst_data[0]] in IGNORE_INST_LIST:
+        return None
+    expire_date = inst_data[1].removeprefix(DCE_NAME_CODE[inst_data[0]])
+    close = to_decimal(inst_data[5])
+    return BarRow(
+        ExchangeType.DCE, inst_data[1], day.date(), to_int(expire_date),
+        to_decimal(inst_data[2]) if inst_data[2] != '-' else close,
+        to_decimal(inst_data[3]) if inst_data[3] != '-' else close,
+        to_decimal(inst_data[4]) if inst_data[4] != '-' else close,
+        close,
+        to_decimal(inst_data[7] if inst_data[7] != '-' else inst_data[6]),
+        to_int(inst_data[10]), to_decimal(inst_data[11]))
+
+
+def dce_parser(day: datetime.datetime, encoding: str = None) -> LineRowParser:
+    # 前三行是标题, 最后三行是总计和空行
+    return LineRowParser(partial(parse_dce_line, day=day), '\r\n', head=3, tail=3, encoding=encoding)
+
+
+def parse_dce(rst, day: datetime.datetime, encoding: str = None) -> List[BarRow]:
+    return parse_all(dce_parser(day, encoding), rst)
+
+
+def dce_form(day: datetime.datetime) -> dict:
+    return {'dayQuotes.variety': 'all', 'dayQuotes.trade_type': 0, 'exportFlag': 'txt',
+            'year': day.year, 'month': day.month-1, 'day': day.day}
+
+
+async def fetch_dce(day: datetime.datetime, revalidate: bool = None) -> HttpResult:
+    return await response_cache.fetch(dce_pool, 'dce', day, 'daily', 'POST',
+                                      '/publicweb/quotesdata/exportDayQuotesChData.html', revalidate, data=dce_form(day))
+
+
+def ingest_dce(response: HttpResult, day: datetime.datetime) -> int:
+    return store_daily_bars(parse_dce(response.body, day, response.encoding))
 
 
 async def update_from_dce(day: datetime.datetime) -> bool:
-    try:
-        async with aiohttp.ClientSession() as session:
-            await max_conn_dce.acquire()
-            async with session.post(f'http://{dce_ip}/publicweb/quotesdata/exportDayQuotesChData.html', data={
-                    'dayQuotes.variety': 'all', 'dayQuotes.trade_type': 0, 'exportFlag': 'txt',
-                    'year': day.year, 'month': day.month-1, 'day': day.day}) as response:
-                rst = await response.text()
-                max_conn_dce.release()
-                for lines in rst.split('\r\n')[3:-3]:
-                    if '小计' in lines or '品种' in lines:
-                        continue
-                    inst_data_raw = [x.strip() for x in lines.split('\t')]
-                    inst_data = []
-                    for cell in inst_data_raw:
-                        if len(cell) > 0:
-                            inst_data.append(cell)
-                    """
-    [0'商品名称', 1'交割月份', 2'开盘价', 3'最高价', 4'最低价', 5'收盘价', 6'前结算价', 7'结算价', 8'涨跌', 9'涨跌1', 10'成交量', 
-     11'持仓量', 12'持仓量变化', 13'成交额']
-    ['豆一', '1611', '3,760', '3,760', '3,760', '3,760', '3,860', '3,760', '-100', '-100', '2', '0', '0', '7.52']
-                    """
-                    if '小计' in inst_data[0]:
-                        continue
-                    if DCE_NAME_CODE[inst_data[0]] in IGNORE_INST_LIST:
-                        continue
-                    expire_date = inst_data[1].removeprefix(
-                        DCE_NAME_CODE[inst_data[0]])
-                    DailyBar.objects.update_or_create(
-                        code=inst_data[1],
-                        exchange=ExchangeType.DCE, time=day, defaults={
-                            'expire_date': expire_date,
-                            'open': inst_data[2].replace(',', '') if inst_data[2] != '-' else
-                            inst_data[5].replace(',', ''),
-                            'high': inst_data[3].replace(',', '') if inst_data[3] != '-' else
-                            inst_data[5].replace(',', ''),
-                            'low': inst_data[4].replace(',', '') if inst_data[4] != '-' else
-                            inst_data[5].replace(',', ''),
-                            'close': inst_data[5].replace(',', ''),
-                            'settlement': inst_data[7].replace(',', '') if inst_data[7] != '-' else
-                            inst_data[6].replace(',', ''),
-                            'volume': inst_data[10].replace(',', ''),
-                            'open_interest': inst_data[11].replace(',', '')})
-                return True
-    except Exception as e:
-        logger.warning(f'update_from_dce failed: {repr(e)}', exc_info=True)
-        return False
+    return await stream_ingest('dce', dce_pool, day, dce_parser, 'POST',
+                               '/publicweb/quotesdata/exportDayQuotesChData.html', data=dce_form(day))
+
+
+def parse_gfex(rst_json: dict, variety: str, day: datetime.datetime) -> Iterator[BarRow]:
+    for inst_code, inst_data in rst_json['contractQuote'].items():
+        close = to_decimal(inst_data['closePrice'])
+        yield BarRow(
+            ExchangeType.GFEX, inst_code, day.date(), to_int(inst_code.removeprefix(variety)),
+            to_decimal(inst_data['openPrice']) if inst_data['openPrice'] != "--" else close,
+            to_decimal(inst_data['highPrice']) if inst_data['highPrice'] != "--" else close,
+            to_decimal(inst_data['lowPrice']) if inst_data['lowPrice'] != "--" else close,
+            close,
+            to_decimal(inst_data['clearPrice']),
+            to_int(inst_data['matchTotQty']) if inst_data['matchTotQty'] != "--" else 0,
+            to_decimal(inst_data['openInterest']) if inst_data['openInterest'] != "--" else Decimal(0))
+
+
+GFEX_VARIETIES = ('lc', 'si')
+
+
+async def fetch_gfex(day: datetime.datetime, variety: str, revalidate: bool = None) -> HttpResult:
+    # 广期所的接口只返回最新行情, 缓存按取数当天保存
+    return await response_cache.fetch(gfex_pool, 'gfex', day, variety, 'POST', '/gfexweb/Quote/getQuote_ftr',
+                                      revalidate, data={'varietyid': variety})
+
+
+def ingest_gfex(response: HttpResult, day: datetime.datetime, variety: str) -> int:
+    return store_daily_bars(parse_gfex(response.json(), variety, day))
 
 
 async def update_from_gfex(day: datetime.datetime) -> bool:
+    result = True
+    for variety in GFEX_VARIETIES:
+        try:
+            response = await fetch_gfex(day, variety)
+        except Exception as e:
+            logger.warning(f'update_from_gfex failed: {repr(e)}', exc_info=True)
+            return False
+        result = ingest_cached('gfex', variety, partial(ingest_gfex, variety=variety), response, day) and result
+    return result
+
+
+def parse_cffex_element(inst_data: ET.Element, day: datetime.datetime) -> BarRow:
+    """
+    <dailydata>
+    <instrumentid>IC2112</instrumentid>
+    <tradingday>20211209</tradingday>
+    <openprice>7272</openprice>
+    <highestprice>7330</highestprice>
+    <lowestprice>7264.4</lowestprice>
+    <closeprice>7302.4</closeprice>
+    <preopeninterest>107546</preopeninterest>
+    <openinterest>101956</openinterest>
+    <presettlementprice>7274.4</presettlementprice>
+    <settlementpriceif>7314.2</settlementpriceif>
+    <settlementprice>7314.2</settlementprice>
+    <volume>51752</volume>
+    <turnover>75570943720</turnover>
+    <productid>IC</productid>
+    <delta/>
+    <expiredate>20211217</expiredate>
+    </dailydata>
+    """
+    # 不存储期权合约
+    if len(inst_data.findtext('instrumentid').strip()) > 6:
+        return None
+    if inst_data.findtext('productid').strip() in IGNORE_INST_LIST:
+        return None
+    close = to_decimal(inst_data.findtext('closeprice'))
+    return BarRow(
+        ExchangeType.CFFEX, inst_data.findtext('instrumentid').strip(), day.date(),
+        to_int(inst_data.findtext('expiredate')[2:6]),
+        to_decimal(inst_data.findtext('openprice')) if inst_data.findtext('openprice') else close,
+        to_decimal(inst_data.findtext('highestprice')) if inst_data.findtext('highestprice') else close,
+        to_decimal(inst_data.findtext('lowestprice')) if inst_data.findtext('lowestprice') else close,
+        close,
+        to_decimal(inst_data.findtext('settlementprice') if inst_data.findtext('settlementprice') else
+                   inst_data.findtext('presettlementprice')),
+        to_int(inst_data.findtext('volume')), to_decimal(inst_data.findtext('openinterest')))
+
+
+def cffex_parser(day: datetime.datetime, encoding: str = None) -> XmlRowParser:
+    return XmlRowParser('dailydata', partial(parse_cffex_element, day=day), encoding)
+
+
+def parse_cffex(rst, day: datetime.datetime, encoding: str = None) -> List[BarRow]:
+    return parse_all(cffex_parser(day, encoding), rst)
+
+
+def cffex_daily_path(day: datetime.datetime) -> str:
+    return f"/sj/hqsj/rtj/{day.strftime('%Y%m/%d')}/index.xml?id=7"
+
+
+async def fetch_cffex(day: datetime.datetime, revalidate: bool = None) -> HttpResult:
+    return await response_cache.fetch(cffex_pool, 'cffex', day, 'daily', 'GET', cffex_daily_path(day), revalidate)
+
+
+def ingest_cffex(response: HttpResult, day: datetime.datetime) -> int:
+    return store_daily_bars(parse_cffex(response.body, day, response.encoding))
+
+
+async def update_from_cffex(day: datetime.datetime) -> bool:
+    return await stream_ingest('cffex', cffex_pool, day, cffex_parser, 'GET', cffex_daily_path(day))
+
+
+async def stream_ingest(exchange: str, pool: HttpPool, day: datetime.datetime, make_parser, method: str, path: str,
+                        endpoint: str = 'daily', batch_size: int = 500, **kwargs) -> bool:
+    """
+    边下载边解析入库(经过 response_cache), 每解析出 batch_size 行写入一次, 不必等整个文件下载完
+    :param make_parser: make_parser(day, encoding) -> 推式解析器, 如 czce_parser
+    """
     try:
-        async with aiohttp.ClientSession() as session:
-            await max_conn_gfex.acquire()
-            for ids in ['lc', 'si']:
-                async with session.post(f'http://{gfex_ip}/gfexweb/Quote/getQuote_ftr', data={'varietyid': ids}) as response:
-                    rst = await response.text()
-                    rst = json.loads(rst)
-                    max_conn_gfex.release()
-                    for inst_code, inst_data in rst['contractQuote'].items():
-                        expire_date = inst_code.removeprefix(ids)
-                        DailyBar.objects.update_or_create(
-                            code=inst_code,
-                            exchange=ExchangeType.GFEX, time=day, defaults={
-                                'expire_date': expire_date,
-                                'open': inst_data['openPrice'] if inst_data['openPrice'] != "--" else inst_data['closePrice'],
-                                'high': inst_data['highPrice'] if inst_data['highPrice'] != "--" else inst_data['closePrice'],
-                                'low': inst_data['lowPrice'] if inst_data['lowPrice'] != "--" else inst_data['closePrice'],
-                                'close': inst_data['closePrice'],
-                                'settlement': inst_data['clearPrice'],
-                                'volume': inst_data['matchTotQty'] if inst_data['matchTotQty'] != "--" else 0,
-                                'open_interest': inst_data['openInterest'] if inst_data['openInterest'] != "--" else 0})
+        rows = list()
+        async with response_cache.open(pool, exchange, day, endpoint, method, path, **kwargs) as stream:
+            if stream.status != 200:
+                raise ValueError(f'HTTP {stream.status}')
+            async for row in iter_rows(make_parser(day, stream.encoding), stream.chunks):
+                rows.append(row)
+                if len(rows) >= batch_size:
+                    store_daily_bars(rows)
+                    rows = list()
+        store_daily_bars(rows)
+        return True
     except Exception as e:
-        logger.warning(f'update_from_gfex failed: {repr(e)}', exc_info=True)
+        logger.warning(f'update_from_{exchange} failed: {repr(e)}', exc_info=True)
+        # 内容已经完整缓存但无法解析时, 下次重新向交易所验证
+        response_cache.invalidate(exchange, day.date(), endpoint)
         return False
-    return True
 
 
-async def update_from_cffex(day: datetime.datetime) -> bool:
+def ingest_cached(exchange: str, endpoint: str, ingest, response: HttpResult, day: datetime.datetime) -> bool:
+    """
+    解析入库, 失败时把缓存标记为过期, 下次重新向交易所验证
+    """
     try:
-        async with aiohttp.ClientSession() as session:
-            await max_conn_cffex.acquire()
-            async with session.get(f"http://{cffex_ip}/sj/hqsj/rtj/{day.strftime('%Y%m/%d')}/index.xml?id=7") as response:
-                rst = await response.text()
-                max_conn_cffex.release()
-                tree = ET.fromstring(rst)
-                for inst_data in tree:
-                    """
-                    <dailydata>
-                    <instrumentid>IC2112</instrumentid>
-                    <tradingday>20211209</tradingday>
-                    <openprice>7272</openprice>
-                    <highestprice>7330</highestprice>
-                    <lowestprice>7264.4</lowestprice>
-                    <closeprice>7302.4</closeprice>
-                    <preopeninterest>107546</preopeninterest>
-                    <openinterest>101956</openinterest>
-                    <presettlementprice>7274.4</presettlementprice>
-                    <settlementpriceif>7314.2</settlementpriceif>
-                    <settlementprice>7314.2</settlementprice>
-                    <volume>51752</volume>
-                    <turnover>75570943720</turnover>
-                    <productid>IC</productid>
-                    <delta/>
-                    <expiredate>20211217</expiredate>
-                    </dailydata>
-                    """
-                    # 不存储期权合约
-                    if len(inst_data.findtext('instrumentid').strip()) > 6:
-                        continue
-                    if inst_data.findtext('productid').strip() in IGNORE_INST_LIST:
-                        continue
-                    DailyBar.objects.update_or_create(
-                        code=inst_data.findtext('instrumentid').strip(),
-                        exchange=ExchangeType.CFFEX, time=day, defaults={
-                            'expire_date': inst_data.findtext('expiredate')[2:6],
-                            'open': inst_data.findtext('openprice').replace(',', '') if inst_data.findtext(
-                                'openprice') else inst_data.findtext('closeprice').replace(',', ''),
-                            'high': inst_data.findtext('highestprice').replace(',', '') if inst_data.findtext(
-                                'highestprice') else inst_data.findtext('closeprice').replace(',', ''),
-                            'low': inst_data.findtext('lowestprice').replace(',', '') if inst_data.findtext(
-                                'lowestprice') else inst_data.findtext('closeprice').replace(',', ''),
-                            'close': inst_data.findtext('closeprice').replace(',', ''),
-                            'settlement': inst_data.findtext('settlementprice').replace(',', '')
-                            if inst_data.findtext('settlementprice') else
-                            inst_data.findtext(
-                                'presettlementprice').replace(',', ''),
-                            'volume': inst_data.findtext('volume').replace(',', ''),
-                            'open_interest': inst_data.findtext('openinterest').replace(',', '')})
-                return True
+        ingest(response, day)
+        return True
     except Exception as e:
-        logger.warning(f'update_from_cffex failed: {repr(e)}', exc_info=True)
+        logger.warning(f'{exchange} {day:%Y%m%d} {endpoint} 入库失败: {repr(e)}', exc_info=True)
+        response_cache.invalidate(exchange, day.date(), endpoint)
         return False
 
 
-def store_main_bar(inst: Instrument, bar: DailyBar):
-    MainBar.objects.update_or_create(
-        exchange=inst.exchange, product_code=inst.product_code, time=bar.time, defaults={
-            'code': bar.code,
-            'open': bar.open,
-            'high': bar.high,
-            'low': bar.low,
-            'close': bar.close,
-            'settlement': bar.settlement,
-            'volume': bar.volume,
-            'open_interest': bar.open_interest})
-
-
-def handle_rollover(inst: Instrument, new_bar: DailyBar):
-    """
-    换月处理, 基差=新合约收盘价-旧合约收盘价, 从今日起之前的所有连续合约的OHLC加上基差
-    """
-    old_bar = DailyBar.objects.filter(
-        exchange=inst.exchange, code=inst.last_main, time=new_bar.time).first()
-    main_bar = MainBar.objects.get(
-        exchange=inst.exchange, product_code=inst.product_code, time=new_bar.time)
-    old_close = old_bar.close if old_bar else new_bar.close
-    basis = new_bar.close - old_close
-    main_bar.basis = basis
-    basis = float(basis)
-    main_bar.save(update_fields=['basis'])
-    MainBar.objects.filter(exchange=inst.exchange, product_code=inst.product_code, time__lt=new_bar.time).update(
-        open=F('open') + basis, high=F('high') + basis, low=F('low') + basis, close=F('close') + basis,
-        settlement=F('settlement') + basis)
-
-
-def calc_main_inst(inst: Instrument, day: datetime.datetime):
-    updated = False
-    expire_date = get_expire_date(
-        inst.main_code, day) if inst.main_code else day.strftime('%y%m')
+INGESTERS = {'shfe': ingest_shfe, 'czce': ingest_czce, 'dce': ingest_dce, 'cffex': ingest_cffex}
+
+
+def reingest_from_cache(start: datetime.date, end: datetime.date, exchanges=None) -> int:
+    """
+    不访问网络, 用缓存的原始数据重新解析入库, 用于修正解析错误后重建历史日线
+    :param exchanges: 交易所列表, 如 ['czce', 'dce'], None为全部
+    :return: 写入的记录数
+    """
+    count = 0
+    for exchange, day, endpoint, response in tqdm(response_cache.entries(start, end, exchanges)):
+        day = datetime.datetime.combine(day, datetime.time())
+        try:
+            if exchange == 'gfex':
+                count += ingest_gfex(response, day, endpoint)
+            else:
+                count += INGESTERS[exchange](response, day)
+        except Exception as e:
+            logger.warning(f'{exchange} {day:%Y%m%d} {endpoint} 重新入库失败: {repr(e)}', exc_info=True)
+    return count
+
+
+MAIN_BAR_FIELDS = ('open', 'high', 'low', 'close', 'settlement', 'volume', 'open_interest')
+ADJUST_FIELDS = ('open', 'high', 'low', 'close', 'settlement')
+
+
+def _main_bar_order(bar):
+    return -bar.volume, -bar.open_interest, bar.code
+
+
+def select_main_bar(inst: Instrument, main_code: str, day: datetime.date, bars: list, recent_tops: list):
+    """
+    从当日该品种的全部合约日线中选出主力合约
+    :param main_code: 当前的主力合约
+    :param bars: 当日该品种全部合约的日线
+    :param recent_tops: 截至当日最近3个交易日每日成交量最大的日线, 日期倒序
+    :return: 主力合约的日线, 找不到时返回None
+    """
+    expire_date = get_expire_date(main_code, day) if main_code else int(day.strftime('%y%m'))
+    candidates = [bar for bar in bars if bar.expire_date is not None and bar.expire_date >= expire_date]
     # 条件1: 成交量最大 & (成交量>1万 & 持仓量>1万 or 股指) = 主力合约
-    check_bar = DailyBar.objects.filter(
-        (Q(exchange=ExchangeType.CFFEX) |
-         (Q(volume__gte=10000) & Q(open_interest__gte=10000))),
-        exchange=inst.exchange, code__regex=f"^{inst.product_code}[0-9]+",
-        expire_date__gte=expire_date, time=day.date()).order_by('-volume').first()
+    active = [bar for bar in candidates if inst.exchange == ExchangeType.CFFEX or (
+            bar.volume >= 10000 and bar.open_interest >= 10000)]
+    if active:
+        return min(active, key=_main_bar_order)
     # 条件2: 不满足条件1但是连续3天成交量最大 = 主力合约
-    if check_bar is None:
-        check_bars = DailyBar.objects.raw(
-            "SELECT a.* from panel_dailybar a INNER JOIN (SELECT time, max(volume) v FROM panel_dailybar "
-            "WHERE CODE RLIKE %s and time<=%s GROUP BY time ORDER BY time DESC LIMIT 3) b "
-            "WHERE a.time=b.time and a.volume=b.v ORDER BY a.time DESC LIMIT 3", [f"^{inst.product_code}[0-9]+", day])
-        check_bar = check_bars[0] if len(
-            set(bar.code for bar in check_bars)) == 1 else None
+    if recent_tops and len(set(bar.code for bar in recent_tops[:3])) == 1:
+        return recent_tops[0]
     # 条件3: 取当前成交量最大的作为主力
-    if check_bar is None:
-        check_bar = DailyBar.objects.filter(
-            exchange=inst.exchange, code__regex=f"^{inst.product_code}[0-9]+",
-            expire_date__gte=expire_date, time=day.date()).order_by('-volume', '-open_interest', 'code').first()
-    if check_bar is None:
-        check_bar = DailyBar.objects.filter(code=inst.main_code).last()
-        logger.error(f"calc_main_inst 未找到主力合约：{inst} 使用上一个主力合约")
-    if inst.main_code is None:  # 之前没有主力合约
-        inst.main_code = check_bar.code
-        inst.change_time = day
-        inst.save(update_fields=['main_code', 'change_time'])
-        store_main_bar(inst, check_bar)
-    else:
-        # 主力合约发生变化, 做换月处理
-        if check_bar and inst.main_code != check_bar.code and check_bar.code > inst.main_code:
-            inst.last_main = inst.main_code
-            inst.main_code = check_bar.code
-            inst.change_time = day
+    if candidates:
+        return min(candidates, key=_main_bar_order)
+    return None
+
+
+def main_bar_resume_day(inst: Instrument):
+    """
+    主力连续K线续算的起始日: 已生成的最后一根K线与换月日中较晚者的下一天, 从未生成过时返回None
+    """
+    last_day = MainBar.objects.filter(
+        exchange=inst.exchange, product_code=inst.product_code).aggregate(Max('time'))['time__max']
+    if inst.change_time is not None:
+        change_day = timezone.localtime(inst.change_time).date()
+        last_day = change_day if last_day is None else max(last_day, change_day)
+    return last_day + datetime.timedelta(days=1) if last_day else None
+
+
+def build_main_bars(inst: Instrument, begin: datetime.date = None, end: datetime.date = None,
+                    save: bool = True) -> Tuple[str, bool]:
+    """
+    生成主力连续K线: 一次读出品种的全部合约日线, 在内存中逐日选出主力合约, 批量写入 MainBar。
+    MainBar 保存合约的原始价格, 换月只在换月当天的K线上记录基差, 读取时再由 adjust_main_prices 换算成连续价格
+    :param begin: 从该日开始(含), None时从 main_bar_resume_day 续算
+    :param end: 截止日期(含), None为全部
+    :param save: 是否保存 inst 的 main_code/last_main/change_time, 批量处理时可由调用方统一 bulk_update
+    :return: (主力合约, 是否发生换月)
+    """
+    if begin is None:
+        begin = main_bar_resume_day(inst)
+    bars = DailyBar.objects.filter(exchange=inst.exchange, code__regex=f"^{inst.product_code}[0-9]+")
+    if end is not None:
+        bars = bars.filter(time__lte=end)
+    if begin is not None:
+        # 条件2要用到之前两个交易日的成交量
+        lookback = list(bars.filter(time__lt=begin).order_by('-time').values_list('time', flat=True).distinct()[:2])
+        bars = bars.filter(time__gte=lookback[-1] if lookback else begin)
+    main_code, last_main, change_day = inst.main_code, inst.last_main, None
+    main_bars, rollovers, tops, last_bars = list(), list(), list(), dict()
+    for day, group in groupby(bars.order_by('time', 'code').values_list(
+            'code', 'time', 'expire_date', *MAIN_BAR_FIELDS, named=True), key=attrgetter('time')):
+        day_bars = list(group)
+        max_volume = max(bar.volume for bar in day_bars)
+        tops.insert(0, [bar for bar in day_bars if bar.volume == max_volume])
+        del tops[3:]
+        last_bars.update((bar.code, bar) for bar in day_bars)
+        if begin is not None and day < begin:
+            continue
+        check_bar = select_main_bar(inst, main_code, day, day_bars, [bar for top in tops for bar in top][:3])
+        if check_bar is None:
+            check_bar = last_bars.get(main_code) or DailyBar.objects.filter(code=main_code).order_by('time').last()
+            logger.error(f"build_main_bars 未找到主力合约：{inst} {day} 使用上一个主力合约")
+            if check_bar is None:
+                continue
+        main_bar = MainBar(exchange=inst.exchange, product_code=inst.product_code, time=day, code=check_bar.code,
+                           **{field: getattr(check_bar, field) for field in MAIN_BAR_FIELDS})
+        if main_code is None:  # 之前没有主力合约
+            main_code, change_day = check_bar.code, day
+        elif check_bar.code != main_code and check_bar.code > main_code:
+            # 主力合约发生变化, 基差=新合约收盘价-旧合约收盘价
+            old_bar = next((bar for bar in day_bars if bar.code == main_code), None)
+            main_bar.basis = check_bar.close - old_bar.close if old_bar else Decimal(0)
+            rollovers.append(main_bar)
+            last_main, main_code, change_day = main_code, check_bar.code, day
+        main_bars.append(main_bar)
+    if not main_bars:
+        return main_code, False
+    update_fields = ['code', *MAIN_BAR_FIELDS]
+    bulk_upsert(MainBar, [bar for bar in main_bars if bar.basis is None],
+                ['exchange', 'product_code', 'time'], update_fields)
+    bulk_upsert(MainBar, rollovers, ['exchange', 'product_code', 'time'], update_fields + ['basis'])
+    bar_store.merge_main(inst.product_code, [
+        (bar.time, bar.code, *(np.nan if getattr(bar, field) is None else getattr(bar, field)
+                               for field in (*MAIN_BAR_FIELDS, 'basis'))) for bar in main_bars])
+    if change_day is not None:
+        inst.main_code, inst.last_main = main_code, last_main
+        inst.change_time = timezone.make_aware(datetime.datetime.combine(change_day, datetime.time.min))
+        if save:
             inst.save(update_fields=['last_main', 'main_code', 'change_time'])
-            store_main_bar(inst, check_bar)
-            handle_rollover(inst, check_bar)
-            updated = True
-        else:
-            store_main_bar(inst, check_bar)
-    return inst.main_code, updated
+    return main_code, len(rollovers) > 0
+
+
+def calc_main_inst(inst: Instrument, day: datetime.datetime, save: bool = True):
+    """
+    生成截至day的主力连续K线, 之前漏掉的交易日一并补上
+    """
+    begin = main_bar_resume_day(inst)
+    if begin is not None:
+        begin = min(begin, day.date())
+    return build_main_bars(inst, begin, day.date(), save)
 
 
 def create_main(inst: Instrument):
     print('processing ', inst.product_code)
-    if inst.change_time is None:
-        for day in DailyBar.objects.filter(
-                # time__gte=datetime.datetime.strptime('20211211', '%Y%m%d'),
-                exchange=inst.exchange, code__regex='^{}[0-9]+'.format(inst.product_code)).order_by(
-                'time').values_list('time', flat=True).distinct():
-            print(day, calc_main_inst(inst, timezone.make_aware(
-                datetime.datetime.combine(day, datetime.time.min))))
-    else:
-        for day in DailyBar.objects.filter(
-                time__gt=inst.change_time,
-                exchange=inst.exchange, code__regex='^{}[0-9]+'.format(inst.product_code)).order_by(
-                'time').values_list('time', flat=True).distinct():
-            print(day, calc_main_inst(inst, timezone.make_aware(
-                datetime.datetime.combine(day, datetime.time.min))))
+    print(build_main_bars(inst))
     return True
 
 
 def create_main_all():
-    for inst in Instrument.objects.all():
-        create_main(inst)
+    inst_list = list(Instrument.objects.all())
+    for inst in inst_list:
+        print('processing ', inst.product_code)
+        build_main_bars(inst, save=False)
+    Instrument.objects.bulk_update(inst_list, ['last_main', 'main_code', 'change_time'])
     print('all done!')
 
 
+def load_rollover_basis(product_codes) -> dict:
+    """
+    读取各品种的换月记录, 即 MainBar 中记录了基差的K线
+    :return: {品种代码: (换月日期 datetime64[D] 升序, 基差 float64)}
+    """
+    rollover_dict = dict()
+    for code, time, basis in MainBar.objects.filter(
+            product_code__in=list(product_codes), basis__isnull=False).order_by('time').values_list(
+            'product_code', 'time', 'basis'):
+        times, bases = rollover_dict.setdefault(code, ([], []))
+        times.append(time)
+        bases.append(float(basis))
+    return {code: (np.array(times, dtype='datetime64[D]'), np.array(bases, dtype=np.float64))
+            for code, (times, bases) in rollover_dict.items()}
+
+
+def calc_adjustment(times, rollover: tuple) -> np.ndarray:
+    """
+    换月调整量: 每根K线加上其后全部换月的基差之和, 调整后的价格与最新的主力合约连续
+    :param times: K线日期
+    :param rollover: load_rollover_basis 得到的 (换月日期, 基差)
+    :return: 与times等长的调整量
+    """
+    rollover_times, basis = rollover
+    after = np.append(np.cumsum(basis[::-1])[::-1], 0)
+    return after[np.searchsorted(rollover_times, np.asarray(times, dtype='datetime64[D]'), side='right')]
+
+
+def apply_adjustment(prices: np.ndarray, adjustment: np.ndarray) -> np.ndarray:
+    """
+    原始价格加上换月调整量, 与 DecimalField 一样保留3位小数, 没有调整的价格原样返回
+    """
+    return np.where(adjustment != 0, (prices + adjustment).round(3), prices)
+
+
+def bars_rollover(bars: Bars) -> tuple:
+    """
+    从缓存的主力连续K线中取出换月记录, 格式同 load_rollover_basis
+    """
+    basis = bars['basis']
+    mask = ~np.isnan(basis)
+    return bars.time[mask], np.asarray(basis[mask])
+
+
+def adjust_main_prices(df: pd.DataFrame, product_code: str, rollover: tuple = None) -> pd.DataFrame:
+    """
+    把从 MainBar 读出的原始价格换算成连续价格, df 以K线日期为索引, 价格列原地修改
+    :param rollover: 已读好的换月记录, 为None时从数据库读取
+    :return: df
+    """
+    if rollover is None:
+        rollover = load_rollover_basis([product_code]).get(product_code)
+    if rollover is None or df.empty:
+        return df
+    adjustment = calc_adjustment(df.index.to_numpy(dtype='datetime64[D]'), rollover)
+    for field in ADJUST_FIELDS:
+        if field in df.columns:
+            df[field] = apply_adjustment(df[field].to_numpy(dtype=np.float64), adjustment)
+    return df
+
+
+def load_main_frame(product_code: str, day: datetime.datetime = None, count: int = None) -> pd.DataFrame:
+    """
+    从本地缓存读取单个品种换月调整后的主力连续K线
+    :param day: 截止日期(含), None为全部
+    :param count: 只取最后count根
+    :return: 以 time 为索引、日期升序的 DataFrame, 包含 code 和 MainBar 的价格/成交量/持仓量/基差列
+    """
+    bars = bar_store.load_main([product_code]).get(product_code)
+    if bars is None:
+        return pd.DataFrame(columns=['code', *MAIN_BAR_FIELDS, 'basis'], index=pd.DatetimeIndex([], name='time'))
+    rollover = bars_rollover(bars)
+    if day is not None:
+        bars = bars.until(day.date())
+    if count is not None:
+        bars = bars.tail(count)
+    df = bars.to_frame()
+    adjustment = calc_adjustment(bars.time, rollover)
+    for field in ADJUST_FIELDS:
+        df[field] = apply_adjustment(df[field].to_numpy(), adjustment)
+    return df
+
+
+def unadjust_main_bars(product_code: str = None):
+    """
+    一次性工具: 把以前换月时整体改写过的 MainBar 历史价格还原为原始价格, 只能执行一次
+    :param product_code: 品种代码, None为全部品种
+    """
+    main_bars = MainBar.objects.all()
+    if product_code is not None:
+        main_bars = main_bars.filter(product_code=product_code)
+    for code in main_bars.values_list('product_code', flat=True).distinct():
+        rollover = load_rollover_basis([code]).get(code)
+        if rollover is None:
+            continue
+        bar_list = list(MainBar.objects.filter(product_code=code).order_by('time'))
+        adjustment = calc_adjustment([bar.time for bar in bar_list], rollover)
+        for bar, value in zip(bar_list, adjustment):
+            for field in ADJUST_FIELDS:
+                if getattr(bar, field) is not None:
+                    setattr(bar, field, getattr(bar, field) - to_decimal(round(value, 3)))
+        MainBar.objects.bulk_update(bar_list, list(ADJUST_FIELDS), batch_size=1000)
+        bar_store.invalidate('main', [code])
+        print('unadjusted', code)
+
+
+def create_adjusted_main_view():
+    """
+    可选: 建立换月调整后的主力连续K线视图, 供 AdjustedMainBar 直接查询
+    """
+    columns = ', '.join(f'm.{field} + COALESCE(SUM(r.basis), 0) AS {field}' for field in ADJUST_FIELDS)
+    with connection.cursor() as cursor:
+        cursor.execute(f'DROP VIEW IF EXISTS {AdjustedMainBar._meta.db_table}')
+        cursor.execute(
+            f'CREATE VIEW {AdjustedMainBar._meta.db_table} AS '
+            f'SELECT m.id, m.exchange, m.product_code, m.code, m.time, {columns}, '
+            f'm.volume, m.open_interest, m.basis FROM {MainBar._meta.db_table} m '
+            f'LEFT JOIN {MainBar._meta.db_table} r ON r.exchange = m.exchange AND '
+            f'r.product_code = m.product_code AND r.time > m.time AND r.basis IS NOT NULL GROUP BY m.id')
+
+
 def is_auction_time(inst: Instrument, status: dict):
     if status['InstrumentStatus'] == ApiStruct.IS_AuctionOrdering:
         now = timezone.localtime()
@@ -471,21 +810,62 @@ def is_auction_time(inst: Instrument, status: dict):
     return False
 
 
+def load_main_bars(product_codes, day: datetime.datetime, count: int = 400) -> dict:
+    """
+    从本地缓存读取多个品种最近count根主力连续K线, 组装成 (K线序号 x 品种) 的二维数组,
+    各品种按最新一根K线右对齐, 不足count根的品种在上方补NaN, 价格已做换月调整
+    :param product_codes: 品种代码列表
+    :param day: 截止日期(含)
+    :param count: 每个品种读取的K线数量
+    :return: {'code': 品种列表, 'size': 各品种K线数量, 'time': datetime64二维数组,
+              'open'/'high'/'low'/'close': float64二维数组}
+    """
+    bars_dict = bar_store.load_main(product_codes)
+    codes = sorted(bars_dict)
+    panel = {'code': codes, 'size': np.zeros(len(codes), dtype=int),
+             'time': np.full((count, len(codes)), np.datetime64('NaT'), dtype='datetime64[ns]')}
+    for field in ('open', 'high', 'low', 'close'):
+        panel[field] = np.full((count, len(codes)), np.nan)
+    for col, code in enumerate(codes):
+        bars = bars_dict[code].until(day.date()).tail(count)
+        size = panel['size'][col] = len(bars)
+        if size == 0:
+            continue
+        adjustment = calc_adjustment(bars.time, bars_rollover(bars_dict[code]))
+        panel['time'][-size:, col] = bars.time
+        for field in ('open', 'high', 'low', 'close'):
+            panel[field][-size:, col] = apply_adjustment(bars[field], adjustment)
+    return panel
+
+
+def panel_to_frames(panel: dict) -> dict:
+    """
+    把 load_main_bars 得到的二维数组按品种拆回按日期升序的 DataFrame
+    :return: {品种代码: DataFrame}
+    """
+    frames = dict()
+    fields = [k for k, v in panel.items() if k not in ('code', 'size', 'time')]
+    for col, code in enumerate(panel['code']):
+        size = panel['size'][col]
+        if size == 0:
+            continue
+        frames[code] = pd.DataFrame({field: panel[field][-size:, col] for field in fields},
+                                    index=pd.DatetimeIndex(panel['time'][-size:, col], name='time'))
+    return frames
+
+
 def calc_sma(price, period):
     return reduce(lambda x, y: ((period - 1) * x + y) / period, price)
 
 
-def calc_corr(day: datetime.datetime):
-    price_dict = dict()
-    begin_day = day.replace(year=day.year - 3)
-    for code in Strategy.objects.get(name='大哥2.0').instruments.all().order_by('id').values_list(
-            'product_code', flat=True):
-        price_dict[code] = to_df(MainBar.objects.filter(
-            time__gte=begin_day.date(),
-            product_code=code).order_by('time').values_list('time', 'close'), index_col='time', parse_dates=['time'])
-        price_dict[code].index = pd.DatetimeIndex(price_dict[code].time)
-        price_dict[code]['price'] = price_dict[code].close.pct_change()
-    return pd.DataFrame({k: v.price for k, v in price_dict.items()}).corr()
+def calc_corr(day: datetime.datetime) -> pd.DataFrame:
+    """
+    策略关注品种最近3年日收益率的相关系数, 由 correlation_service 增量维护
+    """
+    code_list = list(Strategy.objects.get(name='大哥2.0').instruments.all().order_by('id').values_list(
+        'product_code', flat=True))
+    correlation_service.update(day, code_list)
+    return correlation_service.corr(code_list)
 
 
 def nCr(n, r):
@@ -493,144 +873,132 @@ def nCr(n, r):
     return f(n) / f(r) / f(n-r)
 
 
-def find_best_score(n: int = 20):
+def find_best_score(n: int = 20, time_budget: float = 5.0, processes: int = 1):
     """
-    一秒钟算5个组合，要算100年..
+    从策略关注的品种中选出两两相关性最低的n个品种
+    :param time_budget: 组合数太多无法穷举时, 启发式搜索的时间(秒)
+    :param processes: 并行搜索的进程数
+    :return: [(得分, 品种代码列表)], 从好到差
     """
     corr_matrix = calc_corr(datetime.datetime.today())
-    code_list = Strategy.objects.get(name='大哥2.0').instruments.all().order_by('id').values_list(
-        'product_code', flat=True)
-    result = list()
-    for code_list in tqdm(combinations(code_list, n), total=nCr(code_list.count(), n)):
-        score_df = pd.DataFrame([corr_matrix.iloc[i, j]
-                                for i, j in combinations(code_list, 2)])
-        score = (
-            round((1 - (score_df.abs() ** 2).mean()[0]) * 100, 3) - 50) * 2
-        result.append((score, ','.join(code_list)))
-    result.sort(key=lambda tup: tup[0])
-    print('得分最高: ', result[-3:])
-    print('得分最低: ', result[:3])
-
-
-def calc_history_signal(inst: Instrument, day: datetime.datetime, strategy: Strategy):
-    break_n = strategy.param_set.get(code='BreakPeriod').int_value
-    atr_n = strategy.param_set.get(code='AtrPeriod').int_value
-    long_n = strategy.param_set.get(code='LongPeriod').int_value
-    short_n = strategy.param_set.get(code='ShortPeriod').int_value
-    stop_n = strategy.param_set.get(code='StopLoss').int_value
-    df = to_df(MainBar.objects.filter(
-        time__lte=day.date(),
-        exchange=inst.exchange, product_code=inst.product_code).order_by('time').values_list(
-        'time', 'open', 'high', 'low', 'close', 'settlement'), index_col='time', parse_dates=['time'])
-    df.index = pd.DatetimeIndex(df.time, tz=pytz.FixedOffset(480))
-    df['atr'] = ATR(df.high, df.low, df.close, timeperiod=atr_n)
-    # df columns: 0:time,1:open,2:high,3:low,4:close,5:settlement,6:atr,7:short_trend,8:long_trend
-    df['short_trend'] = df.close
-    df['long_trend'] = df.close
-    for idx in range(1, df.shape[0]):
-        df.iloc[idx, 7] = (df.iloc[idx - 1, 7] *
-                           (short_n - 1) + df.iloc[idx, 4]) / short_n
-        df.iloc[idx, 8] = (df.iloc[idx - 1, 8] *
-                           (long_n - 1) + df.iloc[idx, 4]) / long_n
-    df['high_line'] = df.close.rolling(window=break_n).max()
-    df['low_line'] = df.close.rolling(window=break_n).min()
-    cur_pos = 0
-    last_trade = None
-    for cur_idx in range(break_n+1, df.shape[0]):
-        idx = cur_idx - 1
-        cur_date = df.index[cur_idx].to_pydatetime()
-        prev_date = df.index[idx].to_pydatetime()
-        if cur_pos == 0:
-            if df.short_trend[idx] > df.long_trend[idx] and int(df.close[idx]) >= int(df.high_line[idx-1]):
-                new_bar = MainBar.objects.filter(
-                    exchange=inst.exchange, product_code=inst.product_code, time=cur_date).first()
-                Signal.objects.create(
-                    code=new_bar.code, trigger_value=df.atr[idx],
-                    strategy=strategy, instrument=inst, type=SignalType.BUY, processed=True,
-                    trigger_time=prev_date, price=new_bar.open, volume=1, priority=PriorityType.LOW)
-                last_trade = Trade.objects.create(
-                    broker=strategy.broker, strategy=strategy, instrument=inst,
-                    code=new_bar.code, direction=DirectionType.values[DirectionType.LONG],
-                    open_time=cur_date, shares=1, filled_shares=1, avg_entry_price=new_bar.open)
-                cur_pos = cur_idx
-            elif df.short_trend[idx] < df.long_trend[idx] and int(df.close[idx]) < int(df.low_line[idx-1]):
-                new_bar = MainBar.objects.filter(
-                    exchange=inst.exchange, product_code=inst.product_code,
-                    time=df.index[cur_idx].to_pydatetime().date()).first()
-                Signal.objects.create(
-                    code=new_bar.code, trigger_value=df.atr[idx],
-                    strategy=strategy, instrument=inst, type=SignalType.SELL_SHORT, processed=True,
-                    trigger_time=prev_date, price=new_bar.open, volume=1, priority=PriorityType.LOW)
-                last_trade = Trade.objects.create(
-                    broker=strategy.broker, strategy=strategy, instrument=inst,
-                    code=new_bar.code, direction=DirectionType.values[DirectionType.SHORT],
-                    open_time=cur_date, shares=1, filled_shares=1, avg_entry_price=new_bar.open)
-                cur_pos = cur_idx * -1
-        elif cur_pos > 0 and prev_date > last_trade.open_time:
-            hh = float(MainBar.objects.filter(
-                exchange=inst.exchange, product_code=inst.product_code,
-                time__gte=last_trade.open_time,
-                time__lt=prev_date).aggregate(Max('high'))['high__max'])
-            if df.close[idx] <= hh - df.atr[cur_pos-1] * stop_n:
-                new_bar = MainBar.objects.filter(
-                    exchange=inst.exchange, product_code=inst.product_code,
-                    time=df.index[cur_idx].to_pydatetime().date()).first()
-                Signal.objects.create(
-                    strategy=strategy, instrument=inst, type=SignalType.SELL, processed=True,
-                    code=new_bar.code,
-                    trigger_time=prev_date, price=new_bar.open, volume=1, priority=PriorityType.LOW)
-                last_trade.avg_exit_price = new_bar.open
-                last_trade.close_time = cur_date
-                last_trade.closed_shares = 1
-                last_trade.profit = (
-                    new_bar.open - last_trade.avg_entry_price) * inst.volume_multiple
-                last_trade.save()
-                cur_pos = 0
-        elif cur_pos < 0 and prev_date > last_trade.open_time:
-            ll = float(MainBar.objects.filter(
-                exchange=inst.exchange, product_code=inst.product_code,
-                time__gte=last_trade.open_time,
-                time__lt=prev_date).aggregate(Min('low'))['low__min'])
-            if df.close[idx] >= ll + df.atr[cur_pos * -1-1] * stop_n:
-                new_bar = MainBar.objects.filter(
-                    exchange=inst.exchange, product_code=inst.product_code,
-                    time=df.index[cur_idx].to_pydatetime().date()).first()
-                Signal.objects.create(
-                    code=new_bar.code,
-                    strategy=strategy, instrument=inst, type=SignalType.BUY_COVER, processed=True,
-                    trigger_time=prev_date, price=new_bar.open, volume=1, priority=PriorityType.LOW)
-                last_trade.avg_exit_price = new_bar.open
-                last_trade.close_time = cur_date
-                last_trade.closed_shares = 1
-                last_trade.profit = (
-                    last_trade.avg_entry_price - new_bar.open) * inst.volume_multiple
-                last_trade.save()
-                cur_pos = 0
-        if cur_pos != 0 and cur_date.date() == day.date():
-            last_trade.avg_exit_price = df.open[cur_idx]
-            last_trade.close_time = cur_date
-            last_trade.closed_shares = 1
-            if last_trade.direction == DirectionType.values[DirectionType.LONG]:
-                last_trade.profit = (last_trade.avg_entry_price - Decimal(df.open[cur_idx])) * \
-                    inst.volume_multiple
-            else:
-                last_trade.profit = (Decimal(df.open[cur_idx]) - last_trade.avg_entry_price) * \
-                    inst.volume_multiple
-            last_trade.save()
+    code_list = list(corr_matrix.columns)
+    result = [(score, [code_list[i] for i in basket]) for score, basket in select_basket(
+        corr_matrix.to_numpy(), n, time_budget, processes)]
+    for score, codes in result:
+        print('得分: ', score, ','.join(codes))
+    return result
+
+
+def calc_history_signal(inst: Instrument, day: datetime.datetime, strategy: Strategy, param: StrategyParam = None):
+    """
+    回测单个品种截至day的历史信号, 在内存中跑完整段行情后把 Signal 和 Trade 一次性批量写入
+    """
+    if param is None:
+        param = strategy.get_param()
+    df = load_main_frame(inst.product_code, day)
+    if df.shape[0] <= param.break_n + 1:
+        return list()
+    calc_indicators(df, param.break_n, param.atr_n, param.long_n, param.short_n)
+    times = df.index.tz_localize(pytz.FixedOffset(480)).to_pydatetime()
+    codes = df.code.to_numpy()
+    atr = df.atr.to_numpy()
+    events = run_backtest(
+        df.open.to_numpy(), df.high.to_numpy(), df.low.to_numpy(), df.close.to_numpy(), atr,
+        df.short_trend.to_numpy(), df.long_trend.to_numpy(), df.high_line.to_numpy(), df.low_line.to_numpy(),
+        param.stop_n, param.break_n + 1, codes, times[-1].date() == day.date())
+    signals, trades = list(), list()
+    for event in events:
+        price = to_decimal(event.price)
+        if event.kind == ENTRY:
+            signals.append(Signal(
+                code=codes[event.index], trigger_value=to_decimal(round(atr[event.trigger], 3)),
+                strategy=strategy, instrument=inst, processed=True,
+                type=SignalType.BUY if event.direction > 0 else SignalType.SELL_SHORT,
+                trigger_time=times[event.trigger], price=price, volume=1, priority=PriorityType.LOW))
+            trades.append(Trade(
+                broker=strategy.broker, strategy=strategy, instrument=inst, code=codes[event.index],
+                direction=DirectionType.values[DirectionType.LONG if event.direction > 0 else DirectionType.SHORT],
+                open_time=times[event.index], shares=1, filled_shares=1, avg_entry_price=price))
+        elif event.kind in (STOP, MARK):
+            if event.kind == STOP:
+                signals.append(Signal(
+                    code=codes[event.index], strategy=strategy, instrument=inst, processed=True,
+                    type=SignalType.SELL if event.direction > 0 else SignalType.BUY_COVER,
+                    trigger_time=times[event.trigger], price=price, volume=1, priority=PriorityType.LOW))
+            trade = trades[event.trade]
+            trade.avg_exit_price = price
+            trade.close_time = times[event.index]
+            trade.closed_shares = 1
+            trade.profit = (price - trade.avg_entry_price) * event.direction * inst.volume_multiple
+    Signal.objects.bulk_create(signals)
+    Trade.objects.bulk_create(trades)
+    return events
 
 
 def calc_his_all(day: datetime.datetime):
     strategy = Strategy.objects.get(name='大哥2.0')
     print(f'calc_his_all day: {day} stragety: {strategy}')
-    for inst in strategy.instruments.all():
+    param = strategy.get_param()
+    inst_list = list(strategy.instruments.all())
+    bar_store.load_main([inst.product_code for inst in inst_list])  # 一次同步全部品种的K线缓存
+    for inst in inst_list:
         print('process', inst)
         last_day = Trade.objects.filter(instrument=inst, close_time__isnull=True).values_list(
             'open_time', flat=True).first()
         if last_day is None:
-            last_day = datetime.datetime.combine(
+            last_day = timezone.make_aware(datetime.datetime.combine(
                 MainBar.objects.filter(product_code=inst.product_code, time__lte=day).order_by(
-                    '-time').values_list('time', flat=True).first(), timezone.make_aware(datetime.time.min))
-        calc_history_signal(inst, last_day, strategy)
+                    '-time').values_list('time', flat=True).first(), datetime.time.min))
+        calc_history_signal(inst, last_day, strategy, param)
+
+
+def load_sweep_bars(product_codes: list, day: datetime.datetime = None) -> Tuple[list, np.ndarray, np.ndarray]:
+    """
+    读取多个品种换月调整后的主力连续K线, 按交易日对齐成一个数组, 供参数扫描放入共享内存
+    :param day: 截止日期(含), None为全部
+    :return: (品种列表, 交易日, (BAR_FIELDS x 交易日 x 品种) 数组, 当日没有K线的位置为NaN)
+    """
+    bars_map = bar_store.load_main(product_codes)
+    codes, columns = list(), list()
+    for code in product_codes:
+        bars = bars_map.get(code)
+        if bars is None:
+            continue
+        rollover = bars_rollover(bars)
+        if day is not None:
+            bars = bars.until(day.date())
+        if len(bars) == 0:
+            continue
+        adjustment = calc_adjustment(bars.time, rollover)
+        codes.append(code)
+        columns.append((bars.time, [apply_adjustment(bars[field], adjustment) for field in BAR_FIELDS[:4]] +
+                        [np.asarray(bars['open'])]))
+    calendar = np.unique(np.concatenate([times for times, _ in columns])) if columns else \
+        np.array([], dtype='datetime64[D]')
+    panel = np.full((len(BAR_FIELDS), calendar.shape[0], len(codes)), np.nan)
+    for col, (times, values) in enumerate(columns):
+        panel[:, np.searchsorted(calendar, times), col] = values
+    return codes, calendar, panel
+
+
+def param_sweep(grid: dict, product_codes: list = None, day: datetime.datetime = None, max_workers: int = None,
+                cost: float = 0.0) -> pd.DataFrame:
+    """
+    突破策略的参数扫描, 例如 param_sweep({'break_n': range(20, 80, 5), 'stop_n': [2, 3, 4]})
+    :param grid: {StrategyParam字段名: 取值列表}, 没有给出的参数使用策略当前参数
+    :param product_codes: 参与回测的品种, None为策略关注的全部品种
+    :param day: 回测截止日期(含), None为全部
+    :param max_workers: 进程数, 默认为CPU核数
+    :param cost: 每单位换手的成本(比例)
+    :return: 按净值排序的结果, 每行一个参数组合
+    """
+    strategy = Strategy.objects.get(name='大哥2.0')
+    if product_codes is None:
+        product_codes = list(strategy.instruments.values_list('product_code', flat=True))
+    combos = param_grid(grid, asdict(strategy.get_param()))
+    codes, calendar, panel = load_sweep_bars(product_codes, day)
+    logger.info(f'参数扫描: {len(combos)}个组合, {len(codes)}个品种, {calendar.shape[0]}个交易日')
+    return run_sweep(panel, combos, max_workers, cost)
 
 
 def calc_his_up_limit(inst: Instrument, bar: DailyBar):
@@ -647,22 +1015,18 @@ def calc_his_down_limit(inst: Instrument, bar: DailyBar):
     return price + inst.price_tick
 
 
-async def clean_daily_bar():
-    day = timezone.make_aware(datetime.datetime.strptime('20100416', '%Y%m%d'))
-    end = timezone.make_aware(datetime.datetime.strptime('20160118', '%Y%m%d'))
-    tasks = []
-    while day <= end:
-        tasks.append(is_trading_day(day))
-        day += datetime.timedelta(days=1)
-    trading_days = []
-    for f in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
-        rst = await f
-        trading_days.append(rst)
-    tasks.clear()
-    for day, trading in trading_days:
-        if not trading:
-            DailyBar.objects.filter(time=day.date()).delete()
-    print('done!')
+async def clean_daily_bar(start: datetime.date = datetime.date(2010, 4, 16), end: datetime.date = datetime.date(2016, 1, 18)):
+    """
+    删除非交易日的日线
+    """
+    await trading_calendar.ensure(start, end)
+    if not trading_calendar.covers_range(start, end):
+        # 日历不完整时不能删除, 以免误删交易日的数据
+        logger.warning(f'交易日历没有覆盖 {start} 至 {end}, 放弃清理')
+        return
+    trading_days = trading_calendar.trading_days(start, end)
+    deleted, _ = DailyBar.objects.filter(time__range=(start, end)).exclude(time__in=trading_days).delete()
+    print(f'done! 删除{deleted}条')
 
 
 def load_kt_data(directory: str = r'D:\test'):
@@ -694,6 +1058,7 @@ def load_kt_data(directory: str = r'D:\test'):
                         exchange=inst.exchange, product_code=code, code=main_code, time=date, open=oo, high=hh, low=ll,
                         close=cc, settlement=se, open_interest=oi, volume=vo, basis=None))
             MainBar.objects.bulk_create(insert_list)
+            bar_store.invalidate('main', [code])
             Instrument.objects.filter(product_code=code).update(
                 last_main=last_main, main_code=cur_main, change_time=change_time)
         return True
@@ -703,123 +1068,118 @@ def load_kt_data(directory: str = r'D:\test'):
 
 
 # 从交易所获取合约当日的涨跌停幅度 TODO: 广期所
+def parse_cffex_argument(inst_data: ET.Element) -> Tuple[str, str, float]:
+    """
+    <INDEX>
+    <TRADING_DAY>20211216</TRADING_DAY>
+    <PRODUCT_ID>IC</PRODUCT_ID>
+    <INSTRUMENT_ID>IC2112</INSTRUMENT_ID>
+    <INSTRUMENT_MONTH>2112</INSTRUMENT_MONTH>
+    <BASIS_PRICE>6072.8</BASIS_PRICE>
+    <OPEN_DATE>20210419</OPEN_DATE>
+    <END_TRADING_DAY>20211217</END_TRADING_DAY>
+    <UPPER_VALUE>0.1</UPPER_VALUE>
+    <LOWER_VALUE>0.1</LOWER_VALUE>
+    <UPPERLIMITPRICE>8063.6</UPPERLIMITPRICE>
+    <LOWERLIMITPRICE>6597.6</LOWERLIMITPRICE>
+    <LONG_LIMIT>1200</LONG_LIMIT>
+    </INDEX>
+    :return: (合约, 品种, 涨跌停板比例), 期权合约和忽略的品种返回None
+    """
+    inst_id = inst_data.findtext('INSTRUMENT_ID').strip()
+    # 不存储期权合约
+    if len(inst_id) > 6:
+        return None
+    code = inst_data.findtext('PRODUCT_ID').strip()
+    if code in IGNORE_INST_LIST:
+        return None
+    return inst_id, code, str_to_number(inst_data.findtext('UPPER_VALUE').strip())
+
+
 async def get_contracts_argument(day: datetime.datetime = None) -> bool:
     try:
         if day is None:
             day = timezone.localtime()
         day_str = day.strftime('%Y%m%d')
-        redis_client = redis.StrictRedis(
-            host=config.get('REDIS', 'host', fallback='localhost'),
-            db=config.getint('REDIS', 'db', fallback=0), decode_responses=True)
-        async with aiohttp.ClientSession() as session:
-            # 上期所
-            async with session.get(
-                    f'http://{shfe_ip}/data/busiparamdata/future/ContractDailyTradeArgument{day_str}.dat') as response:
-                rst = await response.read()
-                rst_json = json.loads(rst)
-                for inst_data in rst_json['ContractDailyTradeArgument']:
-                    """
+        redis_client = redis_manager.client
+        # 上期所
+        response = await shfe_pool.get(f'/data/busiparamdata/future/ContractDailyTradeArgument{day_str}.dat')
+        rst_json = response.json()
+        for inst_data in rst_json['ContractDailyTradeArgument']:
+            """
 {"HDEGE_LONGMARGINRATIO":".10000000","HDEGE_SHORTMARGINRATIO":".10000000","INSTRUMENTID":"cu2201",
 "LOWER_VALUE":".08000000","PRICE_LIMITS":"","SPEC_LONGMARGINRATIO":".10000000","SPEC_SHORTMARGINRATIO":".10000000",
 "TRADINGDAY":"20211217","UPDATE_DATE":"2021-12-17 09:51:20","UPPER_VALUE":".08000000","id":124468118}
-                    """
-                    # logger.info(f'inst_data: {inst_data}')
-                    code = re.findall(
-                        '[A-Za-z]+', inst_data['INSTRUMENTID'])[0]
-                    if code in IGNORE_INST_LIST:
-                        continue
-                    exchange = ExchangeType.INE if code in INE_INST_LIST else ExchangeType.SHFE
-                    limit_ratio = str_to_number(inst_data['UPPER_VALUE'])
-                    redis_client.set(
-                        f"LIMITRATIO:{exchange}:{code}:{inst_data['INSTRUMENTID']}", limit_ratio)
-            # 大商所
-            async with session.post(f'http://{dce_ip}/publicweb/notificationtips/exportDayTradPara.html',
-                                    data={'exportFlag': 'txt'}) as response:
-                rst = await response.text()
-                for lines in rst.split('\r\n')[3:400]:
-                    # 跳过期权合约
-                    if '本系列限额' in lines:
-                        break
-                    inst_data_raw = [x.strip() for x in lines.split('\t')]
-                    inst_data = []
-                    for cell in inst_data_raw:
-                        if len(cell) > 0:
-                            inst_data.append(cell)
-                    if len(inst_data) == 0:
-                        continue
-                    """
+            """
+            # logger.info(f'inst_data: {inst_data}')
+            code = re.findall(
+                '[A-Za-z]+', inst_data['INSTRUMENTID'])[0]
+            if code in IGNORE_INST_LIST:
+                continue
+            exchange = ExchangeType.INE if code in INE_INST_LIST else ExchangeType.SHFE
+            limit_ratio = str_to_number(inst_data['UPPER_VALUE'])
+            redis_client.set(
+                f"LIMITRATIO:{exchange}:{code}:{inst_data['INSTRUMENTID']}", limit_ratio)
+        # 大商所
+        async with dce_pool.open('POST', '/publicweb/notificationtips/exportDayTradPara.html',
+                                 data={'exportFlag': 'txt'}) as stream:
+            index = 0
+            async for lines in iter_rows(LineRowParser(str, '\r\n', head=3, encoding=stream.encoding), stream.chunks):
+                index += 1
+                # 跳过期权合约, 期货合约在文件开头, 不必读完整个文件
+                if '本系列限额' in lines or index > 397:
+                    break
+                inst_data_raw = [x.strip() for x in lines.split('\t')]
+                inst_data = []
+                for cell in inst_data_raw:
+                    if len(cell) > 0:
+                        inst_data.append(cell)
+                if len(inst_data) == 0:
+                    continue
+                """
 [0合约,1交易保证金比例(投机),2交易保证金金额（元/手）(投机),3交易保证金比例(套保),4交易保证金金额（元/手）(套保),5涨跌停板比例,
      6涨停板价位（元）,7跌停板价位（元）]
 ['a2201','0.12','7,290','0.08','4,860','0.08','6,561','5,589','30,000','15,000']
-                    """
-                    code = re.findall('[A-Za-z]+', inst_data[0])[0]
-                    if code in IGNORE_INST_LIST:
-                        continue
-                    limit_ratio = str_to_number(inst_data[5])
-                    redis_client.set(
-                        f"LIMITRATIO:{ExchangeType.DCE}:{code}:{inst_data[0]}", limit_ratio)
-            # 郑商所
-            async with session.get(f'http://{czce_ip}/cn/DFSStaticFiles/Future/{day.year}/{day_str}/'
-                                   f'FutureDataClearParams.txt') as response:
-                rst = await response.text()
-                for lines in rst.split('\n')[2:]:
-                    if not lines:
-                        continue
-                    inst_data = [x.strip() for x in lines.split(
-                        '|' if '|' in lines else ',')]
-                    """
+                """
+                code = re.findall('[A-Za-z]+', inst_data[0])[0]
+                if code in IGNORE_INST_LIST:
+                    continue
+                limit_ratio = str_to_number(inst_data[5])
+                redis_client.set(
+                    f"LIMITRATIO:{ExchangeType.DCE}:{code}:{inst_data[0]}", limit_ratio)
+        # 郑商所
+        async with czce_pool.open('GET', f'/cn/DFSStaticFiles/Future/{day.year}/{day_str}/FutureDataClearParams.txt') \
+                as stream:
+            async for lines in iter_rows(LineRowParser(str, '\n', head=2, encoding=stream.encoding), stream.chunks):
+                if not lines:
+                    continue
+                inst_data = [x.strip() for x in lines.split(
+                    '|' if '|' in lines else ',')]
+                """
 [0合约代码,1当日结算价,2是否单边市,3连续单边市天数,4交易保证金率(%),5涨跌停板(%),6交易手续费,7交割手续费,8日内平今仓交易手续费,9日持仓限额]
 ['AP201','8,148.00','N','0','10','±9','5.00','0.00','20.00','200','']
-                    """
-                    code = re.findall('[A-Za-z]+', inst_data[0])[0]
-                    if code in IGNORE_INST_LIST:
-                        continue
-                    limit_ratio = str_to_number(inst_data[5][1:]) / 100
-                    redis_client.set(
-                        f"LIMITRATIO:{ExchangeType.CZCE}:{code}:{inst_data[0]}", limit_ratio)
-            # 中金所
-            async with session.get(f"http://{cffex_ip}/sj/jycs/{day.strftime('%Y%m/%d')}/index.xml") as response:
-                rst = await response.text()
-                max_conn_cffex.release()
-                tree = ET.fromstring(rst)
-                for inst_data in tree:
-                    """
-                    <INDEX>
-                    <TRADING_DAY>20211216</TRADING_DAY>
-                    <PRODUCT_ID>IC</PRODUCT_ID>
-                    <INSTRUMENT_ID>IC2112</INSTRUMENT_ID>
-                    <INSTRUMENT_MONTH>2112</INSTRUMENT_MONTH>
-                    <BASIS_PRICE>6072.8</BASIS_PRICE>
-                    <OPEN_DATE>20210419</OPEN_DATE>
-                    <END_TRADING_DAY>20211217</END_TRADING_DAY>
-                    <UPPER_VALUE>0.1</UPPER_VALUE>
-                    <LOWER_VALUE>0.1</LOWER_VALUE>
-                    <UPPERLIMITPRICE>8063.6</UPPERLIMITPRICE>
-                    <LOWERLIMITPRICE>6597.6</LOWERLIMITPRICE>
-                    <LONG_LIMIT>1200</LONG_LIMIT>
-                    </INDEX>
-                    """
-                    inst_id = inst_data.findtext('INSTRUMENT_ID').strip()
-                    # 不存储期权合约
-                    if len(inst_id) > 6:
-                        continue
-                    code = inst_data.findtext('PRODUCT_ID').strip()
-                    if code in IGNORE_INST_LIST:
-                        continue
-                    limit_ratio = str_to_number(
-                        inst_data.findtext('UPPER_VALUE').strip())
-                    redis_client.set(
-                        f"LIMITRATIO:{ExchangeType.CFFEX}:{code}:{inst_id}", limit_ratio)
-            # 保存数据
-            for inst in Instrument.objects.all():
-                ratio = redis_client.get(
-                    f"LIMITRATIO:{inst.exchange}:{inst.product_code}:{inst.main_code}")
-                if ratio:
-                    ratio = str_to_number(ratio)
-                    inst.up_limit_ratio = ratio
-                    inst.down_limit_ratio = ratio
-                    inst.save(update_fields=[
-                              'up_limit_ratio', 'down_limit_ratio'])
+                """
+                code = re.findall('[A-Za-z]+', inst_data[0])[0]
+                if code in IGNORE_INST_LIST:
+                    continue
+                limit_ratio = str_to_number(inst_data[5][1:]) / 100
+                redis_client.set(
+                    f"LIMITRATIO:{ExchangeType.CZCE}:{code}:{inst_data[0]}", limit_ratio)
+        # 中金所
+        async with cffex_pool.open('GET', f"/sj/jycs/{day.strftime('%Y%m/%d')}/index.xml") as stream:
+            async for inst_id, code, limit_ratio in iter_rows(
+                    XmlRowParser('INDEX', parse_cffex_argument, stream.encoding), stream.chunks):
+                redis_client.set(f"LIMITRATIO:{ExchangeType.CFFEX}:{code}:{inst_id}", limit_ratio)
+        # 保存数据
+        for inst in Instrument.objects.all():
+            ratio = redis_client.get(
+                f"LIMITRATIO:{inst.exchange}:{inst.product_code}:{inst.main_code}")
+            if ratio:
+                ratio = str_to_number(ratio)
+                inst.up_limit_ratio = ratio
+                inst.down_limit_ratio = ratio
+                inst.save(update_fields=[
+                          'up_limit_ratio', 'down_limit_ratio'])
         return True
     except Exception as e:
         logger.warning(
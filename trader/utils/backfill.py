@@ -0,0 +1,159 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import os
+import time
+import asyncio
+import datetime
+import logging
+from collections import defaultdict
+
+import ujson as json
+from tqdm import tqdm
+
+from trader.utils import update_from_shfe, update_from_dce, update_from_czce, update_from_cffex, trading_calendar
+from trader.utils.read_config import app_dir
+
+logger = logging.getLogger('Backfill')
+
+# 按交易日抓取历史日线的函数, 广期所的接口只能取到当天行情, 不参与回补
+FETCHERS = {
+    'shfe': update_from_shfe,
+    'dce': update_from_dce,
+    'czce': update_from_czce,
+    'cffex': update_from_cffex,
+}
+# 各交易所同时进行的任务数, 不超过对应连接池的上限
+DEFAULT_CONCURRENCY = {'shfe': 4, 'dce': 2, 'czce': 4, 'cffex': 4}
+
+
+class ExchangeStats(object):
+    __slots__ = ('planned', 'done', 'failed', 'retries', 'seconds')
+
+    def __init__(self):
+        self.planned = 0   # 本次计划的任务数(不含已完成的)
+        self.done = 0      # 成功的任务数
+        self.failed = 0    # 重试用完仍失败的任务数
+        self.retries = 0   # 重试次数
+        self.seconds = 0.  # 成功任务的累计耗时
+
+    def as_dict(self) -> dict:
+        result = {name: getattr(self, name) for name in self.__slots__}
+        result['avg_seconds'] = self.seconds / self.done if self.done else None
+        return result
+
+
+class Backfill(object):
+    """
+    历史日线回补: 按交易日历把 (交易所, 交易日) 拆成任务, 各交易所分别限制并发。
+    每完成一个任务就在状态文件(JSONL)中追加一行, 中断后重新运行时跳过已完成的任务
+    """
+    def __init__(self, state_path: str = None, concurrency: dict = None, retries: int = 3, backoff: float = 5):
+        self.state_path = state_path or os.path.join(app_dir.user_data_dir, 'backfill.jsonl')
+        self.concurrency = {**DEFAULT_CONCURRENCY, **(concurrency or {})}
+        self.retries = retries
+        self.backoff = backoff
+        self.stats = defaultdict(ExchangeStats)
+        self.started = None
+        self._state_file = None
+
+    def completed(self) -> set:
+        """
+        状态文件中已完成的 {(交易所, 'YYYYMMDD')}, 末尾不完整的行忽略
+        """
+        done = set()
+        try:
+            with open(self.state_path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record.get('ok'):
+                        done.add((record['exchange'], record['day']))
+        except FileNotFoundError:
+            pass
+        return done
+
+    async def plan(self, start: datetime.date, end: datetime.date, exchanges=None) -> list:
+        """
+        :return: 还没完成的 [(交易所, 交易日)], 按日期排序
+        """
+        exchanges = list(exchanges or FETCHERS)
+        await trading_calendar.ensure(start, end)
+        done = self.completed()
+        return [(exchange, day) for day in trading_calendar.trading_days(start, end) for exchange in exchanges
+                if (exchange, f'{day:%Y%m%d}') not in done]
+
+    def _record(self, exchange: str, day: datetime.date, ok: bool, seconds: float, attempts: int):
+        self._state_file.write(json.dumps({
+            'exchange': exchange, 'day': f'{day:%Y%m%d}', 'ok': ok, 'seconds': round(seconds, 3),
+            'attempts': attempts, 'at': datetime.datetime.now().isoformat(timespec='seconds')}) + '\n')
+        self._state_file.flush()
+
+    async def _run_unit(self, semaphore: asyncio.Semaphore, exchange: str, day: datetime.date, progress: tqdm):
+        stats = self.stats[exchange]
+        fetch = FETCHERS[exchange]
+        async with semaphore:
+            started = time.monotonic()
+            ok = False
+            attempt = 0
+            for attempt in range(1, self.retries + 2):
+                # update_from_xxx 内部捕获异常, 失败时返回False
+                ok = await fetch(datetime.datetime.combine(day, datetime.time()))
+                if ok:
+                    break
+                if attempt <= self.retries:
+                    stats.retries += 1
+                    await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            seconds = time.monotonic() - started
+        if ok:
+            stats.done += 1
+            stats.seconds += seconds
+        else:
+            stats.failed += 1
+            logger.warning(f'{exchange} {day} 回补失败, 已重试{self.retries}次')
+        self._record(exchange, day, ok, seconds, attempt)
+        progress.update(1)
+
+    async def run(self, start: datetime.date, end: datetime.date, exchanges=None) -> dict:
+        """
+        回补 [start, end] 期间(不晚于昨天)的日线
+        :param exchanges: 交易所列表, 默认为 FETCHERS 中的全部
+        :return: snapshot()
+        """
+        units = await self.plan(start, end, exchanges)
+        for exchange, _ in units:
+            self.stats[exchange].planned += 1
+        logger.info(f'回补 {start} 至 {end}: 共{len(units)}个任务')
+        semaphores = {exchange: asyncio.Semaphore(self.concurrency.get(exchange, 1)) for exchange in FETCHERS}
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        self.started = time.monotonic()
+        with open(self.state_path, 'a') as self._state_file, tqdm(total=len(units)) as progress:
+            await asyncio.gather(*[self._run_unit(semaphores[exchange], exchange, day, progress)
+                                   for exchange, day in units])
+        self._state_file = None
+        result = self.snapshot()
+        logger.info(f'回补完成: {result}')
+        return result
+
+    def snapshot(self) -> dict:
+        """
+        运行指标: 各交易所的任务计数和平均耗时, 以及总吞吐量(任务/秒)
+        """
+        elapsed = time.monotonic() - self.started if self.started is not None else 0
+        done = sum(stats.done for stats in self.stats.values())
+        return {'elapsed': round(elapsed, 1), 'throughput': round(done / elapsed, 3) if elapsed else None,
+                'exchanges': {exchange: stats.as_dict() for exchange, stats in self.stats.items()}}
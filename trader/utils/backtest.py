@@ -0,0 +1,96 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+from typing import NamedTuple
+
+import numpy as np
+
+ENTRY = 'entry'        # 开仓
+STOP = 'stop'          # 止损平仓
+ROLLOVER = 'rollover'  # 持仓期间主力合约换月
+MARK = 'mark'          # 回测结束时仍持仓, 按最后一根K线开盘价估值
+
+
+class Event(NamedTuple):
+    kind: str
+    index: int       # 成交所在的K线序号
+    trigger: int     # 触发信号的K线序号
+    direction: int   # 1: 多头, -1: 空头
+    price: float     # 成交价, 即 index 这根K线的开盘价
+    trade: int       # 所属交易的序号
+
+
+def breakout_signals(close: np.ndarray, short_trend: np.ndarray, long_trend: np.ndarray,
+                     high_line: np.ndarray, low_line: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    突破开仓信号: 短均线在长均线之上且收盘价(取整)不低于前一日的通道上轨 = 做多, 反之做空
+    :return: (做多信号, 做空信号), 布尔数组
+    """
+    prev_high = np.concatenate([[np.nan], high_line[:-1]])
+    prev_low = np.concatenate([[np.nan], low_line[:-1]])
+    trunc_close = np.trunc(close)
+    with np.errstate(invalid='ignore'):
+        long_sig = (short_trend > long_trend) & (trunc_close >= np.trunc(prev_high))
+        short_sig = (short_trend < long_trend) & (trunc_close < np.trunc(prev_low))
+    return long_sig, short_sig & ~long_sig
+
+
+def run_backtest(open_price: np.ndarray, high: np.ndarray, low: np.ndarray, close: np.ndarray, atr: np.ndarray,
+                 short_trend: np.ndarray, long_trend: np.ndarray, high_line: np.ndarray, low_line: np.ndarray,
+                 stop_n: float, start: int, code: np.ndarray = None, mark_last: bool = False) -> list[Event]:
+    """
+    突破策略的整段历史回测, 只处理数组, 不访问数据库。
+    第i根K线收盘后产生信号, 第i+1根K线开盘价成交; 持仓后以开仓以来的最高价(最低价)回撤 stop_n 倍开仓时ATR止损。
+    空仓时用信号数组直接定位下一次开仓, 持仓时用累计最大(最小)值一次算出止损位置
+    :param start: 第一根可以成交的K线序号
+    :param code: 每根K线对应的合约代码, 提供时记录持仓期间的换月
+    :param mark_last: 最后一根K线仍持仓时是否记录估值事件
+    :return: 按时间顺序的事件列表
+    """
+    n = close.shape[0]
+    long_sig, short_sig = breakout_signals(close, short_trend, long_trend, high_line, low_line)
+    entry_sig = long_sig | short_sig
+    events = list()
+    trade = 0
+    cur = max(start, 1)
+    while cur < n:
+        hits = np.flatnonzero(entry_sig[cur - 1:n - 1])
+        if hits.size == 0:
+            break
+        trigger = int(cur - 1 + hits[0])
+        entry = trigger + 1
+        direction = 1 if long_sig[trigger] else -1
+        events.append(Event(ENTRY, entry, trigger, direction, float(open_price[entry]), trade))
+        # 第i根K线 (i >= entry+1) 的止损线由 entry..i-1 的最高价(最低价)决定
+        with np.errstate(invalid='ignore'):
+            if direction > 0:
+                extreme = np.maximum.accumulate(high[entry:n - 2])
+                stop = close[entry + 1:n - 1] <= extreme - atr[entry - 1] * stop_n
+            else:
+                extreme = np.minimum.accumulate(low[entry:n - 2])
+                stop = close[entry + 1:n - 1] >= extreme + atr[entry - 1] * stop_n
+        hits = np.flatnonzero(stop)
+        exit_index = int(entry + 2 + hits[0]) if hits.size else n - 1
+        if code is not None:
+            for index in np.flatnonzero(code[entry + 1:exit_index + 1] != code[entry:exit_index]) + entry + 1:
+                events.append(Event(ROLLOVER, int(index), int(index) - 1, direction, float(open_price[index]), trade))
+        if hits.size == 0:
+            if mark_last:
+                events.append(Event(MARK, n - 1, n - 1, direction, float(open_price[n - 1]), trade))
+            break
+        events.append(Event(STOP, exit_index, exit_index - 1, direction, float(open_price[exit_index]), trade))
+        trade += 1
+        cur = exit_index + 1
+    return events
@@ -0,0 +1,225 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import re
+import datetime
+
+from trader.utils.tick import TickBar
+
+DAY = 0       # 交易日K线(夜盘+日盘)的周期
+SESSION = -1  # 交易时段K线的周期, 每个连续交易时段(见 trading_sessions)一根
+
+# 交易时段, 以分钟表示; 夜盘过了零点的部分加 1440, 使一个交易日内的分钟数单调递增
+DAY_SESSIONS = ((540, 615), (630, 690), (810, 900))              # 09:00-10:15 10:30-11:30 13:30-15:00
+INDEX_SESSIONS = ((570, 690), (780, 900))                        # 股指: 09:30-11:30 13:00-15:00
+BOND_SESSIONS = ((570, 690), (780, 915))                         # 国债: 09:30-11:30 13:00-15:15
+NIGHT_START = 1260                                               # 21:00
+NIGHT_END = {
+    **{code: 1500 for code in ('cu', 'al', 'zn', 'pb', 'ni', 'sn', 'ss', 'bc', 'ao')},  # 01:00
+    **{code: 1590 for code in ('au', 'ag', 'sc')},                                      # 02:30
+}
+NIGHT_DEFAULT_END = 1380                                         # 23:00
+INDEX_PRODUCTS = {'IF', 'IC', 'IH', 'IM'}
+BOND_PRODUCTS = {'T', 'TF', 'TS', 'TL'}
+# 没有夜盘的品种
+DAY_ONLY_PRODUCTS = {'jd', 'lh', 'bb', 'fb', 'wr', 'ec', 'AP', 'CJ', 'PK', 'UR', 'JR', 'LR', 'RI', 'RS', 'WH', 'PM',
+                     'si', 'lc', 'ps'} | INDEX_PRODUCTS | BOND_PRODUCTS
+AUCTION_MINUTES = 5  # 开盘前集合竞价的行情并入开盘后的第一根K线
+
+_re_product = re.compile(r'([a-zA-Z]+)')
+
+
+def trading_sessions(product_code: str) -> tuple:
+    """
+    品种的交易时段 ((开始分钟, 结束分钟), ...), 按一个交易日内的时间顺序, 夜盘在前
+    """
+    if product_code in INDEX_PRODUCTS:
+        return INDEX_SESSIONS
+    if product_code in BOND_PRODUCTS:
+        return BOND_SESSIONS
+    if product_code in DAY_ONLY_PRODUCTS:
+        return DAY_SESSIONS
+    return ((NIGHT_START, NIGHT_END.get(product_code, NIGHT_DEFAULT_END)), ) + DAY_SESSIONS
+
+
+def session_minute(time: datetime.datetime) -> int:
+    """
+    行情时间在交易日内的分钟数, 凌晨的夜盘加 1440
+    """
+    minute = time.hour * 60 + time.minute
+    return minute + 1440 if minute < 300 else minute
+
+
+def trading_day_of(time: datetime.datetime) -> datetime.date:
+    """
+    行情所属的交易日: 夜盘属于下一个工作日。长假前没有夜盘, 所以不需要查询交易日历
+    """
+    day = time.date()
+    if time.hour >= 18:
+        day += datetime.timedelta(days=1)
+    elif time.hour >= 5:
+        return day
+    while day.weekday() >= 5:
+        day += datetime.timedelta(days=1)
+    return day
+
+
+class Bar(object):
+    __slots__ = ('instrument', 'period', 'trading_day', 'time', 'end', 'key', 'open', 'high', 'low', 'close',
+                 'volume', 'open_interest')
+
+    def __init__(self, instrument: str, period: int, trading_day: datetime.date, time: datetime.datetime,
+                 end: datetime.datetime, key: tuple, price: float, volume: int, open_interest: float):
+        self.instrument = instrument
+        self.period = period
+        self.trading_day = trading_day
+        self.time = time                 # K线开始时间
+        self.end = end                   # 到这个时间还没有新行情时由 close_due 结束
+        self.key = key
+        self.open = self.high = self.low = self.close = price
+        self.volume = volume
+        self.open_interest = open_interest
+
+    def __repr__(self):
+        return f'Bar({self.instrument} {self.period} {self.time} o={self.open} h={self.high} l={self.low} ' \
+               f'c={self.close} v={self.volume})'
+
+
+class _InstrumentState(object):
+    __slots__ = ('sessions', 'day_end', 'trading_day', 'last_volume', 'bars', 'closed')
+
+    def __init__(self, sessions: tuple):
+        self.sessions = sessions
+        self.day_end = sessions[-1][1]
+        self.trading_day = None
+        self.last_volume = 0
+        self.bars = dict()  # {周期: 正在生成的Bar}
+        self.closed = dict()  # {周期: 最后一根已结束K线的key}
+
+
+class BarAggregator(object):
+    """
+    由逐笔行情实时合成K线, 分钟K线按整点对齐(例如15分钟线为 09:00, 09:15, ..., 10:00),
+    跨越休市时段的K线不会出现。交易时段K线从时段开始到时段结束, 例如螺纹钢一个交易日有
+    21:00-23:00, 09:00-10:15, 10:30-11:30, 13:30-15:00 四根。交易时段外的行情丢弃,
+    开盘前的集合竞价行情并入第一根K线, 收盘时刻(例如 15:00:00)的行情并入最后一根K线。K线结束后才到达的属于它的行情(时钟偏差)丢弃,
+    以免生成同一时间的K线覆盖已写入的完整K线。完成的K线放入 completed, 由调用方定期取走并批量写入
+    """
+    def __init__(self, periods: tuple = (1, 5, 15, SESSION, DAY)):
+        self.periods = periods
+        self.completed = list()
+        self._states = dict()
+
+    def _state(self, instrument: str) -> _InstrumentState:
+        state = self._states.get(instrument)
+        if state is None:
+            state = self._states[instrument] = _InstrumentState(
+                trading_sessions(_re_product.match(instrument).group(1)))
+        return state
+
+    @staticmethod
+    def _locate(sessions: tuple, minute: int, second: int):
+        """
+        :return: 行情所在的分钟(已按集合竞价和收盘时刻调整), 不在交易时段内为None
+        """
+        for start, end in sessions:
+            if start <= minute < end:
+                return minute
+            if minute == end and second == 0:
+                return end - 1
+            if start - AUCTION_MINUTES <= minute < start:
+                return start
+        return None
+
+    def update(self, tick: TickBar) -> bool:
+        """
+        :param tick: volume 为当日累计成交量的行情
+        :return: 行情是否在交易时段内
+        """
+        state = self._state(tick.instrument)
+        time = tick.dateTime
+        minute = session_minute(time)
+        located = self._locate(state.sessions, minute, time.second)
+        if located is None:
+            return False
+        trading_day = trading_day_of(time)
+        if trading_day != state.trading_day:
+            state.trading_day = trading_day
+            state.last_volume = 0
+        volume = max(tick.volume - state.last_volume, 0)
+        state.last_volume = max(tick.volume, state.last_volume)
+        price = tick.price
+        base = time.replace(second=0, microsecond=0) - datetime.timedelta(minutes=minute - located)
+        session = next(i for i, (start, end) in enumerate(state.sessions) if start <= located < end)
+        for period in self.periods:
+            if period == DAY:
+                key = (trading_day, )
+            elif period == SESSION:
+                key = (trading_day, session)
+            else:
+                key = (trading_day, located - located % period)
+            bar = state.bars.get(period)
+            if key <= state.closed.get(period, ()) or bar is not None and key < bar.key:
+                continue
+            if bar is not None and bar.key == key:
+                if price > bar.high:
+                    bar.high = price
+                if price < bar.low:
+                    bar.low = price
+                bar.close = price
+                bar.volume += volume
+                bar.open_interest = tick.holding
+                continue
+            if bar is not None:
+                self.completed.append(bar)
+                state.closed[period] = bar.key
+            if period == DAY:
+                start = base
+                end = datetime.datetime.combine(trading_day, datetime.time()) + \
+                    datetime.timedelta(minutes=state.day_end)
+            elif period == SESSION:
+                session_start, session_end = state.sessions[session]
+                start = base - datetime.timedelta(minutes=located - session_start)
+                end = start + datetime.timedelta(minutes=session_end - session_start)
+            else:
+                start = base - datetime.timedelta(minutes=located % period)
+                end = start + datetime.timedelta(minutes=period)
+            state.bars[period] = Bar(tick.instrument, period, trading_day, start, end, key, price, volume,
+                                     tick.holding)
+        return True
+
+    def close_due(self, now: datetime.datetime, delay: float = 5) -> int:
+        """
+        结束已经到期的K线, 用于休市和收盘后没有新行情的情况
+        :param now: 当前时间(与行情时间同为本地时间, 不带时区)
+        :param delay: 到期后再等待的秒数, 等待迟到的行情
+        :return: 结束的K线数量
+        """
+        deadline = now - datetime.timedelta(seconds=delay)
+        count = 0
+        for state in self._states.values():
+            for period, bar in list(state.bars.items()):
+                if bar.end <= deadline:
+                    self.completed.append(state.bars.pop(period))
+                    state.closed[period] = bar.key
+                    count += 1
+        return count
+
+    def drain(self) -> list:
+        """
+        取走全部已完成的K线
+        """
+        completed, self.completed = self.completed, list()
+        return completed
@@ -0,0 +1,173 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import os
+import logging
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+from django.db.models import Max, Count
+
+from panel.models import MainBar
+from trader.utils.read_config import app_dir
+
+logger = logging.getLogger('BarStore')
+
+MAIN_COLUMNS = ('open', 'high', 'low', 'close', 'settlement', 'volume', 'open_interest', 'basis')
+
+
+class Bars(object):
+    """
+    一个品种的K线, 按日期升序: time 为 datetime64[D], code 为合约代码,
+    values 为列优先的 float64 矩阵, 每一列在内存中连续, 可以直接交给 numpy/talib 计算
+    """
+    __slots__ = ('time', 'code', 'values', 'columns')
+
+    def __init__(self, time: np.ndarray, code: np.ndarray, values: np.ndarray, columns: tuple):
+        self.time = time
+        self.code = code
+        self.values = values
+        self.columns = columns
+
+    def __len__(self):
+        return self.time.shape[0]
+
+    def __getitem__(self, column: str) -> np.ndarray:
+        return self.values[:, self.columns.index(column)]
+
+    def until(self, day) -> 'Bars':
+        """
+        截至day(含)的K线, 不复制数据
+        """
+        end = np.searchsorted(self.time, np.datetime64(day, 'D'), side='right')
+        return Bars(self.time[:end], self.code[:end], self.values[:end], self.columns)
+
+    def tail(self, count: int) -> 'Bars':
+        start = max(len(self) - count, 0)
+        return Bars(self.time[start:], self.code[start:], self.values[start:], self.columns)
+
+    def to_frame(self) -> pd.DataFrame:
+        df = pd.DataFrame(np.array(self.values), columns=list(self.columns),
+                          index=pd.DatetimeIndex(self.time.astype('datetime64[ns]'), name='time'))
+        df.insert(0, 'code', self.code)
+        return df
+
+    @classmethod
+    def from_rows(cls, rows: list, columns: tuple) -> 'Bars':
+        """
+        :param rows: [(time, code, *columns)], 按日期升序
+        """
+        time = np.array([row[0] for row in rows], dtype='datetime64[D]')
+        code = np.array([row[1] for row in rows], dtype='U16')
+        values = np.array([row[2:] for row in rows], dtype=np.float64, order='F').reshape(len(rows), len(columns))
+        return cls(time, code, np.asfortranarray(values), columns)
+
+
+class BarStore(object):
+    """
+    本地列式K线缓存: 每个品种三个 .npy 文件(日期/合约代码/价格矩阵), 读取时内存映射, 不解析也不复制。
+    数据库仍是唯一的数据来源, 缓存缺失或与数据库不一致时从数据库整体重建, 写入先写临时文件再替换
+    """
+    def __init__(self, root: str = None):
+        self.root = root or os.path.join(app_dir.user_cache_dir, 'bars')
+
+    def _path(self, kind: str, key: str, part: str) -> str:
+        return os.path.join(self.root, kind, f'{key}.{part}.npy')
+
+    def read(self, kind: str, key: str, columns: tuple):
+        try:
+            values = np.load(self._path(kind, key, 'values'), mmap_mode='r')
+            code = np.load(self._path(kind, key, 'code'), mmap_mode='r')
+            time = np.load(self._path(kind, key, 'time'), mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        # 写到一半或列不匹配的文件视为缺失
+        if values.ndim != 2 or values.shape[1] != len(columns) or not values.shape[0] == code.shape[0] == time.shape[0]:
+            return None
+        return Bars(time, code, values, columns)
+
+    def write(self, kind: str, key: str, bars: Bars):
+        os.makedirs(os.path.join(self.root, kind), exist_ok=True)
+        try:
+            # 日期最后写入, 读到的三个文件长度不一致时会被当作缺失
+            for part, array in (('values', np.asfortranarray(bars.values)), ('code', bars.code), ('time', bars.time)):
+                path = self._path(kind, key, part)
+                tmp_path = f'{path}.{os.getpid()}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, array)
+                os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f'BarStore 写入 {kind}/{key} 失败: {repr(e)}')
+            self.invalidate(kind, [key])
+
+    def invalidate(self, kind: str, keys):
+        for key in keys:
+            for part in ('time', 'code', 'values'):
+                try:
+                    os.remove(self._path(kind, key, part))
+                except OSError:
+                    pass
+
+    def merge_main(self, product_code: str, rows: list):
+        """
+        把新生成的主力连续K线合并进缓存, 同一天的K线以新的为准; 缓存不存在时不做处理, 下次读取时重建
+        :param rows: [(time, code, *MAIN_COLUMNS)]
+        """
+        old = self.read('main', product_code, MAIN_COLUMNS)
+        if old is None or not rows:
+            return
+        new = Bars.from_rows(sorted(rows, key=lambda row: row[0]), MAIN_COLUMNS)
+        keep = ~np.isin(old.time, new.time)
+        time = np.concatenate([old.time[keep], new.time])
+        order = np.argsort(time, kind='stable')
+        self.write('main', product_code, Bars(
+            time[order], np.concatenate([old.code[keep], new.code])[order],
+            np.asfortranarray(np.concatenate([old.values[keep], new.values])[order]), MAIN_COLUMNS))
+
+    def rebuild_main(self, product_codes) -> dict:
+        """
+        从数据库一次读出多个品种的主力连续K线并写入缓存
+        """
+        row_dict = defaultdict(list)
+        for row in MainBar.objects.filter(product_code__in=list(product_codes)).order_by('time').values_list(
+                'product_code', 'time', 'code', *MAIN_COLUMNS).iterator(chunk_size=10000):
+            row_dict[row[0]].append(tuple(np.nan if x is None else x for x in row[1:]))
+        bars_dict = dict()
+        for code, rows in row_dict.items():
+            bars_dict[code] = Bars.from_rows(rows, MAIN_COLUMNS)
+            self.write('main', code, bars_dict[code])
+        return bars_dict
+
+    def load_main(self, product_codes) -> dict:
+        """
+        读取多个品种的主力连续K线, 用一次聚合查询核对各品种的K线数量和最后日期, 不一致的品种从数据库重建
+        :return: {品种代码: Bars}
+        """
+        bars_dict = dict()
+        stale = list()
+        for row in MainBar.objects.filter(product_code__in=list(product_codes)).values('product_code').annotate(
+                last=Max('time'), count=Count('id')):
+            bars = self.read('main', row['product_code'], MAIN_COLUMNS)
+            if bars is None or len(bars) != row['count'] or bars.time[-1] != np.datetime64(row['last'], 'D'):
+                stale.append(row['product_code'])
+            else:
+                bars_dict[row['product_code']] = bars
+        if stale:
+            bars_dict.update(self.rebuild_main(stale))
+        return bars_dict
+
+
+bar_store = BarStore()
@@ -0,0 +1,192 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import os
+import datetime
+import logging
+
+import numpy as np
+import pandas as pd
+
+from trader.utils.bars import bar_store, Bars
+from trader.utils.read_config import app_dir
+
+logger = logging.getLogger('CorrelationService')
+
+SUMS = ('n', 'sx', 'sxx', 'sxy')
+
+
+def daily_returns(bars: Bars) -> tuple:
+    """
+    主力连续的日收益率: 换月当天用前一日收盘价加上基差(即折算到新合约)作为分母,
+    只用原始价格计算, 以后再换月也不会改变已经算过的收益率
+    :return: (日期, 收益率)
+    """
+    close = np.asarray(bars['close'])
+    basis = np.nan_to_num(np.asarray(bars['basis'][1:]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = close[1:] / (close[:-1] + basis) - 1
+    return bars.time[1:], returns
+
+
+class CorrelationService(object):
+    """
+    品种间日收益率的滚动相关系数(默认最近3年)。
+    对每一对品种保存共同交易日数量、收益率之和、平方和与乘积和, 新增一天或移出窗口的一天都是 O(品种数²) 的更新,
+    状态保存在本地 npz 文件中, 读取相关系数不需要查询数据库
+    """
+    def __init__(self, path: str = None, years: int = 3):
+        self.path = path or os.path.join(app_dir.user_cache_dir, 'correlation.npz')
+        self.years = years
+        self._mtime = None
+        self._reset(list())
+
+    def _reset(self, codes: list):
+        size = len(codes)
+        self.codes = list(codes)
+        self.dates = np.array([], dtype='datetime64[D]')
+        self.returns = np.empty((0, size))
+        for name in SUMS:
+            setattr(self, name, np.zeros((size, size)))
+
+    def _accumulate(self, returns: np.ndarray, sign: int):
+        """
+        把若干天的收益率(天数 x 品种, 缺失为NaN)加入(sign=1)或移出(sign=-1)累计量, 只统计两个品种都有数据的日子
+        """
+        mask = (~np.isnan(returns)).astype(np.float64)
+        value = np.nan_to_num(returns)
+        self.n += sign * (mask.T @ mask)
+        self.sx += sign * (value.T @ mask)
+        self.sxx += sign * ((value ** 2).T @ mask)
+        self.sxy += sign * (value.T @ value)
+
+    def load(self):
+        """
+        文件被其他进程更新过时重新读取
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with np.load(self.path) as data:
+                self.codes = data['codes'].tolist()
+                self.dates = data['dates']
+                self.returns = data['returns']
+                for name in SUMS:
+                    setattr(self, name, data[name])
+            self._mtime = mtime
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f'读取 {self.path} 失败: {repr(e)}')
+            self._reset(list())
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, codes=np.array(self.codes, dtype=str), dates=self.dates, returns=self.returns,
+                         **{name: getattr(self, name) for name in SUMS})
+            os.replace(tmp_path, self.path)
+            self._mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            logger.warning(f'CorrelationService 写入 {self.path} 失败: {repr(e)}')
+
+    def window_begin(self, day: datetime.date) -> np.datetime64:
+        """
+        窗口起点: years 年前的同一天, 闰日取前一天(2月28日)
+        """
+        if day.month == 2 and day.day == 29:
+            day = day.replace(day=28)
+        return np.datetime64(day.replace(year=day.year - self.years), 'D')
+
+    @staticmethod
+    def _block(series: list, dates: np.ndarray) -> np.ndarray:
+        """
+        各品种在 dates 这些日子的收益率, 没有K线的位置为NaN
+        """
+        block = np.full((dates.shape[0], len(series)), np.nan)
+        for col, (times, returns) in enumerate(series):
+            index = np.searchsorted(dates, times)
+            found = index < dates.shape[0]
+            found[found] &= dates[index[found]] == times[found]
+            block[index[found], col] = returns[found]
+        return block
+
+    def update(self, day: datetime.date, product_codes) -> bool:
+        """
+        把截至 day 的新交易日加入窗口, 移出窗口开始之前的交易日后保存。
+        品种列表变化, 或已保存的数据与K线缓存不一致(例如补录了历史K线)时整体重算
+        :return: 是否整体重算
+        """
+        if isinstance(day, datetime.datetime):
+            day = day.date()
+        product_codes = list(product_codes)
+        self.load()
+        if len(product_codes) == len(self.codes) and set(product_codes) == set(self.codes):
+            # 品种相同只是顺序不同时沿用已保存的顺序, corr() 按品种代码取数据
+            product_codes = list(self.codes)
+        bars_dict = bar_store.load_main(product_codes)
+        series = [daily_returns(bars_dict[code]) if code in bars_dict else
+                  (np.array([], dtype='datetime64[D]'), np.array([])) for code in product_codes]
+        end, begin = np.datetime64(day, 'D'), self.window_begin(day)
+        rebuild = self.codes != product_codes or self.dates.shape[0] == 0 or self.dates[-1] > end
+        if not rebuild:
+            first, last = self.dates[0], self.dates[-1]
+            counts = [np.count_nonzero((times >= first) & (times <= last)) for times, _ in series]
+            rebuild = not np.array_equal(counts, np.diagonal(self.n))
+        if rebuild:
+            self._reset(product_codes)
+            last = begin - 1
+        else:
+            last = self.dates[-1]
+        new_dates = np.unique(np.concatenate([times[(times > last) & (times >= begin) & (times <= end)]
+                                              for times, _ in series] + [self.dates[:0]]))
+        if new_dates.shape[0]:
+            block = self._block(series, new_dates)
+            self._accumulate(block, 1)
+            self.dates = np.concatenate([self.dates, new_dates])
+            self.returns = np.concatenate([self.returns, block])
+        expired = np.searchsorted(self.dates, begin)
+        if expired:
+            self._accumulate(self.returns[:expired], -1)
+            self.dates = self.dates[expired:]
+            self.returns = self.returns[expired:]
+        if rebuild or new_dates.shape[0] or expired:
+            self.save()
+        return rebuild
+
+    def corr(self, product_codes=None) -> pd.DataFrame:
+        """
+        :param product_codes: 只取这些品种, None为全部
+        :return: 相关系数矩阵, 与 DataFrame.corr() 相同, 共同交易日少于2天的为NaN
+        """
+        self.load()
+        index = list(range(len(self.codes))) if product_codes is None else \
+            [self.codes.index(code) for code in product_codes]
+        grid = np.ix_(index, index)
+        n, sx, sxx, sxy = (getattr(self, name)[grid] for name in SUMS)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cov = n * sxy - sx * sx.T
+            var = n * sxx - sx ** 2
+            result = cov / np.sqrt(var * var.T)
+        result[n < 2] = np.nan
+        codes = [self.codes[i] for i in index]
+        return pd.DataFrame(np.clip(result, -1, 1), index=codes, columns=codes)
+
+
+correlation_service = CorrelationService()
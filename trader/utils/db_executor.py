@@ -0,0 +1,109 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import asyncio
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+
+import django
+from django.db import close_old_connections
+
+
+def _call_with_connection(func, *args, **kwargs):
+    # Django 的数据库连接按线程保存, 执行前后关闭超时或出错的连接, 其余连接留给该线程下次使用
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+def _init_process():
+    # spawn 出的子进程重新导入模块, trader.utils 依赖已初始化的 Django
+    django.setup()
+
+
+class DBExecutor(object):
+    """
+    在专用线程池中执行 Django ORM 操作, 不阻塞事件循环, 每个工作线程使用自己的数据库连接。
+    CPU 密集的计算交给进程池, 进程池在第一次使用时创建。主进程中有事件循环、数据库线程和 redis 连接,
+    fork 可能把其他线程持有的锁带进子进程, 所以子进程用 spawn 启动; 启动和传递数据都有开销, 只适合大计算量的任务
+    """
+    def __init__(self, max_workers: int = 4, cpu_workers: int = None):
+        self.max_workers = max_workers
+        self.cpu_workers = cpu_workers
+        self._threads = None
+        self._processes = None
+
+    def _thread_pool(self) -> ThreadPoolExecutor:
+        if self._threads is None:
+            self._threads = ThreadPoolExecutor(self.max_workers, thread_name_prefix='DB')
+        return self._threads
+
+    def _process_pool(self) -> ProcessPoolExecutor:
+        if self._processes is None:
+            self._processes = ProcessPoolExecutor(self.cpu_workers, mp_context=multiprocessing.get_context('spawn'),
+                                                  initializer=_init_process)
+        return self._processes
+
+    def submit(self, func, *args, **kwargs) -> Future:
+        return self._thread_pool().submit(_call_with_connection, func, *args, **kwargs)
+
+    async def run(self, func, *args, **kwargs):
+        """
+        在数据库线程中执行同步函数, 例如 await db.run(Instrument.objects.get, product_code='rb')
+        """
+        return await asyncio.wrap_future(self.submit(func, *args, **kwargs))
+
+    async def get(self, model, **kwargs):
+        return await self.run(model.objects.get, **kwargs)
+
+    async def first(self, queryset):
+        return await self.run(queryset.first)
+
+    async def all(self, queryset) -> list:
+        return await self.run(list, queryset)
+
+    async def save(self, obj, **kwargs):
+        return await self.run(obj.save, **kwargs)
+
+    async def create(self, model, **kwargs):
+        return await self.run(model.objects.create, **kwargs)
+
+    async def update_or_create(self, model, defaults: dict = None, **kwargs):
+        return await self.run(model.objects.update_or_create, defaults=defaults, **kwargs)
+
+    async def bulk_update(self, model, objs: list, fields: list):
+        return await self.run(model.objects.bulk_update, objs, fields)
+
+    async def run_cpu(self, func, *args):
+        """
+        在进程池中执行, func 和参数都要能被 pickle
+        """
+        return await asyncio.wrap_future(self._process_pool().submit(func, *args))
+
+    def cpu(self, func, *args):
+        """
+        run_cpu 的同步版本, 供已经在数据库线程中执行的函数使用
+        """
+        return self._process_pool().submit(func, *args).result()
+
+    def shutdown(self, wait: bool = True):
+        if self._threads is not None:
+            self._threads.shutdown(wait)
+            self._threads = None
+        if self._processes is not None:
+            self._processes.shutdown(wait)
+            self._processes = None
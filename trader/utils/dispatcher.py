@@ -0,0 +1,161 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import asyncio
+import logging
+from collections import deque, defaultdict
+from typing import NamedTuple, Callable
+
+logger = logging.getLogger('ChannelDispatcher')
+
+QUEUE = 'queue'    # 逐条处理, 从不丢弃
+LATEST = 'latest'  # 处理不过来时只保留最新的一条, 用于行情
+
+SERIAL_CHANNEL = 'channel'  # 同一频道(例如同一合约的行情)的消息依次处理
+SERIAL_PATTERN = 'pattern'  # 同一订阅模式下的全部消息依次处理
+
+
+class Route(NamedTuple):
+    pattern: str
+    handler: Callable
+    policy: str
+    serial: str
+    capture: Callable
+
+
+class ChannelStats(object):
+    __slots__ = ('received', 'handled', 'coalesced', 'errors', 'dropped', 'max_depth')
+
+    def __init__(self):
+        self.received = 0   # 收到的消息数
+        self.handled = 0    # 处理完的消息数
+        self.coalesced = 0  # 被更新的消息替换掉的消息数
+        self.errors = 0     # 回调抛出异常的次数
+        self.dropped = 0    # 无法解码或分发而丢弃的消息数
+        self.max_depth = 0  # 单个队列的最大积压
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class ChannelDispatcher(object):
+    """
+    订阅消息的分发: 按频道(或订阅模式、指定的分组)建立串行队列, 保证同一队列内的消息按到达顺序处理;
+    所有回调共用一个并发上限。LATEST 策略的队列积压时只保留最新一条; QUEUE 策略的消息从不丢弃,
+    积压总数超过 max_pending 时 dispatch() 等待处理, 由 redis 缓存后续消息
+    """
+    def __init__(self, concurrency: int = 64, max_pending: int = 10000):
+        self.max_pending = max_pending
+        self.pending = 0  # QUEUE 策略积压的消息数
+        self.stats = defaultdict(ChannelStats)
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._routes = dict()
+        self._queues = dict()   # {队列键: deque}
+        self._workers = dict()  # {队列键: Task}
+        self._has_room = asyncio.Event()
+        self._has_room.set()
+
+    def add_route(self, pattern: str, handler: Callable, policy: str = QUEUE, serial: str = SERIAL_CHANNEL,
+                  capture: Callable = None):
+        """
+        :param handler: async def handler(channel, data)
+        :param policy: QUEUE 或 LATEST
+        :param serial: SERIAL_CHANNEL, SERIAL_PATTERN, 或任意分组名(同名分组的消息共用一个队列)
+        :param capture: 可选的同步函数 capture(channel, data), 每条消息到达时立即调用, 不受 LATEST 合并影响
+        """
+        self._routes[pattern] = Route(pattern, handler, policy, serial, capture)
+
+    def _queue_key(self, route: Route, channel: str) -> str:
+        if route.serial == SERIAL_CHANNEL:
+            return channel
+        if route.serial == SERIAL_PATTERN:
+            return route.pattern
+        return route.serial
+
+    async def dispatch(self, pattern: str, channel: str, data):
+        route = self._routes[pattern]
+        stats = self.stats[pattern]
+        stats.received += 1
+        if route.capture is not None:
+            try:
+                route.capture(channel, data)
+            except Exception as e:
+                stats.errors += 1
+                logger.warning(f'{pattern} capture 发生错误: {repr(e)}', exc_info=True)
+        key = self._queue_key(route, channel)
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+        if route.policy == LATEST:
+            # 同一队列中还没处理的旧行情直接替换
+            if queue:
+                stats.coalesced += len(queue)
+                queue.clear()
+        else:
+            self.pending += 1
+        queue.append((route, channel, data))
+        if len(queue) > stats.max_depth:
+            stats.max_depth = len(queue)
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._work(key, queue))
+        if self.pending >= self.max_pending:
+            self._has_room.clear()
+            logger.warning(f'消息积压{self.pending}条, 暂停读取')
+            await self._has_room.wait()
+
+    async def _work(self, key: str, queue: deque):
+        try:
+            while queue:
+                route, channel, data = queue.popleft()
+                if route.policy != LATEST:
+                    self.pending -= 1
+                    if not self._has_room.is_set() and self.pending <= self.max_pending // 2:
+                        self._has_room.set()
+                stats = self.stats[route.pattern]
+                async with self._semaphore:
+                    try:
+                        await route.handler(channel, data)
+                        stats.handled += 1
+                    except Exception as e:
+                        stats.errors += 1
+                        logger.warning(f'{channel} 回调发生错误: {repr(e)}', exc_info=True)
+        finally:
+            del self._workers[key]
+            if not queue:
+                del self._queues[key]
+
+    def depths(self) -> dict:
+        """
+        各队列当前积压的消息数, 只包含有积压的队列
+        """
+        return {key: len(queue) for key, queue in self._queues.items() if queue}
+
+    def snapshot(self) -> dict:
+        """
+        运行指标: 各订阅模式的累计计数, 以及当前的积压总数和活动队列数
+        """
+        return {'pending': self.pending, 'active': len(self._workers),
+                'channels': {pattern: stats.as_dict() for pattern, stats in self.stats.items()}}
+
+    async def join(self):
+        """
+        等待全部队列处理完
+        """
+        while self._workers:
+            await asyncio.gather(*list(self._workers.values()), return_exceptions=True)
+
+    def cancel(self):
+        for task in list(self._workers.values()):
+            task.cancel()
@@ -0,0 +1,159 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import asyncio
+import threading
+import logging
+from contextlib import asynccontextmanager
+from typing import NamedTuple, AsyncIterator
+
+import aiohttp
+import ujson as json
+
+logger = logging.getLogger('HttpPool')
+
+RETRY_STATUS = (500, 502, 503, 504)
+
+
+class HttpResult(NamedTuple):
+    status: int
+    body: bytes
+    encoding: str
+    headers: dict = None
+
+    def text(self) -> str:
+        return self.body.decode(self.encoding or 'utf-8')
+
+    def json(self):
+        return json.loads(self.body)
+
+
+class HttpStream(NamedTuple):
+    status: int
+    encoding: str  # 响应头中声明的编码, 没有声明时为None
+    headers: dict
+    chunks: AsyncIterator[bytes]
+
+
+class HttpPool(object):
+    """
+    单个交易所网站的长连接池: 进程内共用一个ClientSession(keep-alive),
+    由连接器限制同时连接数, 请求超时或服务器5xx错误时按指数退避重试。
+    超时只限制建立连接和两次收到数据的间隔, 不包括排队等待空闲连接和读取大文件的总时间
+    """
+    def __init__(self, host: str, limit: int = 15, timeout: float = 30, retries: int = 3, backoff: float = 1,
+                 connect_timeout: float = 10):
+        self.host = host
+        self.limit = limit
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._session = None
+        self._loop = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            # ClientSession 绑定创建时的事件循环, 换了循环(例如脚本多次 run_until_complete)需要重建
+            self._detach()
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                connector=connector, timeout=aiohttp.ClientTimeout(
+                    total=None, sock_connect=self.connect_timeout, sock_read=self.timeout))
+            self._loop = loop
+        return self._session
+
+    def _detach(self):
+        """
+        关闭旧循环上的 session, 它的连接只能在旧循环中关闭
+        """
+        session, loop, self._session = self._session, self._loop, None
+        if session is None or session.closed:
+            return
+        if loop.is_running():
+            # 旧循环还在其他线程中运行
+            asyncio.run_coroutine_threadsafe(session.close(), loop)
+        elif not loop.is_closed():
+            # 旧循环已停止(例如上一次 run_until_complete 结束), 当前线程正在运行新循环, 借用一个线程在旧循环上关闭
+            closer = threading.Thread(target=loop.run_until_complete, args=(session.close(), ), daemon=True)
+            closer.start()
+            closer.join(self.connect_timeout)
+        else:
+            # 旧循环已经关闭(例如 asyncio.run 结束), 连接无法正常关闭, 只能丢弃等待回收
+            session.detach()
+
+    def url(self, path: str) -> str:
+        return f'http://{self.host}{path}'
+
+    async def request(self, method: str, path: str, **kwargs) -> HttpResult:
+        """
+        :param method: GET/POST
+        :param path: 以/开头的路径
+        :param kwargs: 透传给 aiohttp 的参数, 如 data, allow_redirects
+        :return: HttpResult, 重试次数用完后抛出最后一次的异常
+        """
+        attempt = 0
+        while True:
+            try:
+                async with self.session.request(method, self.url(path), **kwargs) as response:
+                    body = await response.read()
+                    if response.status not in RETRY_STATUS or attempt >= self.retries:
+                        return HttpResult(response.status, body, response.get_encoding(), dict(response.headers))
+                    logger.debug(f'{self.host}{path} 返回 {response.status}, 重试')
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= self.retries:
+                    raise
+                logger.debug(f'{self.host}{path} 请求失败: {repr(e)}, 重试')
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+    @asynccontextmanager
+    async def open(self, method: str, path: str, chunk_size: int = 65536, **kwargs) -> HttpStream:
+        """
+        流式请求, 收到响应头后即返回, 内容由 chunks 逐块读取: async with pool.open('GET', path) as stream: ...
+        只在开始读取内容之前重试, 读取中途出错时直接抛出异常
+        """
+        attempt = 0
+        while True:
+            try:
+                response = await self.session.request(method, self.url(path), **kwargs)
+                if response.status not in RETRY_STATUS or attempt >= self.retries:
+                    break
+                response.release()
+                logger.debug(f'{self.host}{path} 返回 {response.status}, 重试')
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= self.retries:
+                    raise
+                logger.debug(f'{self.host}{path} 请求失败: {repr(e)}, 重试')
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+        try:
+            yield HttpStream(response.status, response.charset, dict(response.headers),
+                             response.content.iter_chunked(chunk_size))
+        finally:
+            response.release()
+
+    async def get(self, path: str, **kwargs) -> HttpResult:
+        return await self.request('GET', path, **kwargs)
+
+    async def post(self, path: str, **kwargs) -> HttpResult:
+        return await self.request('POST', path, **kwargs)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
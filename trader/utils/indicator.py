@@ -0,0 +1,114 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+from talib import ATR
+
+
+def calc_trend(close, period: int) -> np.ndarray:
+    """
+    递推均线: trend[0] = close[0], trend[i] = (trend[i-1] * (period-1) + close[i]) / period
+    运算顺序与原来逐行循环完全一致, 结果逐位相同。支持二维数组(行=日期, 列=品种), 列首的NaN视为缺失数据
+    递推无法向量化(改写成 lfilter 等形式结果不再逐位相同), 所以仍按日期循环: 一维在 Python float 上递推,
+    二维每个日期对所有品种做一次 float64 向量运算, 循环次数只取决于日期数
+    :param close: 收盘价, 一维或二维
+    :param period: 周期
+    :return: np.ndarray 与close形状相同
+    """
+    close = np.asarray(close, dtype=np.float64)
+    trend = np.empty_like(close)
+    if close.shape[0] == 0:
+        return trend
+    if close.ndim == 1:
+        prev = np.nan
+        for i, price in enumerate(close.tolist()):
+            # 前面是补齐用的NaN, 从第一根有效K线开始递推
+            prev = price if prev != prev else (prev * (period - 1) + price) / period
+            trend[i] = prev
+        return trend
+    trend[0] = close[0]
+    for i in range(1, close.shape[0]):
+        prev = trend[i - 1]
+        np.copyto(trend[i], (prev * (period - 1) + close[i]) / period)
+        np.copyto(trend[i], close[i], where=prev != prev)
+    return trend
+
+
+def calc_channel(close, period: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    突破通道, 等价于 close.rolling(window=period).max() / .min()
+    :param close: 收盘价, 一维或二维
+    :param period: 周期
+    :return: (上轨, 下轨)
+    """
+    close = np.asarray(close, dtype=np.float64)
+    high_line = np.full(close.shape, np.nan)
+    low_line = np.full(close.shape, np.nan)
+    if close.shape[0] >= period:
+        windows = sliding_window_view(close, period, axis=0)
+        high_line[period - 1:] = windows.max(axis=-1)
+        low_line[period - 1:] = windows.min(axis=-1)
+    return high_line, low_line
+
+
+def calc_atr(high, low, close, period: int) -> np.ndarray:
+    """
+    ATR, 由talib计算; 二维数组逐列计算, 列首的NaN视为缺失数据
+    """
+    high = np.asarray(high, dtype=np.float64)
+    low = np.asarray(low, dtype=np.float64)
+    close = np.asarray(close, dtype=np.float64)
+    if close.ndim == 1:
+        return ATR(np.ascontiguousarray(high), np.ascontiguousarray(low), np.ascontiguousarray(close),
+                   timeperiod=period)
+    atr = np.full(close.shape, np.nan)
+    for col in range(close.shape[1]):
+        valid = np.flatnonzero(~np.isnan(close[:, col]))
+        if valid.size == 0:
+            continue
+        start = valid[0]
+        atr[start:, col] = ATR(np.ascontiguousarray(high[start:, col]), np.ascontiguousarray(low[start:, col]),
+                               np.ascontiguousarray(close[start:, col]), timeperiod=period)
+    return atr
+
+
+def calc_indicators(df: pd.DataFrame, break_n: int, atr_n: int, long_n: int, short_n: int) -> pd.DataFrame:
+    """
+    计算突破策略用到的全部指标, 追加 atr, short_trend, long_trend, high_line, low_line 列
+    :param df: 按日期升序排列, 包含 high, low, close 列
+    :return: df
+    """
+    close = df.close.to_numpy(dtype=np.float64)
+    df['atr'] = calc_atr(df.high.to_numpy(dtype=np.float64), df.low.to_numpy(dtype=np.float64), close, atr_n)
+    df['short_trend'] = calc_trend(close, short_n)
+    df['long_trend'] = calc_trend(close, long_n)
+    df['high_line'], df['low_line'] = calc_channel(close, break_n)
+    return df
+
+
+def calc_panel_indicators(panel: dict, break_n: int, atr_n: int, long_n: int, short_n: int) -> dict:
+    """
+    对 (K线序号 x 品种) 的二维K线一次性计算全部指标, 结果以同样形状追加到panel中
+    :param panel: 包含 high, low, close 二维数组, 见 trader.utils.load_main_bars
+    :return: panel
+    """
+    close = panel['close']
+    panel['atr'] = calc_atr(panel['high'], panel['low'], close, atr_n)
+    panel['short_trend'] = calc_trend(close, short_n)
+    panel['long_trend'] = calc_trend(close, long_n)
+    panel['high_line'], panel['low_line'] = calc_channel(close, break_n)
+    return panel
@@ -36,12 +36,19 @@ weixin_log = MSG:LOG:WEIXIN
 [TRADE]
 command_timeout = 5
 ignore_inst = WH,bb,JR,RI,RS,LR,PM,im
+query_rate = 1
+query_concurrency = 8
+tick_buffer_size = 4096
+tick_journal = true
+db_workers = 4
 
 [REDIS]
 host = 127.0.0.1
 port = 6379
 db = 0
 encoding = utf-8
+max_connections = 32
+health_check_interval = 30
 
 [MYSQL]
 host = 127.0.0.1
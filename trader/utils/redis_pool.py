@@ -0,0 +1,135 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import os
+import logging
+
+import redis
+from redis import asyncio as aioredis
+from redis.backoff import ExponentialBackoff
+from redis.exceptions import ConnectionError, TimeoutError
+from redis.retry import Retry
+from redis.asyncio.retry import Retry as AsyncRetry
+
+from trader.utils.read_config import config
+
+logger = logging.getLogger('RedisManager')
+
+CLIENT_NAME_PREFIX = 'trader'
+
+
+class RedisManager(object):
+    """
+    进程内共用的 Redis 连接: 同步客户端和异步客户端各使用一个有上限的连接池, 连接用完时等待而不是新建,
+    避免补数据等批量任务耗尽服务器的 maxclients。空闲超过 health_check_interval 秒的连接使用前先 PING,
+    连接断开或超时时按指数退避重连重试。每个连接以 trader:进程号 命名, 可以在服务器端按进程统计连接数
+    """
+    def __init__(self, host: str = 'localhost', port: int = 6379, db: int = 0, max_connections: int = 32,
+                 timeout: float = 20, health_check_interval: int = 30, retries: int = 3):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.retries = retries
+        self._client = None
+        self._async_client = None
+        self._pid = None
+
+    @classmethod
+    def from_config(cls):
+        return cls(host=config.get('REDIS', 'host', fallback='localhost'),
+                   port=config.getint('REDIS', 'port', fallback=6379),
+                   db=config.getint('REDIS', 'db', fallback=0),
+                   max_connections=config.getint('REDIS', 'max_connections', fallback=32),
+                   health_check_interval=config.getint('REDIS', 'health_check_interval', fallback=30))
+
+    @property
+    def client_name(self) -> str:
+        return f'{CLIENT_NAME_PREFIX}:{os.getpid()}'
+
+    def _connection_kwargs(self) -> dict:
+        return dict(host=self.host, port=self.port, db=self.db, decode_responses=True, client_name=self.client_name,
+                    health_check_interval=self.health_check_interval, socket_keepalive=True,
+                    retry_on_error=[ConnectionError, TimeoutError])
+
+    def _check_fork(self):
+        # fork 出的子进程(如进程池)不能沿用父进程的连接
+        if self._pid != os.getpid():
+            self._client = None
+            self._async_client = None
+            self._pid = os.getpid()
+
+    @property
+    def client(self) -> redis.Redis:
+        """
+        同步客户端, 线程安全, 所有同步调用共用
+        """
+        self._check_fork()
+        if self._client is None:
+            self._client = redis.Redis(connection_pool=redis.BlockingConnectionPool(
+                max_connections=self.max_connections, timeout=self.timeout,
+                retry=Retry(ExponentialBackoff(), self.retries), **self._connection_kwargs()))
+        return self._client
+
+    @property
+    def async_client(self) -> aioredis.Redis:
+        """
+        异步客户端, 连接在第一次使用时于当前事件循环中建立, 同一进程的异步调用(包括订阅)应在同一个事件循环中
+        """
+        self._check_fork()
+        if self._async_client is None:
+            self._async_client = aioredis.Redis(connection_pool=aioredis.BlockingConnectionPool(
+                max_connections=self.max_connections, timeout=self.timeout,
+                retry=AsyncRetry(ExponentialBackoff(), self.retries), **self._connection_kwargs()))
+        return self._async_client
+
+    def ping(self) -> bool:
+        try:
+            return self.client.ping()
+        except redis.RedisError as e:
+            logger.warning(f'redis 连接失败: {repr(e)}')
+            return False
+
+    def stats(self) -> dict:
+        """
+        服务器端的连接统计: 全部连接数, maxclients, 本进程和全部 trader 进程的连接数
+        """
+        client = self.client
+        names = [item.get('name', '') for item in client.client_list()]
+        result = {'connected_clients': len(names),
+                  'this_process': names.count(self.client_name),
+                  'trader': sum(1 for name in names if name.startswith(CLIENT_NAME_PREFIX + ':'))}
+        try:
+            result['maxclients'] = int(client.config_get('maxclients')['maxclients'])
+        except redis.RedisError:
+            # 部分托管的 Redis 禁用了 CONFIG 命令
+            result['maxclients'] = None
+        return result
+
+    def close(self):
+        if self._client is not None:
+            self._client.connection_pool.disconnect()
+            self._client = None
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.connection_pool.disconnect()
+            self._async_client = None
+        self.close()
+
+
+redis_manager = RedisManager.from_config()
@@ -0,0 +1,268 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import os
+import gzip
+import hashlib
+import datetime
+from contextlib import asynccontextmanager
+from typing import Iterator, Tuple, AsyncIterator
+
+import ujson as json
+
+from trader.utils.http_pool import HttpPool, HttpResult, HttpStream
+from trader.utils.read_config import app_dir
+
+# 缓存中保存的响应头, 键为小写时转成这里的写法
+CACHED_HEADERS = {'etag': 'ETag', 'last-modified': 'Last-Modified', 'content-type': 'Content-Type'}
+
+
+class _BlobWriter(object):
+    """
+    边下载边压缩写入临时文件并计算哈希, 内容完整后再按哈希改名
+    """
+    def __init__(self, tmp_path: str, compress_level: int):
+        os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
+        self.tmp_path = tmp_path
+        self.size = 0
+        self.complete = False
+        self._sha256 = hashlib.sha256()
+        self._file = gzip.open(tmp_path, 'wb', compress_level)
+
+    def write(self, chunk: bytes):
+        self._sha256.update(chunk)
+        self._file.write(chunk)
+        self.size += len(chunk)
+
+    def commit(self, blob_path) -> str:
+        """
+        :param blob_path: blob_path(digest) -> 文件路径
+        :return: 内容的 sha256
+        """
+        self._file.close()
+        digest = self._sha256.hexdigest()
+        path = blob_path(digest)
+        if os.path.exists(path):
+            os.remove(self.tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self.tmp_path, path)
+        return digest
+
+    def discard(self):
+        self._file.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+
+class ResponseCache(object):
+    """
+    交易所原始数据的本地缓存: 响应内容按 sha256 存为 gzip 文件(相同内容只存一份),
+    索引按 交易所/日期/接口 记录内容的哈希、编码以及 ETag 和 Last-Modified。
+    历史数据不会变化, 命中缓存时不访问网络; 当天的数据或标记为过期的缓存用条件请求重新验证
+    """
+    def __init__(self, root: str = None, compress_level: int = 6):
+        self.root = root or os.path.join(app_dir.user_cache_dir, 'exchange')
+        self.compress_level = compress_level
+        self.hits = 0
+        self.revalidated = 0  # 条件请求返回 304 的次数
+        self.downloads = 0
+
+    def _index_path(self, exchange: str, day: datetime.date, endpoint: str) -> str:
+        return os.path.join(self.root, 'index', exchange, f'{day:%Y%m%d}', f'{endpoint}.json')
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.root, 'blobs', digest[:2], f'{digest}.gz')
+
+    @staticmethod
+    def _write(path: str, data: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def meta(self, exchange: str, day: datetime.date, endpoint: str) -> dict:
+        try:
+            with open(self._index_path(exchange, day, endpoint)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def load(self, exchange: str, day: datetime.date, endpoint: str) -> HttpResult:
+        """
+        :return: 缓存的响应, 没有缓存时为None
+        """
+        meta = self.meta(exchange, day, endpoint)
+        if meta is None:
+            return None
+        try:
+            with gzip.open(self._blob_path(meta['sha256'])) as f:
+                body = f.read()
+        except OSError:
+            return None
+        return HttpResult(200, body, meta['encoding'], meta['headers'])
+
+    def store(self, exchange: str, day: datetime.date, endpoint: str, response: HttpResult, url: str = None):
+        body = response.body
+        digest = hashlib.sha256(body).hexdigest()
+        blob_path = self._blob_path(digest)
+        if not os.path.exists(blob_path):
+            self._write(blob_path, gzip.compress(body, self.compress_level))
+        self._store_meta(exchange, day, endpoint, digest, len(body), response.encoding, response.headers, url)
+
+    def _store_meta(self, exchange: str, day: datetime.date, endpoint: str, digest: str, size: int, encoding: str,
+                    headers: dict, url: str):
+        headers = {CACHED_HEADERS[key.lower()]: value for key, value in (headers or {}).items()
+                   if key.lower() in CACHED_HEADERS}
+        self._write(self._index_path(exchange, day, endpoint), json.dumps({
+            'sha256': digest, 'size': size, 'encoding': encoding, 'headers': headers, 'url': url,
+            'fetched_at': datetime.datetime.now().isoformat(timespec='seconds')}).encode())
+
+    def invalidate(self, exchange: str, day: datetime.date, endpoint: str):
+        """
+        标记缓存过期(例如内容无法解析), 下次使用前重新验证, 原内容保留
+        """
+        meta = self.meta(exchange, day, endpoint)
+        if meta is not None:
+            meta['stale'] = True
+            self._write(self._index_path(exchange, day, endpoint), json.dumps(meta).encode())
+
+    async def fetch(self, pool: HttpPool, exchange: str, day: datetime.datetime, endpoint: str, method: str,
+                    path: str, revalidate: bool = None, **kwargs) -> HttpResult:
+        """
+        先查缓存再请求交易所, 成功的响应写入缓存
+        :param endpoint: 接口名, 同一交易所同一天的不同接口用它区分
+        :param revalidate: 是否向交易所验证缓存, None 为只验证当天及以后的数据
+        :param kwargs: 透传给 HttpPool.request
+        """
+        day = day.date() if isinstance(day, datetime.datetime) else day
+        if revalidate is None:
+            revalidate = day >= datetime.date.today()
+        meta = self.meta(exchange, day, endpoint)
+        if meta is not None and not revalidate and not meta.get('stale'):
+            cached = self.load(exchange, day, endpoint)
+            if cached is not None:
+                self.hits += 1
+                return cached
+        headers = dict(kwargs.pop('headers', None) or {})
+        if meta is not None:
+            if 'ETag' in meta['headers']:
+                headers['If-None-Match'] = meta['headers']['ETag']
+            if 'Last-Modified' in meta['headers']:
+                headers['If-Modified-Since'] = meta['headers']['Last-Modified']
+        response = await pool.request(method, path, headers=headers, **kwargs)
+        if response.status == 304:
+            cached = self.load(exchange, day, endpoint)
+            if cached is not None:
+                self.revalidated += 1
+                if meta.get('stale'):
+                    meta.pop('stale')
+                    self._write(self._index_path(exchange, day, endpoint), json.dumps(meta).encode())
+                return cached
+            # 索引还在但内容丢失, 不带条件重新下载
+            response = await pool.request(method, path, **kwargs)
+        self.downloads += 1
+        if response.status == 200 and response.body:
+            self.store(exchange, day, endpoint, response, pool.url(path))
+        return response
+
+    async def _read_chunks(self, digest: str, chunk_size: int) -> AsyncIterator[bytes]:
+        with gzip.open(self._blob_path(digest)) as f:
+            while chunk := f.read(chunk_size):
+                yield chunk
+
+    def _cached_stream(self, meta: dict, chunk_size: int) -> HttpStream:
+        return HttpStream(200, meta['encoding'], meta['headers'], self._read_chunks(meta['sha256'], chunk_size))
+
+    @staticmethod
+    async def _tee(chunks: AsyncIterator[bytes], writer: _BlobWriter) -> AsyncIterator[bytes]:
+        async for chunk in chunks:
+            writer.write(chunk)
+            yield chunk
+        writer.complete = True
+
+    @asynccontextmanager
+    async def open(self, pool: HttpPool, exchange: str, day: datetime.datetime, endpoint: str, method: str,
+                   path: str, revalidate: bool = None, chunk_size: int = 65536, **kwargs) -> HttpStream:
+        """
+        fetch() 的流式版本: 命中缓存时逐块读取本地文件, 否则边下载边写入缓存, 内容读完整后才记入索引
+        """
+        day = day.date() if isinstance(day, datetime.datetime) else day
+        if revalidate is None:
+            revalidate = day >= datetime.date.today()
+        meta = self.meta(exchange, day, endpoint)
+        cached = meta is not None and os.path.exists(self._blob_path(meta['sha256']))
+        if cached and not revalidate and not meta.get('stale'):
+            self.hits += 1
+            yield self._cached_stream(meta, chunk_size)
+            return
+        headers = dict(kwargs.pop('headers', None) or {})
+        if cached:
+            if 'ETag' in meta['headers']:
+                headers['If-None-Match'] = meta['headers']['ETag']
+            if 'Last-Modified' in meta['headers']:
+                headers['If-Modified-Since'] = meta['headers']['Last-Modified']
+        async with pool.open(method, path, chunk_size, headers=headers, **kwargs) as stream:
+            if stream.status == 304 and cached:
+                self.revalidated += 1
+                if meta.pop('stale', False):
+                    self._write(self._index_path(exchange, day, endpoint), json.dumps(meta).encode())
+                yield self._cached_stream(meta, chunk_size)
+                return
+            self.downloads += 1
+            if stream.status != 200:
+                yield stream
+                return
+            writer = _BlobWriter(os.path.join(self.root, 'blobs', f'{os.getpid()}.{id(stream)}.tmp'),
+                                 self.compress_level)
+            try:
+                yield stream._replace(chunks=self._tee(stream.chunks, writer))
+            except BaseException:
+                writer.discard()
+                raise
+            if writer.complete and writer.size:
+                digest = writer.commit(self._blob_path)
+                self._store_meta(exchange, day, endpoint, digest, writer.size, stream.encoding, stream.headers,
+                                 pool.url(path))
+            else:
+                writer.discard()
+
+    def entries(self, start: datetime.date, end: datetime.date, exchanges=None) -> \
+            Iterator[Tuple[str, datetime.date, str, HttpResult]]:
+        """
+        按交易所和日期顺序遍历 [start, end] 期间的缓存
+        :return: (交易所, 日期, 接口, 响应)
+        """
+        index_root = os.path.join(self.root, 'index')
+        if exchanges is None:
+            exchanges = sorted(os.listdir(index_root)) if os.path.isdir(index_root) else []
+        for exchange in exchanges:
+            exchange_root = os.path.join(index_root, exchange)
+            if not os.path.isdir(exchange_root):
+                continue
+            for day_str in sorted(os.listdir(exchange_root)):
+                day = datetime.datetime.strptime(day_str, '%Y%m%d').date()
+                if not start <= day <= end:
+                    continue
+                for name in sorted(os.listdir(os.path.join(exchange_root, day_str))):
+                    if not name.endswith('.json'):
+                        continue
+                    endpoint = name[:-len('.json')]
+                    response = self.load(exchange, day, endpoint)
+                    if response is not None:
+                        yield exchange, day, endpoint, response
@@ -0,0 +1,156 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import asyncio
+import logging
+from collections import defaultdict, deque
+
+import ujson as json
+from redis import asyncio as aioredis
+
+logger = logging.getLogger('RpcMultiplexer')
+
+
+class _Waiter(object):
+    def __init__(self, channels: list):
+        self.channels = channels
+        self.future = asyncio.get_running_loop().create_future()
+        self.msg_list = []
+
+    def feed(self, msg_dict: dict) -> bool:
+        """
+        收集一条应答, 收到最后一条(bIsLast)时完成
+        :return: 是否已完成
+        """
+        if 'empty' not in msg_dict or not msg_dict['empty']:
+            self.msg_list.append(msg_dict)
+        if 'bIsLast' not in msg_dict or msg_dict['bIsLast']:
+            if not self.future.done():
+                self.future.set_result(self.msg_list)
+            return True
+        return False
+
+
+class RpcMultiplexer(object):
+    """
+    常驻的CTP应答分发器: 启动时订阅一次应答频道, 之后所有请求共用这个订阅,
+    应答按频道(频道名中含RequestID)交给等待中的请求, 同一频道有多个等待者时按先后顺序分配
+    """
+    def __init__(self, redis_client: aioredis.Redis, patterns: list):
+        self.redis_client = redis_client
+        self.patterns = patterns
+        self.sub_client = None
+        self.reader = None
+        self.waiters = defaultdict(deque)  # { channel: deque[_Waiter] }
+
+    async def start(self):
+        self.sub_client = self.redis_client.pubsub(ignore_subscribe_messages=True)
+        await self.sub_client.psubscribe(*self.patterns)
+        self.reader = asyncio.create_task(self._reader())
+        logger.debug('RpcMultiplexer started: %s', self.patterns)
+
+    async def stop(self):
+        if self.reader is not None:
+            self.reader.cancel()
+            self.reader = None
+        for queue in self.waiters.values():
+            for waiter in queue:
+                waiter.future.cancel()
+        self.waiters.clear()
+        if self.sub_client is not None:
+            await self.sub_client.punsubscribe()
+            await self.sub_client.close()
+            self.sub_client = None
+
+    async def _reader(self):
+        while True:
+            try:
+                async for msg in self.sub_client.listen():
+                    if msg['type'] != 'pmessage':
+                        continue
+                    queue = self.waiters.get(msg['channel'])
+                    if not queue:
+                        continue
+                    waiter = queue[0]
+                    if waiter.feed(json.loads(msg['data'])):
+                        self._unregister(waiter)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f'RpcMultiplexer 读取应答发生错误: {repr(e)}, 重新订阅', exc_info=True)
+                await asyncio.sleep(1)
+                try:
+                    await self.sub_client.psubscribe(*self.patterns)
+                except Exception as ee:
+                    logger.warning(f'RpcMultiplexer 重新订阅失败: {repr(ee)}')
+
+    def _register(self, channels: list) -> _Waiter:
+        waiter = _Waiter(channels)
+        for channel in channels:
+            self.waiters[channel].append(waiter)
+        return waiter
+
+    def _unregister(self, waiter: _Waiter):
+        for channel in waiter.channels:
+            queue = self.waiters.get(channel)
+            if queue is None:
+                continue
+            try:
+                queue.remove(waiter)
+            except ValueError:
+                pass
+            if not queue:
+                del self.waiters[channel]
+
+    async def call(self, channels: list, request_channel: str, payload: str, timeout: float) -> list:
+        """
+        发送请求并等待应答
+        :param channels: 等待应答的频道, 任一频道收到bIsLast即结束
+        :param request_channel: 请求频道
+        :param payload: 请求内容(json)
+        :param timeout: 超时秒数, 超时抛出 asyncio.TimeoutError
+        :return: 收到的应答列表
+        """
+        waiter = self._register(channels)  # 先登记再发请求, 不会漏掉应答
+        try:
+            await self.redis_client.publish(request_channel, payload)
+            return await asyncio.wait_for(waiter.future, timeout)
+        finally:
+            self._unregister(waiter)
+
+
+class TokenBucket(object):
+    """
+    令牌桶限速: 每秒补充rate个令牌, 最多积攒capacity个, 取令牌按先来后到排队
+    """
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_time = None
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            loop = asyncio.get_running_loop()
+            while True:
+                now = loop.time()
+                if self.last_time is not None:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+                self.last_time = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
@@ -0,0 +1,225 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+# 品种组合选择: 在相关系数矩阵上找两两相关性最低的n个品种
+import heapq
+import math
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+def pair_cost(corr: np.ndarray) -> np.ndarray:
+    """
+    两两相关系数的平方, 对角线为0, 缺失的相关系数按完全相关处理
+    """
+    cost = np.nan_to_num(np.asarray(corr, dtype=np.float64), nan=1.0) ** 2
+    np.fill_diagonal(cost, 0)
+    return cost
+
+
+def basket_score(total: float, n: int) -> float:
+    """
+    与原来 find_best_score 一致的得分: (1 - 两两相关系数平方的均值) 换算到 -100~100, 越高越好
+    :param total: 组合内两两相关系数平方之和
+    :param n: 组合品种数
+    """
+    return (round((1 - total / (n * (n - 1) / 2)) * 100, 3) - 50) * 2
+
+
+def basket_cost(cost: np.ndarray, basket) -> float:
+    basket = np.asarray(basket)
+    return float(cost[np.ix_(basket, basket)].sum() / 2)
+
+
+def _push(heap: list, top: int, total: float, basket: tuple):
+    # heap 保存 top 个最小的 total, 用负值做成最大堆
+    if len(heap) < top:
+        heapq.heappush(heap, (-total, basket))
+    elif total < -heap[0][0]:
+        heapq.heapreplace(heap, (-total, basket))
+
+
+def _enumerate(cost: np.ndarray, n: int, firsts: list, top: int) -> list:
+    """
+    以 firsts 中的品种为组合第一个元素的全部组合, 深度优先逐个加入品种并增量累加得分,
+    剩余品种的最小增量之和已经超过当前第top名时剪枝
+    """
+    size = cost.shape[0]
+    heap = list()
+    basket = [0] * n
+
+    def bound() -> float:
+        return -heap[0][0] if len(heap) >= top else math.inf
+
+    def dfs(depth: int, start: int, total: float, added: np.ndarray):
+        remain = n - depth
+        if remain == 1:
+            totals = total + added[start:]
+            for j in np.argsort(totals)[:top]:
+                _push(heap, top, float(totals[j]), tuple(basket[:depth]) + (int(start + j), ))
+            return
+        candidates = added[start:size - remain + 1]
+        lower = np.sort(added[start:])[:remain].sum()
+        if total + lower >= bound():
+            return
+        for offset in np.argsort(candidates):
+            i = int(start + offset)
+            if total + added[i] + np.sort(added[i + 1:])[:remain - 1].sum() >= bound():
+                continue
+            basket[depth] = i
+            dfs(depth + 1, i + 1, total + added[i], added + cost[i])
+
+    for first in firsts:
+        if first > size - n:
+            continue
+        basket[0] = first
+        dfs(1, first + 1, 0.0, cost[first].copy())
+    return [(-neg, b) for neg, b in heap]
+
+
+def enumerate_baskets(cost: np.ndarray, n: int, top: int = 3, processes: int = 1) -> list:
+    """
+    穷举全部组合(带剪枝), 适合品种较少的情况
+    :return: [(两两相关系数平方之和, 品种序号)], 从好到差
+    """
+    firsts = list(range(cost.shape[0] - n + 1))
+    if processes > 1:
+        with ProcessPoolExecutor(processes) as executor:
+            parts = executor.map(_enumerate, *zip(*[(cost, n, firsts[i::processes], top) for i in range(processes)]))
+            result = [item for part in parts for item in part]
+    else:
+        result = _enumerate(cost, n, firsts, top)
+    return sorted(result)[:top]
+
+
+def greedy_basket(cost: np.ndarray, n: int, seed: int = None) -> list:
+    """
+    贪心: 从相关性最低的一对(或指定的品种)开始, 每次加入使得分增加最少的品种
+    """
+    size = cost.shape[0]
+    if seed is None:
+        masked = cost + np.eye(size) * np.inf
+        basket = list(np.unravel_index(np.argmin(masked), masked.shape))
+    else:
+        basket = [seed]
+    added = cost[basket].sum(axis=0)
+    while len(basket) < n:
+        candidates = added.copy()
+        candidates[basket] = np.inf
+        best = int(np.argmin(candidates))
+        basket.append(best)
+        added += cost[best]
+    return sorted(int(i) for i in basket)
+
+
+def beam_search(cost: np.ndarray, n: int, width: int = 64) -> list:
+    """
+    集束搜索: 每一步给部分组合各加入一个品种, 只保留得分最好的 width 个
+    :return: [(两两相关系数平方之和, 品种序号)], 从好到差
+    """
+    beams = [(0.0, (i, )) for i in range(cost.shape[0])]
+    for _ in range(n - 1):
+        expanded = dict()
+        for total, basket in beams:
+            values = total + cost[list(basket)].sum(axis=0)
+            values[list(basket)] = np.inf
+            for j in np.argsort(values)[:width]:
+                key = tuple(sorted(basket + (int(j), )))
+                if key not in expanded:
+                    expanded[key] = float(values[j])
+        beams = [(value, key) for key, value in heapq.nsmallest(width, expanded.items(), key=lambda item: item[1])]
+    return beams
+
+
+def local_search(cost: np.ndarray, basket, deadline: float, seed: int = 0, top: int = 1) -> list:
+    """
+    交换邻域的局部搜索: 每次做使得分下降最多的一组(移出, 移入)交换, 到达局部最优后随机替换几个品种重新开始,
+    直到 deadline
+    :return: 找到的最好的 top 个局部最优 [(两两相关系数平方之和, 品种序号)], 从好到差
+    """
+    rng = np.random.default_rng(seed)
+    size = cost.shape[0]
+    inside = np.zeros(size, dtype=bool)
+    inside[list(basket)] = True
+    n = int(inside.sum())
+    found = dict()
+    best = tuple(np.flatnonzero(inside).tolist())
+    found[best] = basket_cost(cost, best)
+    if n in (0, size):
+        return [(found[best], best)]
+    while True:
+        added = cost[inside].sum(axis=0)
+        total = float(added[inside].sum() / 2)
+        while True:
+            members, others = np.flatnonzero(inside), np.flatnonzero(~inside)
+            # delta[a, b]: 移出 members[a] 并移入 others[b] 后得分的变化
+            delta = added[others][None, :] - cost[np.ix_(members, others)] - added[members][:, None]
+            a, b = np.unravel_index(np.argmin(delta), delta.shape)
+            if delta[a, b] >= -1e-12:
+                break
+            inside[members[a]], inside[others[b]] = False, True
+            added += cost[others[b]] - cost[members[a]]
+            total += float(delta[a, b])
+        optimum = tuple(np.flatnonzero(inside).tolist())
+        found[optimum] = total
+        if total < found[best]:
+            best = optimum
+        if time.monotonic() >= deadline:
+            return sorted((value, key) for key, value in found.items())[:top]
+        inside[:] = False
+        inside[list(best)] = True
+        kick = max(1, min(n, size - n) // 4)
+        inside[rng.choice(best, kick, replace=False)] = False
+        inside[rng.choice(np.flatnonzero(~inside), kick, replace=False)] = True
+
+
+def _search(cost: np.ndarray, n: int, budget: float, seed: int, top: int) -> list:
+    """
+    seed 为0时从集束搜索的结果出发, 否则从以第seed个品种开始的贪心组合出发, 各进程的起点不同
+    """
+    deadline = time.monotonic() + budget
+    if seed == 0:
+        start = beam_search(cost, n)[0][1]
+    else:
+        start = greedy_basket(cost, n, (seed - 1) % cost.shape[0])
+    return local_search(cost, start, deadline, seed, top)
+
+
+def select_basket(corr: np.ndarray, n: int, time_budget: float = 5.0, processes: int = 1, top: int = 3,
+                  exhaustive_limit: int = 1_000_000) -> list:
+    """
+    从相关系数矩阵中选出两两相关性最低的n个品种。
+    组合数不超过 exhaustive_limit 时穷举, 否则用集束搜索和贪心得到初始组合, 再在 time_budget 秒内局部搜索
+    :param corr: 相关系数矩阵(numpy 数组或 DataFrame)
+    :param processes: 进程数, 大于1时各进程从不同初始组合并行搜索
+    :return: [(得分, 品种序号)], 从好到差
+    """
+    cost = pair_cost(corr)
+    size = cost.shape[0]
+    n = min(n, size)
+    if n < 2:
+        return [(100.0, tuple(range(n)))]
+    if math.comb(size, n) <= exhaustive_limit:
+        result = enumerate_baskets(cost, n, top, processes)
+    elif processes > 1:
+        with ProcessPoolExecutor(processes) as executor:
+            parts = executor.map(_search, *zip(*[(cost, n, time_budget, seed, top) for seed in range(processes)]))
+            result = [item for part in parts for item in part]
+    else:
+        result = _search(cost, n, time_budget, 0, top)
+    result = sorted((total, basket) for basket, total in {basket: total for total, basket in result}.items())
+    return [(basket_score(total, n), basket) for total, basket in result[:top]]
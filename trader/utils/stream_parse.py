@@ -0,0 +1,157 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import codecs
+from collections import deque
+from typing import AsyncIterable, AsyncIterator, Callable
+import xml.etree.ElementTree as ET
+
+# 交易所网站的中文编码, 统一用超集 gb18030 解码
+GB_ENCODINGS = {'gbk', 'gb2312', 'gb18030', 'cp936', 'x-gbk'}
+
+
+class StreamDecoder(object):
+    """
+    增量解码, 字节块可以在多字节字符中间断开。编码为中文编码时按 gb18030 解码;
+    未声明编码或按声明的编码解码失败时, 从失败处改用 gb18030
+    """
+    def __init__(self, encoding: str = None):
+        encoding = (encoding or 'utf-8').lower()
+        self.encoding = 'gb18030' if encoding in GB_ENCODINGS else encoding
+        self._decoder = codecs.getincrementaldecoder(self.encoding)()
+
+    def decode(self, chunk: bytes, final: bool = False) -> str:
+        try:
+            return self._decoder.decode(chunk, final)
+        except UnicodeDecodeError:
+            if self.encoding == 'gb18030':
+                raise
+            # 上一块末尾未解码的字节加上本块, 改用 gb18030 重新解码
+            pending = self._decoder.getstate()[0]
+            self.encoding = 'gb18030'
+            self._decoder = codecs.getincrementaldecoder(self.encoding)()
+            return self._decoder.decode(pending + chunk, final)
+
+
+class LineSplitter(object):
+    """
+    把分块到达的文本按分隔符切成行, 全部行与 text.split(separator) 的结果相同(包括末尾的空串)
+    """
+    def __init__(self, separator: str = '\n'):
+        self.separator = separator
+        self._buffer = ''
+
+    def feed(self, text: str) -> list:
+        if not text:
+            return []
+        lines = (self._buffer + text).split(self.separator)
+        self._buffer = lines.pop()
+        return lines
+
+    def close(self) -> list:
+        line, self._buffer = self._buffer, ''
+        return [line]
+
+
+class LineRowParser(object):
+    """
+    按行解析的推式解析器: feed() 送入字节块(或文本), 返回已经能解析的行。
+    head 和 tail 与 text.split(separator)[head:-tail] 的切片相同, 末尾的 tail 行要到 close() 时才能确定
+    :param parse_line: parse_line(line) -> 解析结果, 返回None的行丢弃
+    """
+    def __init__(self, parse_line: Callable, separator: str = '\n', head: int = 0, tail: int = 0,
+                 encoding: str = None):
+        self.parse_line = parse_line
+        self.head = head
+        self._splitter = LineSplitter(separator)
+        self._decoder = StreamDecoder(encoding)
+        self._pending = deque()
+        self._tail = tail
+
+    def _parse(self, lines: list) -> list:
+        rows = list()
+        for line in lines:
+            if self.head:
+                self.head -= 1
+                continue
+            self._pending.append(line)
+            if len(self._pending) > self._tail:
+                row = self.parse_line(self._pending.popleft())
+                if row is not None:
+                    rows.append(row)
+        return rows
+
+    def feed(self, chunk) -> list:
+        text = chunk if isinstance(chunk, str) else self._decoder.decode(chunk)
+        return self._parse(self._splitter.feed(text))
+
+    def close(self) -> list:
+        rows = self._parse(self._splitter.feed(self._decoder.decode(b'', True)) + self._splitter.close())
+        self._pending.clear()
+        return rows
+
+
+class XmlRowParser(object):
+    """
+    XML 的推式解析器: 每个 tag 元素结束时调用 parse_element 并释放该元素, 内存占用与文件大小无关
+    :param parse_element: parse_element(element) -> 解析结果, 返回None的元素丢弃
+    """
+    def __init__(self, tag: str, parse_element: Callable, encoding: str = None):
+        self.tag = tag
+        self.parse_element = parse_element
+        self._decoder = StreamDecoder(encoding)
+        # 已解码的文本送入解析器, 不受文件中声明的编码影响
+        self._parser = ET.XMLPullParser(events=('end', ))
+
+    def _parse(self) -> list:
+        rows = list()
+        for _, element in self._parser.read_events():
+            if element.tag == self.tag:
+                row = self.parse_element(element)
+                if row is not None:
+                    rows.append(row)
+                element.clear()
+        return rows
+
+    def feed(self, chunk) -> list:
+        self._parser.feed(chunk if isinstance(chunk, str) else self._decoder.decode(chunk))
+        return self._parse()
+
+    def close(self) -> list:
+        self._parser.feed(self._decoder.decode(b'', True))
+        self._parser.close()
+        return self._parse()
+
+
+def parse_all(parser, chunks) -> list:
+    """
+    把全部字节块(或一整段文本)送入推式解析器
+    """
+    rows = list()
+    for chunk in [chunks] if isinstance(chunks, (str, bytes)) else chunks:
+        rows.extend(parser.feed(chunk))
+    rows.extend(parser.close())
+    return rows
+
+
+async def iter_rows(parser, chunks: AsyncIterable[bytes]) -> AsyncIterator:
+    """
+    边下载边解析, 逐个返回解析结果
+    """
+    async for chunk in chunks:
+        for row in parser.feed(chunk):
+            yield row
+    for row in parser.close():
+        yield row
@@ -0,0 +1,162 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+# 参数扫描: 子进程通过共享内存只读访问K线, 不访问数据库
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import product
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from trader.utils.backtest import run_backtest, ENTRY, STOP
+from trader.utils.indicator import calc_trend, calc_channel, calc_atr
+
+SWEEP_FIELDS = ('break_n', 'atr_n', 'long_n', 'short_n', 'stop_n')
+# 共享内存中K线数组的第一维, raw_open 为未做换月调整的开盘价, 用作收益率的分母
+BAR_FIELDS = ('open', 'high', 'low', 'close', 'raw_open')
+TRADING_DAYS = 252
+
+_worker = dict()
+
+
+def param_grid(grid: dict, base: dict) -> list:
+    """
+    展开参数网格, 去掉短均线周期不小于长均线周期的组合
+    :param grid: {参数名: 取值列表}, 参数名见 SWEEP_FIELDS
+    :param base: 网格中没有给出的参数取这里的值
+    :return: [(break_n, atr_n, long_n, short_n, stop_n)]
+    """
+    values = [grid[field] if field in grid else [base[field]] for field in SWEEP_FIELDS]
+    return [combo for combo in product(*values) if combo[3] < combo[2]]
+
+
+def portfolio_stats(position: np.ndarray, returns: np.ndarray, listed: np.ndarray, cost: float) -> dict:
+    """
+    等权组合的表现: 每个交易日把资金平均分给已上市的品种
+    :param position: (交易日 x 品种) 持仓方向 1/0/-1
+    :param returns: (交易日 x 品种) 当日开盘到下一交易日开盘的收益率
+    :param listed: (交易日 x 品种) 当日是否有K线
+    :param cost: 每单位换手的成本(比例)
+    :return: 净值, 年化收益, 最大回撤, 年化换手率
+    """
+    weight = listed / np.maximum(listed.sum(axis=1, keepdims=True), 1)
+    turnover = (np.abs(np.diff(position, axis=0, prepend=0)) * weight).sum(axis=1)
+    daily = (position * returns * weight).sum(axis=1) - cost * turnover
+    nav = np.cumprod(1 + daily)
+    years = max(nav.shape[0] / TRADING_DAYS, 1 / TRADING_DAYS)
+    max_drawdown = float((1 - nav / np.maximum.accumulate(nav)).max()) if nav.size else 0.0
+    final = float(nav[-1]) if nav.size else 1.0
+    annual_return = final ** (1 / years) - 1 if final > 0 else -1.0
+    return {'nav': final, 'annual_return': annual_return, 'max_drawdown': max_drawdown,
+            'calmar': annual_return / max_drawdown if max_drawdown > 0 else np.nan,
+            'turnover': float(turnover.sum()) / years}
+
+
+def _init_worker(shm_name: str, shape: tuple, cost: float):
+    shm = SharedMemory(name=shm_name)
+    bars = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    _worker.update(shm=shm, bars=bars, cost=cost, listed=~np.isnan(bars[BAR_FIELDS.index('close')]),
+                   columns=dict())
+    _indicator.cache_clear()
+
+
+def _product_bars(col: int) -> tuple:
+    """
+    一个品种去掉空行后的K线, 每个子进程只整理一次
+    :return: (交易日序号, open, high, low, close, raw_open)
+    """
+    columns = _worker['columns']
+    if col not in columns:
+        bars = _worker['bars']
+        rows = np.flatnonzero(_worker['listed'][:, col])
+        columns[col] = (rows, *(np.ascontiguousarray(bars[i, rows, col]) for i in range(len(BAR_FIELDS))))
+    return columns[col]
+
+
+@lru_cache(maxsize=4096)
+def _indicator(col: int, kind: str, period: int):
+    """
+    同一子进程内不同参数组合共用的指标, 例如只改止损倍数时均线和通道不必重算
+    """
+    rows, open_price, high, low, close, raw_open = _product_bars(col)
+    if kind == 'atr':
+        return calc_atr(high, low, close, period)
+    if kind == 'trend':
+        return calc_trend(close, period)
+    return calc_channel(close, period)
+
+
+def _run_combo(combo: tuple) -> dict:
+    break_n, atr_n, long_n, short_n, stop_n = combo
+    listed = _worker['listed']
+    position = np.zeros(listed.shape)
+    returns = np.zeros(listed.shape)
+    trades = 0
+    for col in range(listed.shape[1]):
+        rows, open_price, high, low, close, raw_open = _product_bars(col)
+        if rows.size <= break_n + 1:
+            continue
+        high_line, low_line = _indicator(col, 'channel', break_n)
+        events = run_backtest(
+            open_price, high, low, close, _indicator(col, 'atr', atr_n), _indicator(col, 'trend', short_n),
+            _indicator(col, 'trend', long_n), high_line, low_line, stop_n, break_n + 1)
+        pos = np.zeros(rows.size)
+        entry = None
+        for event in events:
+            if event.kind == ENTRY:
+                entry = event
+                trades += 1
+            elif event.kind == STOP:
+                pos[entry.index:event.index] = entry.direction
+                entry = None
+        if entry is not None:
+            pos[entry.index:] = entry.direction
+        ret = np.zeros(rows.size)
+        ret[:-1] = (open_price[1:] - open_price[:-1]) / raw_open[:-1]
+        position[rows, col] = pos
+        returns[rows, col] = ret
+    stats = portfolio_stats(position, returns, listed, _worker['cost'])
+    stats['trades'] = trades
+    return dict(zip(SWEEP_FIELDS, combo), **stats)
+
+
+def run_sweep(bars: np.ndarray, combos: list, max_workers: int = None, cost: float = 0.0,
+              chunksize: int = None) -> pd.DataFrame:
+    """
+    多进程参数扫描: K线放入共享内存, 各子进程只读映射, 参数组合分批交给进程池
+    :param bars: (BAR_FIELDS x 交易日 x 品种) float64, 没有K线的位置为NaN
+    :param combos: param_grid 展开的参数组合
+    :param max_workers: 进程数, 默认为CPU核数
+    :param cost: 每单位换手的成本(比例)
+    :return: 按净值从高到低排列的 DataFrame, 每行一个参数组合
+    """
+    max_workers = max_workers or os.cpu_count()
+    chunksize = chunksize or max(1, len(combos) // (max_workers * 8))
+    shm = SharedMemory(create=True, size=max(bars.nbytes, 1))
+    try:
+        np.ndarray(bars.shape, dtype=np.float64, buffer=shm.buf)[:] = bars
+        with ProcessPoolExecutor(max_workers, initializer=_init_worker,
+                                 initargs=(shm.name, bars.shape, cost)) as executor:
+            result = list(tqdm(executor.map(_run_combo, combos, chunksize=chunksize), total=len(combos)))
+    finally:
+        shm.close()
+        shm.unlink()
+    df = pd.DataFrame(result, columns=[*SWEEP_FIELDS, 'nav', 'annual_return', 'max_drawdown', 'calmar',
+                                       'turnover', 'trades'])
+    return df.sort_values('nav', ascending=False, ignore_index=True)
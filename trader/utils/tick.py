@@ -1,13 +1,56 @@
 # coding=utf-8
 import datetime
 
+import ujson as json
+
+
+class TickTimeParser(object):
+    """
+    解析固定格式的行情时间 "YYYYMMDD HH:MM:SS[:fff]", 比 strptime 快一个数量级。
+    同一天的行情日期部分相同, 只在日期变化时重新生成当天零点
+    """
+    __slots__ = ('_prefix', '_base')
+
+    def __init__(self):
+        self._prefix = None
+        self._base = None
+
+    def parse(self, text: str, millisecond: int = None) -> datetime.datetime:
+        """
+        :param text: "20230104 21:00:01:500" 或 "20230104 21:00:01"
+        :param millisecond: 毫秒, 不为None时代替 text 中的毫秒部分
+        """
+        prefix = text[:8]
+        if prefix != self._prefix:
+            self._base = datetime.datetime(int(prefix[:4]), int(prefix[4:6]), int(prefix[6:8]))
+            self._prefix = prefix
+        if millisecond is not None:
+            microsecond = millisecond * 1000
+        elif len(text) > 18:
+            # 与 strptime 的 %f 一致, 不足6位时在右边补0
+            microsecond = int(text[18:24].ljust(6, '0'))
+        else:
+            microsecond = 0
+        return self._base.replace(hour=int(text[9:11]), minute=int(text[12:14]), second=int(text[15:17]),
+                                  microsecond=microsecond)
+
+
+time_parser = TickTimeParser()
+
 
 class TickBar(object):
+    """
+    一笔行情, 只保留策略用到的字段
+    """
+    __slots__ = ('instrument', 'bid_price', 'bid_volume', 'ask_price', 'ask_volume', 'holding', 'up_limit_price',
+                 'down_limit_price', 'volume', 'price', 'day_high', 'day_low', 'open', 'pre_close', 'dateTime')
+
     def __init__(self, day, data, last_volume):
         """
         pData的格式转换和整理, 交易数据都转换为整数，tick的后四个字段在模拟行情中经常出错
+        :param day: 日期, 格式为 YYYYMMDD
         :param data: ApiStruct.DepthMarketData
-        :return:
+        :param last_volume: 上一笔行情的累计成交量
         """
         self.instrument = data.InstrumentID
         self.bid_price = data.BidPrice1
@@ -23,8 +66,39 @@ class TickBar(object):
         self.day_low = data.LowestPrice
         self.open = data.OpenPrice
         self.pre_close = data.PreClosePrice
-        self.dateTime = datetime.datetime.strptime(
-            day+data.UpdateTime, "%Y%m%d%H:%M:%S")
-        self.dateTime = self.dateTime + \
-            datetime.timedelta(
-                microseconds=datetime.datetime.now().microsecond)
+        self.dateTime = time_parser.parse(f'{day} {data.UpdateTime}', getattr(data, 'UpdateMillisec', None))
+
+    @classmethod
+    def from_dict(cls, tick: dict, last_volume: int = 0):
+        """
+        由行情推送的字典生成, 其中 UpdateTime 的格式为 "YYYYMMDD HH:MM:SS:fff"; 不用的字段直接丢弃
+        """
+        bar = cls.__new__(cls)
+        bar.instrument = tick['InstrumentID']
+        bar.bid_price = tick['BidPrice1']
+        bar.bid_volume = tick['BidVolume1']
+        bar.ask_price = tick['AskPrice1']
+        bar.ask_volume = tick['AskVolume1']
+        bar.holding = tick['OpenInterest']
+        bar.up_limit_price = tick['UpperLimitPrice']
+        bar.down_limit_price = tick['LowerLimitPrice']
+        bar.volume = tick['Volume'] - last_volume
+        bar.price = tick['LastPrice']
+        bar.day_high = tick['HighestPrice']
+        bar.day_low = tick['LowestPrice']
+        bar.open = tick['OpenPrice']
+        bar.pre_close = tick['PreClosePrice']
+        bar.dateTime = time_parser.parse(tick['UpdateTime'])
+        return bar
+
+    def __repr__(self):
+        return f'TickBar({self.instrument} {self.dateTime} price={self.price} volume={self.volume} ' \
+               f'bid={self.bid_price}x{self.bid_volume} ask={self.ask_price}x{self.ask_volume})'
+
+
+def decode_tick(raw: str) -> TickBar:
+    """
+    OnRtnDepthMarketData 频道的消息解码器, 配合 RegisterCallback(decoder=decode_tick) 使用。
+    volume 为当日累计成交量
+    """
+    return TickBar.from_dict(json.loads(raw))
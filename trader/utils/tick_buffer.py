@@ -0,0 +1,136 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import numpy as np
+
+from trader.utils.tick import TickBar
+
+# time 为 unix 时间戳(秒), volume 为当日累计成交量
+TICK_COLUMNS = ('time', 'price', 'volume', 'bid_price', 'bid_volume', 'ask_price', 'ask_volume')
+TIME, PRICE, VOLUME, BID_PRICE, BID_VOLUME, ASK_PRICE, ASK_VOLUME = range(len(TICK_COLUMNS))
+
+
+class TickBuffer(object):
+    """
+    单个合约最近 capacity 笔行情的环形缓冲区, 内存预先分配, 写入不产生新数组。
+    每笔行情同时写在 i 和 i+capacity 两个位置(镜像), 任意最近n笔都是一段连续内存, window() 直接返回视图
+    """
+    __slots__ = ('capacity', 'count', '_data', '_flat', '_pos')
+
+    def __init__(self, capacity: int = 4096):
+        self.capacity = capacity
+        self.count = 0  # 累计写入的笔数
+        self._data = np.full((len(TICK_COLUMNS), capacity * 2), np.nan)
+        # 逐个元素写入时 memoryview 比 numpy 下标赋值快得多
+        self._flat = memoryview(self._data.reshape(-1))
+        self._pos = capacity - 1  # 最新一笔在前半段的位置
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, time: float, price: float, volume: float, bid_price: float, bid_volume: float,
+               ask_price: float, ask_volume: float):
+        pos = self._pos + 1
+        if pos == self.capacity:
+            pos = 0
+        self._pos = pos
+        flat = self._flat
+        stride = self.capacity * 2
+        mirror = pos + self.capacity
+        # 逐个字段展开写入, 不创建临时元组
+        flat[pos] = flat[mirror] = time
+        pos += stride
+        mirror += stride
+        flat[pos] = flat[mirror] = price
+        pos += stride
+        mirror += stride
+        flat[pos] = flat[mirror] = volume
+        pos += stride
+        mirror += stride
+        flat[pos] = flat[mirror] = bid_price
+        pos += stride
+        mirror += stride
+        flat[pos] = flat[mirror] = bid_volume
+        pos += stride
+        mirror += stride
+        flat[pos] = flat[mirror] = ask_price
+        pos += stride
+        mirror += stride
+        flat[pos] = flat[mirror] = ask_volume
+        self.count += 1
+
+    def append_tick(self, tick: TickBar):
+        self.append(tick.dateTime.timestamp(), tick.price, tick.volume, tick.bid_price, tick.bid_volume,
+                    tick.ask_price, tick.ask_volume)
+
+    def last(self, column: int = PRICE) -> float:
+        """
+        最新一笔的某个字段, 还没有行情时为NaN
+        :param column: 字段序号, 如 PRICE, BID_PRICE
+        """
+        return float(self._data[column, self._pos])
+
+    def window(self, count: int = None) -> np.ndarray:
+        """
+        最近 count 笔行情的只读视图, 形状为 (字段 x 笔数), 按时间顺序, 不复制数据; 下一笔写入后视图内容会变
+        :param count: 笔数, None 为缓冲区中的全部
+        """
+        size = len(self) if count is None else min(count, len(self))
+        end = self._pos + self.capacity + 1
+        view = self._data[:, end - size:end]
+        view.flags.writeable = False
+        return view
+
+    def column(self, column: int, count: int = None) -> np.ndarray:
+        """
+        最近 count 笔行情某个字段的只读视图
+        """
+        return self.window(count)[column]
+
+
+class TickBufferPool(object):
+    """
+    按合约代码管理 TickBuffer, 订阅时预先分配, 收到未订阅合约的行情时再分配
+    """
+    def __init__(self, capacity: int = 4096):
+        self.capacity = capacity
+        self.buffers = dict()
+
+    def ensure(self, instruments):
+        for instrument in instruments:
+            if instrument not in self.buffers:
+                self.buffers[instrument] = TickBuffer(self.capacity)
+
+    def discard(self, instruments):
+        for instrument in instruments:
+            self.buffers.pop(instrument, None)
+
+    def get(self, instrument: str) -> TickBuffer:
+        return self.buffers.get(instrument)
+
+    def append(self, tick: TickBar):
+        buffer = self.buffers.get(tick.instrument)
+        if buffer is None:
+            buffer = self.buffers[tick.instrument] = TickBuffer(self.capacity)
+        buffer.append_tick(tick)
+
+    def last_price(self, instrument: str) -> float:
+        """
+        :return: 最新价, 没有行情时为None
+        """
+        buffer = self.buffers.get(instrument)
+        if buffer is None or buffer.count == 0:
+            return None
+        return buffer.last(PRICE)
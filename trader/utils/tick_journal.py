@@ -0,0 +1,185 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import os
+import time
+import queue
+import asyncio
+import datetime
+import logging
+import threading
+
+import numpy as np
+import pandas as pd
+
+from trader.utils.bar_aggregator import trading_day_of
+from trader.utils.read_config import app_dir
+from trader.utils.tick import TickBar
+
+logger = logging.getLogger('TickJournal')
+
+# 每笔行情一条定长记录; time 为行情时间, received 为本进程收到行情的时间, 均为不带时区的本地时间
+TICK_DTYPE = np.dtype([
+    ('instrument', 'S16'), ('time', 'M8[us]'), ('received', 'M8[us]'), ('price', 'f8'), ('volume', 'i8'),
+    ('bid_price', 'f8'), ('bid_volume', 'i8'), ('ask_price', 'f8'), ('ask_volume', 'i8'), ('holding', 'f8'),
+    ('up_limit_price', 'f8'), ('down_limit_price', 'f8'), ('day_high', 'f8'), ('day_low', 'f8'),
+    ('open', 'f8'), ('pre_close', 'f8'),
+])
+TICK_FIELDS = ('price', 'volume', 'bid_price', 'bid_volume', 'ask_price', 'ask_volume', 'holding',
+               'up_limit_price', 'down_limit_price', 'day_high', 'day_low', 'open', 'pre_close')
+DEFAULT_CHANNEL = 'MSG:CTP:RSP:MARKET:OnRtnDepthMarketData:{}'
+
+
+class TickJournal(object):
+    """
+    行情日志: 每个交易日一个只追加的二进制文件, 记录格式固定为 TICK_DTYPE, 读取时内存映射。
+    record() 只把行情放入有界队列, 由后台线程批量转换和写盘, 队列满时丢弃并计数, 不阻塞事件循环。
+    进程崩溃时文件末尾可能留下不完整的记录, 读取时忽略, 重新打开追加前截掉
+    """
+    def __init__(self, root: str = None, queue_size: int = 100000, batch_size: int = 4096,
+                 flush_interval: float = 1.0):
+        self.root = root or os.path.join(app_dir.user_data_dir, 'ticks')
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.written = 0
+        self._queue = queue.Queue(queue_size)
+        self._thread = None
+        self._files = dict()  # {交易日: 文件对象}
+
+    def path(self, day: datetime.date) -> str:
+        return os.path.join(self.root, f'{day:%Y%m%d}.bin')
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            os.makedirs(self.root, exist_ok=True)
+            self._thread = threading.Thread(target=self._run, name='TickJournal', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        """
+        写完队列中剩余的行情后结束后台线程
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+        if self.dropped:
+            logger.warning(f'行情日志队列已满, 共丢弃{self.dropped}笔行情')
+
+    def record(self, tick: TickBar):
+        try:
+            self._queue.put_nowait((tick, time.time()))
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            items = list()
+            deadline = time.monotonic() + self.flush_interval
+            while len(items) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                items.append(item)
+            if items:
+                try:
+                    self._write(items)
+                except Exception as e:
+                    logger.warning(f'写入行情日志失败: {repr(e)}', exc_info=True)
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+
+    def _open(self, day: datetime.date):
+        f = open(self.path(day), 'ab')
+        # 上次崩溃时末尾可能留下不完整的记录, 先截掉, 否则之后追加的记录全部错位
+        size = f.seek(0, os.SEEK_END)
+        if size % TICK_DTYPE.itemsize:
+            f.truncate(size - size % TICK_DTYPE.itemsize)
+        return f
+
+    def _write(self, items: list):
+        ticks = [tick for tick, _ in items]
+        records = np.empty(len(items), dtype=TICK_DTYPE)
+        # 按列整体赋值, 比逐条记录逐个字段赋值快得多
+        records['instrument'] = [tick.instrument for tick in ticks]
+        records['time'] = [tick.dateTime for tick in ticks]
+        records['received'] = [datetime.datetime.fromtimestamp(received) for _, received in items]
+        for field in TICK_FIELDS:
+            records[field] = [getattr(tick, field) for tick in ticks]
+        days = np.array([trading_day_of(tick.dateTime) for tick in ticks], dtype='M8[D]')
+        for day in np.unique(days):
+            day = day.astype(datetime.date)
+            f = self._files.get(day)
+            if f is None:
+                for old in [key for key in self._files if key < day]:
+                    self._files.pop(old).close()
+                f = self._files[day] = self._open(day)
+            f.write((records if days[0] == days[-1] else records[days == np.datetime64(day)]).tobytes())
+            f.flush()
+        self.written += len(items)
+
+    def load(self, day: datetime.date) -> np.ndarray:
+        """
+        内存映射读取一个交易日的全部记录, 文件不存在时返回空数组
+        """
+        path = self.path(day)
+        if not os.path.exists(path):
+            return np.zeros(0, dtype=TICK_DTYPE)
+        count = os.path.getsize(path) // TICK_DTYPE.itemsize
+        if count == 0:
+            return np.zeros(0, dtype=TICK_DTYPE)
+        return np.memmap(path, dtype=TICK_DTYPE, mode='r', shape=(count, ))
+
+    def to_frame(self, day: datetime.date) -> pd.DataFrame:
+        df = pd.DataFrame(np.asarray(self.load(day)))
+        df['instrument'] = df['instrument'].str.decode('ascii')
+        return df
+
+    async def replay(self, day: datetime.date, callback, speed: float = None, instruments=None,
+                     channel_format: str = DEFAULT_CHANNEL) -> int:
+        """
+        按记录顺序把一个交易日的行情重新送给回调, 例如 replay(day, strategy.OnRtnDepthMarketData)
+        :param callback: async def callback(channel, tick: TickBar)
+        :param speed: 回放倍速, 1为按记录时的间隔, None为不等待
+        :param instruments: 只回放这些合约
+        :param channel_format: 回调收到的频道名格式
+        :return: 回放的行情笔数
+        """
+        records = self.load(day)
+        if instruments is not None:
+            records = records[np.isin(records['instrument'], [code.encode() for code in instruments])]
+        started, first = time.monotonic(), None
+        for record in records:
+            if speed:
+                if first is None:
+                    first = record['received']
+                delay = (record['received'] - first) / np.timedelta64(1, 's') / speed - \
+                    (time.monotonic() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            tick = TickBar.__new__(TickBar)
+            tick.instrument = record['instrument'].decode()
+            tick.dateTime = record['time'].astype(datetime.datetime)
+            for field in TICK_FIELDS:
+                setattr(tick, field, record[field].item())
+            await callback(channel_format.format(tick.instrument), tick)
+        return records.shape[0]
@@ -0,0 +1,200 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import os
+import asyncio
+import datetime
+import logging
+from bisect import bisect_left, bisect_right
+
+import ujson as json
+
+from trader.utils.read_config import app_dir
+
+logger = logging.getLogger('TradingCalendar')
+
+
+def to_date(day) -> datetime.date:
+    return day.date() if isinstance(day, datetime.datetime) else day
+
+
+class TradingCalendar(object):
+    """
+    本地保存的交易日历: 已确认的交易日按顺序存放, 查询用二分查找, 不访问网络。
+    日历按年刷新: 查询的日期所在年份还没确认过时, 对该年(截至昨天)所有工作日限制并发地探测,
+    周末直接视为非交易日。刷新结果写入文件, 多个进程共用
+    """
+    def __init__(self, probe=None, path: str = None, concurrency: int = 15, retries: int = 2, backoff: float = 1):
+        """
+        :param probe: async def probe(day: datetime.datetime) -> (day, bool), 判断某天是否为交易日,
+                      例如 trader.utils.check_trading_day, 无法确定时应抛出异常而不是返回False
+        :param concurrency: 同时进行的探测数, 不超过 probe 所用连接池的上限
+        :param retries: 探测失败后重试的轮数, 每轮只重试失败的日子
+        """
+        self.probe = probe
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.path = path or os.path.join(app_dir.user_data_dir, 'trading_calendar.json')
+        self.days = list()     # 已确认的交易日, 升序
+        self.covered = dict()  # {年份: 已确认到的日期}
+        self._mtime = None
+
+    def load(self):
+        """
+        文件被其他进程更新过时重新读取
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            self.days = [datetime.datetime.strptime(day, '%Y%m%d').date() for day in data['days']]
+            self.covered = {int(year): datetime.datetime.strptime(day, '%Y%m%d').date()
+                            for year, day in data['covered'].items()}
+            self._mtime = mtime
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f'TradingCalendar 读取 {self.path} 失败: {repr(e)}')
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'covered': {str(year): f'{day:%Y%m%d}' for year, day in self.covered.items()},
+                           'days': [f'{day:%Y%m%d}' for day in self.days]}, f)
+            os.replace(tmp_path, self.path)
+            self._mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            logger.warning(f'TradingCalendar 写入 {self.path} 失败: {repr(e)}')
+
+    def covers(self, day) -> bool:
+        day = to_date(day)
+        last = self.covered.get(day.year)
+        return last is not None and day <= last
+
+    def covers_range(self, start, end) -> bool:
+        """
+        [start, end] 期间每一年都已确认到 min(年末, end), 部分确认的年份(中途探测失败)不算覆盖
+        """
+        start, end = to_date(start), to_date(end)
+        return all(self.covers(min(datetime.date(year, 12, 31), end)) for year in range(start.year, end.year + 1))
+
+    async def ensure(self, start, end=None) -> int:
+        """
+        确认 [start, end] 期间(不晚于昨天)的每一天, 未确认的年份整年刷新
+        :return: 探测的天数
+        """
+        self.load()
+        yesterday = datetime.date.today() - datetime.timedelta(days=1)
+        start = to_date(start)
+        end = min(to_date(end) if end is not None else yesterday, yesterday)
+        count = 0
+        for year in range(start.year, end.year + 1):
+            until = min(datetime.date(year, 12, 31), yesterday)
+            if not self.covers(until):
+                count += await self.refresh_year(year, until)
+        return count
+
+    async def refresh_year(self, year: int, until: datetime.date = None) -> int:
+        """
+        从交易所确认一年中到 until 为止还没确认的日子
+        :return: 探测的天数
+        """
+        first = self.covered.get(year)
+        first = first + datetime.timedelta(days=1) if first is not None else datetime.date(year, 1, 1)
+        until = until or datetime.date(year, 12, 31)
+        if until < first:
+            return 0
+        weekdays = [first + datetime.timedelta(days=i) for i in range((until - first).days + 1)]
+        weekdays = [day for day in weekdays if day.weekday() < 5]
+        logger.debug(f'从交易所确认 {first} 至 {until} 的交易日...')
+        results = await self._probe_all(weekdays)
+        confirmed = until
+        found = list()
+        for day in weekdays:
+            result = results[day]
+            if isinstance(result, BaseException):
+                # 重试后仍失败时只确认到这一天之前, 下次从这里继续
+                logger.warning(f'确认交易日 {day} 失败: {repr(result)}')
+                confirmed = day - datetime.timedelta(days=1)
+                break
+            if result:
+                found.append(day)
+        if confirmed >= first:
+            self.load()
+            known = set(self.days)
+            known.update(found)
+            self.days = sorted(known)
+            self.covered[year] = max(confirmed, self.covered.get(year, confirmed))
+            self.save()
+        return len(weekdays)
+
+    async def _probe_all(self, days: list) -> dict:
+        """
+        限制并发地探测, 失败的日子隔一段时间再重试
+        :return: {日期: 是否交易日, 或最后一次的异常}
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def probe(day: datetime.date):
+            async with semaphore:
+                return (await self.probe(datetime.datetime.combine(day, datetime.time())))[1]
+
+        results = dict()
+        pending = days
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            for day, result in zip(pending, await asyncio.gather(*[probe(day) for day in pending],
+                                                               return_exceptions=True)):
+                results[day] = result
+            pending = [day for day in pending if isinstance(results[day], BaseException)]
+            if not pending:
+                break
+        return results
+
+    def is_trading_day(self, day) -> bool:
+        self.load()
+        day = to_date(day)
+        index = bisect_left(self.days, day)
+        return index < len(self.days) and self.days[index] == day
+
+    def next_trading_day(self, day):
+        """
+        day 之后(不含当天)的第一个交易日, 日历中没有时为None
+        """
+        self.load()
+        index = bisect_right(self.days, to_date(day))
+        return self.days[index] if index < len(self.days) else None
+
+    def previous_trading_day(self, day):
+        """
+        day 之前(不含当天)的最后一个交易日, 日历中没有时为None
+        """
+        self.load()
+        index = bisect_left(self.days, to_date(day))
+        return self.days[index - 1] if index > 0 else None
+
+    def trading_days(self, start, end) -> list:
+        """
+        [start, end] 期间的全部交易日
+        """
+        self.load()
+        return self.days[bisect_left(self.days, to_date(start)):bisect_right(self.days, to_date(end))]